@@ -1,71 +1,314 @@
-from typing import Callable, List, Optional, Self, cast
+import hashlib
+from typing import TYPE_CHECKING, Callable, Dict, Iterator, List, Optional, Self, TextIO, Tuple, TypeVar, cast
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from functools import lru_cache
 
-from lexer import Token, TokenType
+from lexer import Token
+from printer import code_string, expression_string, write_code
+from visitor import FunctionTransformer, invalidate_cached, link_child, note_field_change, walk_preorder
+
+if TYPE_CHECKING:
+    from node_index import NodeIndex
 
 
 class ASTNode(ABC):
+    __slots__ = ('_begin_pos', '_end_pos', 'parent', '_rendered', '_hash')
+    # Attributes holding child nodes or lists of child nodes, in children() order
+    _child_fields: Tuple[str, ...] = ()
+    # The other attributes that make up the node's content, positions and links aside
+    _value_fields: Tuple[str, ...] = ()
+
     def __init__(self, begin_pos: int, end_pos: int):
         self._begin_pos: int = begin_pos
         self._end_pos: int = end_pos
         self.parent: Optional[ASTNode] = None
+        # The text of a statement as of the last time its tree was printed under caching_renders(),
+        # None once anything in the subtree changes
+        self._rendered: Optional[str] = None
+        # structural_hash(), None until it is asked for and once anything in the subtree changes
+        self._hash: Optional[int] = None
 
     @abstractmethod
     def children(self) -> List['ASTNode']:
         pass
 
+    def __str__(self):
+        return self._render()
+
+    def _render(self) -> str:
+        return object.__str__(self)
+
     def replace_child(self, old_child: 'ASTNode', new_child: 'ASTNode'):
-        for key, value in self.__dict__.items():
+        for field in self._child_fields:
+            value = getattr(self, field)
             if value is old_child:
-                self.__dict__[key] = new_child
-                break
-        else:
-            raise ValueError(f"Child {old_child} not found")
-        new_child.parent = self
+                object.__setattr__(self, field, new_child)
+                link_child(self, old_child, new_child)
+                return
+            if isinstance(value, list):
+                index = next((i for i, item in enumerate(value) if item is old_child), None)
+                if index is not None:
+                    value[index] = new_child
+                    link_child(self, old_child, new_child)
+                    return
+        raise ValueError(f"Child {old_child} not found")
+
+    def assign(self, field: str, value):
+        # Sets one of the node's fields and keeps parent links, the node index, the tree's mutation
+        # count and cached text and hashes up to date. A plain assignment does none of that.
+        old_value = getattr(self, field)
+        object.__setattr__(self, field, value)
+        note_field_change(self, field, old_value)
 
     def replace_child_at_index(self, index: int, new_child: 'ASTNode'):
         old_child = self.children()[index]
         self.replace_child(old_child, new_child)
 
-    def find_node(self, predicate: Callable[['ASTNode'], bool]) -> Optional['ASTNode']:
-        def dfs(node: ASTNode) -> Optional[ASTNode]:
-            if predicate(node):
-                return node
-            for child in node.children():
-                result = dfs(child)
-                if result:
-                    return result
-            return None
-        
-        return dfs(self)
-    
-    def find_nodes(self, predicate: Callable[['ASTNode'], bool]) -> List['ASTNode']:
-        nodes = []
-        def dfs(node: 'ASTNode'):
-            if predicate(node):
-                nodes.append(node)
-            for child in node.children():
-                dfs(child)
-        dfs(self)
-        return nodes
+    def find_node(self, predicate: Callable[['ASTNode'], bool], prune: Optional[Callable[['ASTNode'], bool]] = None) -> Optional['ASTNode']:
+        return next(self.iter_nodes(predicate, prune), None)
+    
+    def find_nodes(self, predicate: Callable[['ASTNode'], bool], prune: Optional[Callable[['ASTNode'], bool]] = None) -> List['ASTNode']:
+        return list(self.iter_nodes(predicate, prune))
+
+    def iter_nodes(self, predicate: Callable[['ASTNode'], bool], prune: Optional[Callable[['ASTNode'], bool]] = None) -> Iterator['ASTNode']:
+        # Pre-order, stopping as soon as the caller does; prune(node) returning True skips node's children
+        return filter(predicate, walk_preorder(self, prune))
     
     def transform(self, transformation: Callable[['ASTNode'], Optional['ASTNode']]) -> 'ASTNode':
-        def dfs(node: ASTNode) -> Optional[ASTNode]:
-            result = transformation(node)
-            if result is not None:
-                return result
-            
-            for child in node.children():
-                new_child = dfs(child)
-                if new_child is not None and new_child is not child:
-                    node.replace_child(child, new_child)
-            
-            return None
-        
-        dfs(self)
-        return self
+        # Returns the transformed tree, which is transformation's result if it replaced self
+        return FunctionTransformer(transformation).visit(self) or self
+
+    def structural_hash(self) -> int:
+        # A hash of the classes, contents and shape of the subtree, without positions, that is the
+        # same from one run to the next. Kept in the nodes, like the text of caching_renders().
+        if self._hash is None:
+            _hash_subtree(self)
+        return cast(int, self._hash)
+
+    def equals(self, other: 'ASTNode') -> bool:
+        # Whether the subtrees have the same classes, contents and shape, positions aside. Subtrees
+        # with different hashes are told apart without walking them.
+        if self is other:
+            return True
+        if self.structural_hash() != other.structural_hash():
+            return False
+        return _same_structure(self, other)
+
+    def deep_copy(self) -> Self:
+        # A copy of the whole subtree, positions included, whose root has no parent yet. A node
+        # must only ever be in one place in a tree, a rule that puts the same subtree in several
+        # places puts copies there.
+        root = _shallow_copy(self, None)
+        stack = [root]
+        while stack:
+            copy = stack.pop()
+            # Its fields still hold the original children, in lists of its own
+            for field in copy._child_fields:
+                value = getattr(copy, field)
+                if value.__class__ is list:
+                    for index, child in enumerate(value):
+                        value[index] = child_copy = _shallow_copy(child, copy)
+                        stack.append(child_copy)
+                elif value is not None:
+                    child_copy = _shallow_copy(value, copy)
+                    object.__setattr__(copy, field, child_copy)
+                    stack.append(child_copy)
+        return cast(Self, root)
+
+
+@lru_cache(maxsize=None)
+def _slot_names(node_class: type) -> Tuple[str, ...]:
+    return tuple(name for base in node_class.__mro__ for name in getattr(base, '__slots__', ()))
+
+
+def _shallow_copy(node: ASTNode, parent: Optional[ASTNode]) -> ASTNode:
+    copy = object.__new__(node.__class__)
+    for name in _slot_names(node.__class__):
+        value = getattr(node, name, _UNSET)
+        if value is not _UNSET:
+            object.__setattr__(copy, name, value.copy() if value.__class__ is list else value)
+    object.__setattr__(copy, 'parent', parent)
+    if hasattr(copy, 'index'):
+        # A Program's index is of the original's nodes
+        object.__setattr__(copy, 'index', None)
+    return copy
+
+
+_UNSET = object()
+
+
+@contextmanager
+def caching_renders(program: 'Program') -> Iterator[None]:
+    # Makes printing program keep each statement's text in the statement, so that printing again
+    # only renders what changed since. replace_child, transform, rules and ASTNode.assign drop the
+    # text of the changed node and of everything above it. Any other change to the tree has to be
+    # followed by clear_caches(). Only program is affected, and the text is dropped on the way out.
+    caching = program.caching
+    program.caching = True
+    try:
+        yield
+    finally:
+        program.caching = caching
+        if not caching:
+            clear_caches(program)
+
+
+def clear_caches(root: ASTNode):
+    # Drops the cached text and structural hashes of root's subtree and of the nodes above it
+    for node in walk_preorder(root):
+        object.__setattr__(node, '_rendered', None)
+        object.__setattr__(node, '_hash', None)
+    invalidate_cached(root.parent)
+
+
+# Stands for None, whose hash() is not the same in every run before Python 3.12
+_NONE_HASH = 0x2545F491
+
+
+@lru_cache(maxsize=1 << 16)
+def stable_hash(text: str) -> int:
+    # hash() of a str changes from one run to the next
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=8).digest(), 'little')
+
+
+def _value_hash(value) -> int:
+    if value.__class__ is str:
+        return stable_hash(value)
+    if value.__class__ is list:
+        return hash(tuple(stable_hash(item) for item in value))
+    if value is None:
+        return _NONE_HASH
+    return hash(value)
+
+
+def _node_hash(node: ASTNode) -> int:
+    # From the hashes of node's children, which are already known
+    parts = [stable_hash(node.__class__.__name__)]
+    for field in node._value_fields:
+        parts.append(_value_hash(getattr(node, field)))
+    for field in node._child_fields:
+        value = getattr(node, field)
+        if value.__class__ is list:
+            parts.append(hash(tuple(child._hash for child in value)))
+        else:
+            parts.append(_NONE_HASH if value is None else value._hash)
+    return hash(tuple(parts))
+
+
+def _hash_subtree(root: ASTNode):
+    # Children before parents, without recursion, expressions can nest deeper than the stack
+    stack = [root]
+    while stack:
+        node = stack[-1]
+        pending = False
+        for field in node._child_fields:
+            value = getattr(node, field)
+            for child in (value if value.__class__ is list else (value,)):
+                if child is not None and child._hash is None:
+                    stack.append(child)
+                    pending = True
+        if not pending:
+            stack.pop()
+            if node._hash is None:
+                object.__setattr__(node, '_hash', _node_hash(node))
+
+
+def _same_structure(first: ASTNode, second: ASTNode) -> bool:
+    # Compares two subtrees with equal hashes node by node, down to the subtrees they share.
+    # Both are hashed, so children with different hashes end the walk early.
+    pairs = [(first, second)]
+    while pairs:
+        first, second = pairs.pop()
+        if first.__class__ is not second.__class__:
+            return False
+        for field in first._value_fields:
+            if getattr(first, field) != getattr(second, field):
+                return False
+        for field in first._child_fields:
+            first_value = getattr(first, field)
+            second_value = getattr(second, field)
+            if first_value.__class__ is list:
+                if len(first_value) != len(second_value):
+                    return False
+                children = zip(first_value, second_value)
+            elif first_value is None or second_value is None:
+                if first_value is not second_value:
+                    return False
+                continue
+            else:
+                children = ((first_value, second_value),)
+            for first_child, second_child in children:
+                if first_child is not second_child:
+                    if first_child._hash != second_child._hash:
+                        return False
+                    pairs.append((first_child, second_child))
+    return True
+
+
+LeafT = TypeVar('LeafT', bound=ASTNode)
+
+
+def _frozen(value):
+    return tuple(value) if value.__class__ is list else value
+
+
+# Hash-consing of leaves such as identifiers, literals and types. Every leaf put through intern()
+# takes the strings of the first equal leaf before it, so repeated names are stored once, and its
+# structural hash, which is only computed once for each distinct leaf. The nodes themselves are
+# not shared, each one keeps its own parent and positions.
+class LeafTable:
+    def __init__(self):
+        # (class, *contents) -> the first key equal to it, whose contents are shared, and their
+        # structural hash
+        self._leaves: Dict[tuple, Tuple[tuple, int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._leaves)
+
+    def intern(self, leaf: LeafT) -> LeafT:
+        fields = leaf._value_fields
+        if len(fields) == 1:
+            # Identifiers and literals, most of the leaves
+            key = (leaf.__class__, getattr(leaf, fields[0]))
+        else:
+            # Lists such as Type.specifiers are kept as tuples and each leaf gets a list of its own
+            key = (leaf.__class__,) + tuple([_frozen(getattr(leaf, field)) for field in fields])
+        shared = self._leaves.get(key)
+        if shared is None:
+            self._leaves[key] = (key, leaf.structural_hash())
+            return leaf
+        shared_key, leaf_hash = shared
+        for field, value in zip(fields, shared_key[1:]):
+            object.__setattr__(leaf, field, list(value) if value.__class__ is tuple else value)
+        object.__setattr__(leaf, '_hash', leaf_hash)
+        return leaf
+
+# Binding strength of the binary operators, higher binds tighter. The parser's expression
+# engine and BinaryOperation._needs_parentheses both read this table.
+COMMA_PRECEDENCE = 0
+ASSIGNMENT_PRECEDENCE = 1
+BINARY_OPERATOR_PRECEDENCE = {
+    ',': COMMA_PRECEDENCE,
+    '=': ASSIGNMENT_PRECEDENCE, '+=': ASSIGNMENT_PRECEDENCE, '-=': ASSIGNMENT_PRECEDENCE,
+    '*=': ASSIGNMENT_PRECEDENCE, '/=': ASSIGNMENT_PRECEDENCE, '%=': ASSIGNMENT_PRECEDENCE,
+    '&=': ASSIGNMENT_PRECEDENCE, '|=': ASSIGNMENT_PRECEDENCE, '^=': ASSIGNMENT_PRECEDENCE,
+    '<<=': ASSIGNMENT_PRECEDENCE, '>>=': ASSIGNMENT_PRECEDENCE,
+    '||': 2,
+    '&&': 3,
+    '|': 4,
+    '^': 5,
+    '&': 6,
+    '==': 7, '!=': 7,
+    '<': 8, '>': 8, '<=': 8, '>=': 8,
+    '+': 9, '-': 9,
+    '*': 10, '/': 10, '%': 10,
+}
+RIGHT_ASSOCIATIVE_PRECEDENCES = {COMMA_PRECEDENCE, ASSIGNMENT_PRECEDENCE}
 
 class Statement(ASTNode):
+    __slots__ = ()
+
     def __init__(self, begin_pos: int, end_pos: int):
         super().__init__(begin_pos, end_pos)
 
@@ -73,10 +316,29 @@ class Statement(ASTNode):
         return []
 
 class Program(ASTNode):
+    __slots__ = ('statements', 'comments', 'index', 'mutations', 'caching')
+    _child_fields = ('statements',)
+
     def __init__(self, statements: List[Statement], comments: List[Token], begin_pos: int, end_pos: int):
         super().__init__(begin_pos, end_pos)
         self.statements: List[Statement] = statements
         self.comments: List[Token] = comments
+        # Optional NodeIndex, kept up to date by replace_child and transform
+        self.index: Optional['NodeIndex'] = None
+        # Changes made to the tree, see visitor.mutation_count
+        self.mutations: int = 0
+        # Whether printing keeps the text of each node, see caching_renders
+        self.caching: bool = False
+
+    def nodes_of_class(self, cls: type) -> List[ASTNode]:
+        if self.index is not None:
+            return self.index.nodes_of_class(cls)
+        return self.find_nodes(lambda node: isinstance(node, cls))
+
+    def identifiers_named(self, name: str) -> List['Identifier']:
+        if self.index is not None:
+            return self.index.identifiers_named(name)
+        return cast(List[Identifier], self.find_nodes(lambda node: isinstance(node, Identifier) and node.name == name))
     
     def replace_child(self, old_child: ASTNode, new_child: ASTNode):
         if not isinstance(new_child, Statement):
@@ -84,68 +346,32 @@ class Program(ASTNode):
         try:
             index = self.statements.index(cast(Statement, old_child))
             self.statements[index] = cast(Statement, new_child)
-            new_child.parent = self
+            link_child(self, old_child, new_child)
         except ValueError:
             raise ValueError(f"Child {old_child} not found")
 
     def __str__(self):
-        result = self._get_declarations_string()
-        if not self.comments:
-            return result
-        return self._insert_comments(result)
-
-    def _get_declarations_string(self):
-        return '\n\n'.join(str(decl) for decl in self.statements)
-
-    def _insert_comments(self, result):
-        lines = result.split('\n')
-        comment_index = 0
-        for i, line in enumerate(lines):
-            indent, line_parts = self._get_indent_and_parts(line)
-            comment_index = self._process_line_comments(i, line_parts, comment_index)
-            lines[i] = indent + ' '.join(line_parts)
-        result = '\n'.join(lines)
-        return self._add_remaining_comments(result, comment_index)
-
-    def _get_indent_and_parts(self, line):
-        line_parts = line.split(' ')
-        indent = ''
-        if line_parts and not line_parts[0]:
-            indent = ' ' * len(line_parts[0])
-            line_parts = line_parts[1:]
-        return indent, line_parts
-
-    def _process_line_comments(self, line_number, line_parts, comment_index):
-        while comment_index < len(self.comments) and self.comments[comment_index].line <= line_number + 1:
-            comment = self.comments[comment_index]
-            if comment.type == TokenType.LINE_COMMENT:
-                line_parts.append(comment.value)
-            elif comment.type == TokenType.BLOCK_COMMENT:
-                self._insert_block_comment(line_parts, comment)
-            comment_index += 1
-        return comment_index
-
-    def _insert_block_comment(self, line_parts, comment):
-        closest_index = min(range(len(line_parts)), key=lambda j: abs(len(' '.join(line_parts[:j])) - comment.column))
-        line_parts.insert(closest_index, comment.value)
-
-    def _add_remaining_comments(self, result, comment_index):
-        while comment_index < len(self.comments):
-            result += f"\n{self.comments[comment_index].value}"
-            comment_index += 1
-        return result
+        # Not cached itself, its comments are not part of the tree
+        return code_string(self, self.comments, self.caching)
+
+    def write_to(self, stream: TextIO):
+        # Writes str(self) to stream line by line, without building the whole string
+        write_code(self, stream, self.comments, self.caching)
 
     def children(self) -> List[ASTNode]:
         return cast(List[ASTNode], self.statements.copy())
 
 class Type(ASTNode):
+    __slots__ = ('name', 'specifiers', 'pointer_count')
+    _value_fields = ('name', 'specifiers', 'pointer_count')
+
     def __init__(self, name: str, specifiers: List[str], pointer_count: Optional[int], begin_pos: int, end_pos: int):
         super().__init__(begin_pos, end_pos)
         self.name: str = name
         self.specifiers: List[str] = specifiers
         self.pointer_count: Optional[int] = pointer_count
 
-    def __str__(self):
+    def _render(self) -> str:
         result = ""
         if self.specifiers:
             result += ' '.join(self.specifiers) + ' '
@@ -158,6 +384,9 @@ class Type(ASTNode):
         return []
 
 class CompoundStatement(Statement):
+    __slots__ = ('statements',)
+    _child_fields = ('statements',)
+
     def __init__(self, statements: List[Statement], begin_pos: int, end_pos: int):
         super().__init__(begin_pos, end_pos)
         self.statements: List[Statement] = statements
@@ -168,37 +397,37 @@ class CompoundStatement(Statement):
         try:
             index = self.statements.index(cast(Statement, old_child))
             self.statements[index] = cast(Statement, new_child)
-            new_child.parent = self
+            link_child(self, old_child, new_child)
         except ValueError:
             raise ValueError(f"Child {old_child} not found")
     
-    def __str__(self):
-        stmt_strs = []
-        for stmt in self.statements:
-            if isinstance(stmt, LabelStatement):
-                # Do not indent label statements
-                stmt_strs.append(str(stmt))
-            else:
-                stmt_strs.append('    ' + str(stmt).replace('\n', '\n    '))
-        NEW_LINE = '\n'
-        return f"{{\n{NEW_LINE.join(stmt_strs)}\n}}"
+    def _render(self) -> str:
+        return code_string(self)
 
     def children(self) -> List[ASTNode]:
         return cast(List[ASTNode], self.statements.copy())
 
 class Parameter(ASTNode):
+    __slots__ = ('type', 'name')
+    _child_fields = ('type',)
+    _value_fields = ('name',)
+
     def __init__(self, type: Type, name: str, begin_pos: int, end_pos: int):
         super().__init__(begin_pos, end_pos)
         self.type = type
         self.name = name
     
-    def __str__(self):
+    def _render(self) -> str:
         return f"{self.type} {self.name}"
 
     def children(self) -> List[ASTNode]:
         return [self.type]
 
 class FunctionDeclaration(Statement):
+    __slots__ = ('return_type', 'name', 'parameters', 'body', 'calling_convention')
+    _child_fields = ('return_type', 'parameters', 'body')
+    _value_fields = ('name', 'calling_convention')
+
     def __init__(self, return_type: Type, name: str, parameters: List[Parameter], body: Optional[CompoundStatement], calling_convention: Optional[str], begin_pos: int, end_pos: int):
         super().__init__(begin_pos, end_pos)
         self.return_type: Type = return_type
@@ -213,23 +442,14 @@ class FunctionDeclaration(Statement):
         try:
             index = self.parameters.index(cast(Parameter, old_child))
             self.parameters[index] = cast(Parameter, new_child)
-            new_child.parent = self
+            link_child(self, old_child, new_child)
             return
         except ValueError:
             pass
         super().replace_child(old_child, new_child)
     
-    def __str__(self):
-        params = ', '.join(str(param) for param in self.parameters)
-        result = str(self.return_type)
-        if self.calling_convention:
-            result += f" {self.calling_convention}"
-        result += f" {self.name}({params})"
-        if self.body:
-            result += f"\n{self.body}"
-        else:
-            result += ";"
-        return result
+    def _render(self) -> str:
+        return code_string(self)
 
     def children(self) -> List[ASTNode]:
         children: List[ASTNode] = [self.return_type]
@@ -239,45 +459,44 @@ class FunctionDeclaration(Statement):
         return children
 
 class Operand(ASTNode):
+    __slots__ = ()
+
     def __init__(self, begin_pos: int, end_pos: int):
         super().__init__(begin_pos, end_pos)
 
+    def _render(self) -> str:
+        return expression_string(self)
+
     def children(self) -> List[ASTNode]:
         return []
 
 class ExpressionStatement(Statement):
+    __slots__ = ('expression',)
+    _child_fields = ('expression',)
+
     def __init__(self, expression: Operand, begin_pos: int, end_pos: int):
         super().__init__(begin_pos, end_pos)
         self.expression: Operand = expression
     
-    def __str__(self):
+    def _render(self) -> str:
         return f"{self.expression};"
 
     def children(self) -> List[ASTNode]:
         return [self.expression]
 
-def _indent(operand: Statement):
-    if isinstance(operand, CompoundStatement):
-        return str(operand)
-    return '\n'.join('    ' + line for line in str(operand).split('\n'))
-
 class IfStatement(Statement):
+    __slots__ = ('condition', 'then_branch', 'else_branch')
+    _child_fields = ('condition', 'then_branch', 'else_branch')
+
     def __init__(self, condition: Operand, then_branch: Statement, else_branch: Optional[Statement], begin_pos: int, end_pos: int):
         super().__init__(begin_pos, end_pos)
         self.condition: Operand = condition
         self.then_branch: Statement = then_branch
         self.else_branch: Optional[Statement] = else_branch
     
-    def __str__(self):
-        result = f"if ({self.condition})\n{_indent(self.then_branch)}"
-        current_else = self.else_branch
-        while isinstance(current_else, IfStatement):
-            result += f"\nelse if ({current_else.condition})\n{_indent(current_else.then_branch)}"
-            current_else = current_else.else_branch
-        if current_else:
-            result += f"\nelse\n{_indent(current_else)}"
-        return result
-    
+    def _render(self) -> str:
+        return code_string(self)
+
     def children(self) -> List[ASTNode]:
         children = [self.condition, self.then_branch]
         if self.else_branch:
@@ -285,18 +504,24 @@ class IfStatement(Statement):
         return children
 
 class WhileStatement(Statement):
+    __slots__ = ('condition', 'body')
+    _child_fields = ('condition', 'body')
+
     def __init__(self, condition, body, begin_pos: int, end_pos: int):
         super().__init__(begin_pos, end_pos)
         self.condition: Operand = condition
         self.body: Statement = body
     
-    def __str__(self):
-        return f"while ({self.condition})\n{self.body}"
+    def _render(self) -> str:
+        return code_string(self)
 
     def children(self) -> List[ASTNode]:
         return [self.condition, self.body]
 
 class ForStatement(Statement):
+    __slots__ = ('initializer', 'condition', 'increment', 'body')
+    _child_fields = ('initializer', 'condition', 'increment', 'body')
+
     def __init__(self, initializer: Optional[Statement], condition: Optional[Operand], increment: Optional[Operand], body: Statement, begin_pos: int, end_pos: int):
         super().__init__(begin_pos, end_pos)
         self.initializer: Optional[Statement] = initializer
@@ -304,16 +529,8 @@ class ForStatement(Statement):
         self.increment: Optional[Operand] = increment
         self.body: Statement = body
     
-    def __str__(self):
-        init_str = str(self.initializer) if self.initializer else ''
-        cond_str = str(self.condition) if self.condition else ''
-        incr_str = str(self.increment) if self.increment else ''
-        return f"for ({init_str} {cond_str}; {incr_str})\n{self._indent(self.body)}"
-    
-    def _indent(self, operand: Statement):
-        if isinstance(operand, CompoundStatement):
-            return str(operand)
-        return '\n'.join('    ' + line for line in str(operand).split('\n'))
+    def _render(self) -> str:
+        return code_string(self)
 
     def children(self) -> List[ASTNode]:
         children = []
@@ -327,11 +544,14 @@ class ForStatement(Statement):
         return children
 
 class ReturnStatement(Statement):
+    __slots__ = ('expression',)
+    _child_fields = ('expression',)
+
     def __init__(self, expression: Optional[Operand], begin_pos: int, end_pos: int):
         super().__init__(begin_pos, end_pos)
         self.expression: Optional[Operand] = expression
     
-    def __str__(self):
+    def _render(self) -> str:
         if self.expression:
             return f"return {self.expression};"
         return "return;"
@@ -340,49 +560,33 @@ class ReturnStatement(Statement):
         return [self.expression] if self.expression else []
 
 class JumpStatement(Statement):
+    __slots__ = ('jump_type',)
+    _value_fields = ('jump_type',)
+
     def __init__(self, jump_type: str, begin_pos: int, end_pos: int):
         super().__init__(begin_pos, end_pos)
         self.jump_type: str = jump_type
     
-    def __str__(self):
+    def _render(self) -> str:
         return f"{self.jump_type};"
 
     def children(self) -> List[ASTNode]:
         return []
 
 class BinaryOperation(Operand):
+    __slots__ = ('left', 'operator', 'right')
+    _child_fields = ('left', 'right')
+    _value_fields = ('operator',)
+
     def __init__(self, left: Operand, operator: str, right: Operand, begin_pos: int, end_pos: int):
         super().__init__(begin_pos, end_pos)
         self.left: Operand = left
         self.operator: str = operator
         self.right: Operand = right
     
-    def __str__(self):
-        left_str = str(self.left)
-        right_str = str(self.right)
-        
-        if ((isinstance(self.left, BinaryOperation) and self._needs_parentheses(self.left))
-            or isinstance(self.left, CommaOperation)):
-            left_str = f"({left_str})"
-        
-        if ((isinstance(self.right, BinaryOperation) and self._needs_parentheses(self.right))
-            or isinstance(self.right, CommaOperation)):
-            right_str = f"({right_str})"
-        
-        return f"{left_str} {self.operator} {right_str}"
-
     def _needs_parentheses(self, child_op: Self):
-        precedence = {
-            '*': 3, '/': 3, '%': 3,
-            '+': 2, '-': 2,
-            '<': 1, '>': 1, '<=': 1, '>=': 1,
-            '==': 0, '!=': 0,
-            '&&': -1,
-            '||': -2
-        }
-        
-        parent_precedence = precedence.get(self.operator, 0)
-        child_precedence = precedence.get(child_op.operator, 0)
+        parent_precedence = BINARY_OPERATOR_PRECEDENCE.get(self.operator, 0)
+        child_precedence = BINARY_OPERATOR_PRECEDENCE.get(child_op.operator, 0)
         
         if parent_precedence > child_precedence:
             return True
@@ -394,113 +598,111 @@ class BinaryOperation(Operand):
         return [self.left, self.right]
 
 class UnaryOperation(Operand):
+    __slots__ = ('operator', 'operand', 'is_postfix')
+    _child_fields = ('operand',)
+    _value_fields = ('operator', 'is_postfix')
+
     def __init__(self, operator: str, operand: Operand, is_postfix: bool, begin_pos: int, end_pos: int):
         super().__init__(begin_pos, end_pos)
         self.operator: str = operator
         self.operand: Operand = operand
         self.is_postfix: bool = is_postfix
     
-    def __str__(self):
-        if self.is_postfix:
-            return f"{self.operand}{self.operator}"
-        if isinstance(self.operand, BinaryOperation):
-            return f"{self.operator}({self.operand})"
-        return f"{self.operator}{self.operand}"
-
     def children(self) -> List[ASTNode]:
         return [self.operand]
 
 class ArrayAccess(Operand):
+    __slots__ = ('array', 'index')
+    _child_fields = ('array', 'index')
+
     def __init__(self, array: Operand, index: Operand, begin_pos: int, end_pos: int):
         super().__init__(begin_pos, end_pos)
         self.array: Operand = array
         self.index: Operand = index
     
-    def __str__(self):
-        return f"{self.array}[{self.index}]"
-    
     def children(self) -> List[ASTNode]:
         return [self.array, self.index]
 
 class MemberAccess(Operand):
+    __slots__ = ('object', 'member')
+    _child_fields = ('object', 'member')
+
     def __init__(self, object: Operand, member: Operand, begin_pos: int, end_pos: int):
         super().__init__(begin_pos, end_pos)
         self.object: Operand = object
         self.member: Operand = member
     
-    def __str__(self):
-        return f"{self.object}.{self.member}"
-    
     def children(self) -> List[ASTNode]:
         return [self.object, self.member]
 
 class PointerAccess(Operand):
+    __slots__ = ('pointer', 'member')
+    _child_fields = ('pointer', 'member')
+
     def __init__(self, pointer: Operand, member: Operand, begin_pos: int, end_pos: int):
         super().__init__(begin_pos, end_pos)
         self.pointer: Operand = pointer
         self.member: Operand = member
     
-    def __str__(self):
-        return f"{self.pointer}->{self.member}"
-    
     def children(self) -> List[ASTNode]:
         return [self.pointer, self.member]
 
 class TernaryOperation(Operand):
+    __slots__ = ('condition', 'true_branch', 'false_branch')
+    _child_fields = ('condition', 'true_branch', 'false_branch')
+
     def __init__(self, condition: Operand, true_branch: Operand, false_branch: Operand, begin_pos: int, end_pos: int):
         super().__init__(begin_pos, end_pos)
         self.condition: Operand = condition
         self.true_branch: Operand = true_branch
         self.false_branch: Operand = false_branch
     
-    def __str__(self):
-        return f"({self.condition} ? {self.true_branch} : {self.false_branch})"
-    
     def children(self) -> List[ASTNode]:
         return [self.condition, self.true_branch, self.false_branch]
 
 class Literal(Operand):
+    __slots__ = ('value',)
+    _value_fields = ('value',)
+
     def __init__(self, value: str, begin_pos: int, end_pos: int):
         super().__init__(begin_pos, end_pos)
         self.value: str = value
     
-    def __str__(self):
+    def _render(self) -> str:
         return self.value
     
     def children(self) -> List[ASTNode]:
         return []
 
 class StringLiteral(Literal):
-    pass # value should already have quotes
+    __slots__ = () # value should already have quotes
     
     def children(self) -> List[ASTNode]:
         return []
 
 class Identifier(Operand):
+    __slots__ = ('name',)
+    _value_fields = ('name',)
+
     def __init__(self, name: str, begin_pos: int, end_pos: int):
         super().__init__(begin_pos, end_pos)
         self.name: str = name
     
-    def __str__(self):
+    def _render(self) -> str:
         return self.name
     
     def children(self) -> List[ASTNode]:
         return []
 
 class FunctionCall(Operand):
+    __slots__ = ('function', 'arguments')
+    _child_fields = ('function', 'arguments')
+
     def __init__(self, function: Operand, arguments: List[Operand], begin_pos: int, end_pos: int):
         super().__init__(begin_pos, end_pos)
         self.function: Operand = function
         self.arguments: List[Operand] = arguments
     
-    def __str__(self):
-        if not self.arguments:
-            return f"{self.function}()"
-        args = ', '.join(str(arg) for arg in self.arguments)
-        if isinstance(self.function, UnaryOperation):
-            return f"({self.function})({args})"
-        return f"{self.function}({args})"
-    
     def children(self) -> List[ASTNode]:
         children: List[ASTNode] = [self.function]
         return children + self.arguments
@@ -511,20 +713,24 @@ class FunctionCall(Operand):
         try:
             arg = self.arguments.index(cast(Operand, old_child))
             self.arguments[arg] = cast(Operand, new_child)
-            new_child.parent = self
+            link_child(self, old_child, new_child)
             return
         except ValueError:
             pass
         super().replace_child(old_child, new_child)
 
 class VariableDeclaration(Statement):
+    __slots__ = ('type', 'name', 'initializer')
+    _child_fields = ('type', 'initializer')
+    _value_fields = ('name',)
+
     def __init__(self, type: Type, name: str, initializer: Optional[Operand], begin_pos: int, end_pos: int):
         super().__init__(begin_pos, end_pos)
         self.type: Type = type
         self.name: str = name
         self.initializer: Optional[Operand] = initializer
     
-    def __str__(self):
+    def _render(self) -> str:
         if self.initializer:
             return f"{self.type} {self.name} = {self.initializer};"
         return f"{self.type} {self.name};"
@@ -536,66 +742,68 @@ class VariableDeclaration(Statement):
         return children
 
 class GotoStatement(Statement):
+    __slots__ = ('label',)
+    _value_fields = ('label',)
+
     def __init__(self, label: str, begin_pos: int, end_pos: int):
         super().__init__(begin_pos, end_pos)
         self.label: str = label
     
-    def __str__(self):
+    def _render(self) -> str:
         return f"goto {self.label};"
     
     def children(self) -> List[ASTNode]:
         return []
 
 class LabelStatement(Statement):
+    __slots__ = ('label',)
+    _value_fields = ('label',)
+
     def __init__(self, label: str, begin_pos: int, end_pos: int):
         super().__init__(begin_pos, end_pos)
         self.label: str = label
     
-    def __str__(self):
+    def _render(self) -> str:
         return f"{self.label}:"
     
     def children(self) -> List[ASTNode]:
         return []
 
 class CommaOperation(BinaryOperation):
+    __slots__ = ()
+
     def __init__(self, left: Operand, right: Operand, begin_pos: int, end_pos: int):
         super().__init__(left, ',', right, begin_pos, end_pos)
     
-    def __str__(self):
-        return f"{self.left}, {self.right}"
-    
     def children(self) -> List[ASTNode]:
         return cast(List[ASTNode], [self.left, self.right])
 
 class SwitchStatement(Statement):
+    __slots__ = ('expression', 'cases')
+    _child_fields = ('expression', 'cases')
+
     def __init__(self, expression: Operand, cases: List['CaseStatement'], begin_pos: int, end_pos: int):
         super().__init__(begin_pos, end_pos)
         self.expression: Operand = expression
         self.cases: List['CaseStatement'] = cases
     
-    def __str__(self):
-        cases_str = '\n'.join(_indent(case) for case in self.cases)
-        return f"switch ({self.expression}) {{\n{cases_str}\n}}"
+    def _render(self) -> str:
+        return code_string(self)
 
     def children(self) -> List[ASTNode]:
         return [self.expression] + cast(List[ASTNode], self.cases)
 
 class CaseStatement(Statement):
+    __slots__ = ('value', 'statements')
+    _child_fields = ('value', 'statements')
+
     def __init__(self, value: Optional[Operand], statements: List[Statement], begin_pos: int, end_pos: int):
         super().__init__(begin_pos, end_pos)
         self.value: Optional[Operand] = value
         self.statements: List[Statement] = statements
     
-    def __str__(self):
-        prefix = "default:" if self.is_default_statement() else f"case {self.value}:"
-        if not self.statements:
-            return prefix
-        statement_strs = [ _indent(stmt) for stmt in self.statements]
-        for i, stmt_str in enumerate(statement_strs):
-            if isinstance(self.statements[i], LabelStatement):
-                statement_strs[i] = stmt_str.strip()
-        NEW_LINE = '\n'
-        return f"{prefix}\n{NEW_LINE.join(statement_strs)}"
+    def _render(self) -> str:
+        return code_string(self)
 
     def children(self) -> List[ASTNode]:
         children = cast(List[ASTNode], self.statements.copy())
@@ -0,0 +1,138 @@
+import argparse
+import os
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import binary_ast
+from hex_rays_parser import Parser
+from lexer import TokenBuffer
+from parse_cache import DEFAULT_MAX_BYTES, ParseCache
+from refactorings import apply_refactorings
+
+MODES = ('refactor', 'ast')
+
+
+class BatchResult:
+    def __init__(self, path: str, output: Any = None, error: Optional[str] = None, cache_hits: int = 0, cache_misses: int = 0):
+        self.path: str = path
+        # Refactored source text in 'refactor' mode, binary_ast.dumps() output in 'ast' mode
+        self.output: Any = output
+        self.error: Optional[str] = error
+        # Top-level statements of the file loaded from and added to the parse cache
+        self.cache_hits: int = cache_hits
+        self.cache_misses: int = cache_misses
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+# One ParseCache per cache directory in each worker process, reused for every file it handles
+_caches: Dict[str, ParseCache] = {}
+
+
+def process_file(path: str, mode: str = 'refactor', cache_directory: Optional[str] = None,
+                 cache_size: int = DEFAULT_MAX_BYTES) -> BatchResult:
+    try:
+        with open(path, encoding='utf-8', errors='replace') as file:
+            code = file.read()
+        hits = misses = 0
+        if cache_directory is None:
+            program = Parser(tokens=TokenBuffer(code)).parse()
+        else:
+            cache = _caches.get(cache_directory)
+            if cache is None:
+                cache = _caches[cache_directory] = ParseCache(cache_directory, cache_size)
+            hits, misses = cache.stats.hits, cache.stats.misses
+            program = cache.parse(code)
+            hits, misses = cache.stats.hits - hits, cache.stats.misses - misses
+        if mode == 'refactor':
+            return BatchResult(path, str(apply_refactorings(program)), cache_hits=hits, cache_misses=misses)
+        # Bytes, which are sent back from a worker without pickle recursing once per tree level
+        return BatchResult(path, binary_ast.dumps(program), cache_hits=hits, cache_misses=misses)
+    except Exception as e:
+        # One bad dump must not take the rest of the batch down with it
+        return BatchResult(path, error=''.join(traceback.format_exception_only(type(e), e)).strip())
+
+
+def process_files(paths: List[str], workers: Optional[int] = None, chunk_size: int = 1, mode: str = 'refactor',
+                  cache_directory: Optional[str] = None, cache_size: int = DEFAULT_MAX_BYTES) -> List[BatchResult]:
+    if mode not in MODES:
+        raise ValueError(f"Unknown mode {mode}")
+    process = partial(process_file, mode=mode, cache_directory=cache_directory, cache_size=cache_size)
+    if workers == 1:
+        return [process(path) for path in paths]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # map() yields results in input order regardless of which worker finishes first
+        return list(executor.map(process, paths, chunksize=chunk_size))
+
+
+def collect_files(paths: Iterable[str], extension: str = '.c') -> List[Tuple[str, str]]:
+    # Each file with the name its output gets: its path under the directory it was found in, or
+    # its file name when it was given itself
+    files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append((path, os.path.basename(path)))
+            continue
+        for root, directories, names in os.walk(path):
+            directories.sort()
+            files.extend((os.path.join(root, name), os.path.relpath(os.path.join(root, name), path))
+                         for name in sorted(names) if name.endswith(extension))
+    return files
+
+
+def _write_output(result: BatchResult, output_path: str, mode: str):
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    if mode == 'refactor':
+        with open(output_path, 'w', encoding='utf-8') as file:
+            file.write(result.output)
+    else:
+        with open(output_path + '.ast', 'wb') as file:
+            file.write(result.output)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    argument_parser = argparse.ArgumentParser(description="Parse Hex-Rays pseudocode dumps in parallel")
+    argument_parser.add_argument('paths', nargs='+', help="files or directories of .c files")
+    argument_parser.add_argument('-j', '--workers', type=int, default=None, help="worker processes, defaults to the CPU count")
+    argument_parser.add_argument('--chunk-size', type=int, default=1, help="files handed to a worker at a time")
+    argument_parser.add_argument('--mode', choices=MODES, default='refactor')
+    argument_parser.add_argument('-o', '--output', help="directory to write refactored files or serialized ASTs to")
+    argument_parser.add_argument('--cache', help="directory of parsed functions to reuse between runs")
+    argument_parser.add_argument('--cache-size', type=int, default=DEFAULT_MAX_BYTES // (1024 * 1024),
+                                 help="size limit of the cache in MiB, enforced by each worker")
+    args = argument_parser.parse_args(argv)
+
+    files = collect_files(args.paths)
+    if args.output:
+        seen: Dict[str, str] = {}
+        for path, name in files:
+            other = seen.setdefault(os.path.normcase(os.path.normpath(name)), path)
+            if other != path:
+                print(f"{path}: same output file {name} as {other}", file=sys.stderr)
+                return 2
+        os.makedirs(args.output, exist_ok=True)
+    names = dict(files)
+    failures = 0
+    cache_hits = cache_misses = 0
+    for result in process_files([path for path, _ in files], args.workers, args.chunk_size, args.mode, args.cache,
+                                args.cache_size * 1024 * 1024):
+        cache_hits += result.cache_hits
+        cache_misses += result.cache_misses
+        if not result.ok:
+            failures += 1
+            print(f"{result.path}: {result.error}", file=sys.stderr)
+        elif args.output:
+            _write_output(result, os.path.join(args.output, names[result.path]), args.mode)
+    print(f"{len(files) - failures}/{len(files)} files parsed", file=sys.stderr)
+    if args.cache:
+        print(f"parse cache: {cache_hits} hits, {cache_misses} misses", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
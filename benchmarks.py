@@ -0,0 +1,706 @@
+import importlib.util
+import os
+import pickle
+import random
+import re
+import sys
+import time
+import tempfile
+import tracemalloc
+from typing import Callable, List, Optional, Type, cast
+
+from ast_nodes import (ASTNode, CompoundStatement, FunctionCall, FunctionDeclaration, IfStatement, Identifier, Literal, Operand,
+                       Program, caching_renders)
+import binary_ast
+from batch import process_files
+from comment_anchors import attach_comments
+from hex_rays_parser import Parser, StatementKind
+from incremental import reparse
+from parse_cache import CacheStats, ParseCache
+from printer import code_string
+from lexer import CharLexer, Lexer, TokenBuffer, TokenType
+from refactorings import (RULES, Rule, RuleEngine, WorklistEngine, apply_refactorings, inline_comma_assignment,
+                          remove_calling_convention, remove_data_arrow, remove_vtbl_and_first_arg)
+from visitor import mutation_count
+from serialization import decode, encode
+
+
+# Building blocks for synthetic Hex-Rays style pseudocode. The generated code only uses
+# constructs the parser understands, so the same corpus can drive every benchmark.
+_TYPES = ['int', '__int64', 'char', '_DWORD', '_BYTE', 'unsigned int', 'const char', 'void', 'bool']
+_CALLING_CONVENTIONS = ['__cdecl', '__stdcall', '__fastcall', '__thiscall']
+
+
+def _expression(rng: random.Random, names: List[str], depth: int = 0) -> str:
+    choice = rng.randint(0, 9 if depth < 3 else 2)
+    if choice == 0:
+        return rng.choice(names)
+    if choice == 1:
+        return str(rng.randint(0, 255)) if rng.random() < 0.5 else hex(rng.randint(0, 0xFFFFFF)) + 'u'
+    if choice == 2:
+        return f"{rng.choice(names)}[{rng.randint(0, 16)}]"
+    if choice == 3:
+        return f"sub_{rng.randint(0x401000, 0x4FFFFF):X}({_expression(rng, names, depth + 1)})"
+    if choice == 4:
+        return f"this->vtbl->Method{rng.randint(0, 40)}(this, {_expression(rng, names, depth + 1)})"
+    if choice == 5:
+        return f"this->data.field_{rng.randint(0, 0x40):X}"
+    if choice == 6:
+        return f"!{_expression(rng, names, depth + 1)}"
+    if choice == 7:
+        return f"({_expression(rng, names, depth + 1)} {rng.choice(['&&', '||'])} {_expression(rng, names, depth + 1)})"
+    op = rng.choice(['+', '-', '*', '/', '%', '&', '|', '^', '==', '!=', '<', '>=', '&&', '||'])
+    return f"{_expression(rng, names, depth + 1)} {op} {_expression(rng, names, depth + 1)}"
+
+
+def _statement(rng: random.Random, names: List[str], indent: str, depth: int = 0) -> List[str]:
+    choice = rng.randint(0, 8 if depth < 2 else 3)
+    name = rng.choice(names)
+    if choice <= 1:
+        return [f"{indent}{name} = {_expression(rng, names)};"]
+    if choice == 2:
+        return [f"{indent}{name} += {_expression(rng, names)}; // {rng.randint(0, 99)}"]
+    if choice == 3:
+        return [f"{indent}sub_{rng.randint(0x401000, 0x4FFFFF):X}(\"str_{rng.randint(0, 999)}\\n\", {name});"]
+    if choice == 4:
+        lines = [f"{indent}if ( {_expression(rng, names)} )", f"{indent}{{"]
+        for _ in range(rng.randint(1, 3)):
+            lines += _statement(rng, names, indent + '  ', depth + 1)
+        lines += [f"{indent}}}", f"{indent}else", f"{indent}{{"]
+        lines += _statement(rng, names, indent + '  ', depth + 1)
+        return lines + [f"{indent}}}"]
+    if choice == 5:
+        lines = [f"{indent}while ( {name} < {rng.randint(1, 100)} )", f"{indent}{{"]
+        lines += _statement(rng, names, indent + '  ', depth + 1)
+        return lines + [f"{indent}  ++{name};", f"{indent}}}"]
+    if choice == 6:
+        lines = [f"{indent}for ( {name} = 0; {name} < {rng.randint(1, 64)}; ++{name} )"]
+        return lines + _statement(rng, names, indent + '  ', depth + 1)
+    if choice == 7:
+        lines = [f"{indent}switch ( {name} )", f"{indent}{{"]
+        for case in range(rng.randint(1, 3)):
+            lines.append(f"{indent}  case {case}:")
+            lines += _statement(rng, names, indent + '    ', depth + 1)
+            lines.append(f"{indent}    break;")
+        return lines + [f"{indent}  default:", f"{indent}    return {name};", f"{indent}}}"]
+    return [f"{indent}/* {name} */ {name} = ({name} = {rng.randint(0, 9)}, {name} == {rng.randint(0, 9)});"]
+
+
+def generate_corpus(function_count: int, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    functions = []
+    for index in range(function_count):
+        calling_convention = rng.choice(_CALLING_CONVENTIONS)
+        parameters = ['Object *this'] if calling_convention == '__thiscall' else []
+        parameters += [f"{rng.choice(_TYPES)} a{i + 2}" for i in range(rng.randint(0, 3))]
+        names = [f"v{i}" for i in range(rng.randint(2, 8))]
+        lines = [f"{rng.choice(_TYPES)} {calling_convention} Object::Method_{index}({', '.join(parameters)})",
+                 f"{{ // 0x{0x401000 + index * 0x40:X}"]
+        lines += [f"  {rng.choice(_TYPES)} {name}; // [esp+{i * 4:X}h] [ebp-{i * 4 + 4:X}h]" for i, name in enumerate(names)]
+        lines.append("")
+        for _ in range(rng.randint(2, 10)):
+            lines += _statement(rng, names, '  ')
+        lines += [f"  return {rng.choice(names)};", "}"]
+        functions.append('\n'.join(lines))
+    return '\n\n'.join(functions) + '\n'
+
+
+def _chain_code(term_count: int = 3000) -> str:
+    # A function returning one long && chain, nested as deep as it has terms
+    return f"int f()\n{{\n    return {' && '.join(f'a{index}' for index in range(term_count))};\n}}\n"
+
+
+def _timed(func: Callable[[], object], repeat: int = 3) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _lex_all(lexer_class: Type[CharLexer], code: str) -> int:
+    lexer = lexer_class(code)
+    count = 0
+    while lexer.next_token().type != TokenType.EOF:
+        count += 1
+    return count
+
+
+def bench_lexer(function_count: int = 500) -> None:
+    code = generate_corpus(function_count)
+    # CharLexer recurses once per skipped whitespace character
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 10000))
+    token_count = _lex_all(Lexer, code)
+    print(f"lexer: {len(code)} chars, {token_count} tokens")
+    for lexer_class in (CharLexer, Lexer):
+        elapsed = _timed(lambda: _lex_all(lexer_class, code))
+        print(f"  {lexer_class.__name__:<10} {token_count / elapsed:>12,.0f} tokens/s")
+
+
+def bench_token_buffer(function_count: int = 200) -> None:
+    code = generate_corpus(function_count)
+    tokens = TokenBuffer(code)
+    print(f"token buffer: {len(code)} chars, {len(tokens)} tokens")
+    print(f"  build buffer        {_timed(lambda: TokenBuffer(code)):8.3f}s")
+    print(f"  parse, lexer        {_timed(lambda: Parser(code=code).parse()):8.3f}s")
+    print(f"  parse, new buffer   {_timed(lambda: Parser(tokens=TokenBuffer(code)).parse()):8.3f}s")
+    print(f"  parse, same buffer  {_timed(lambda: Parser(tokens=tokens).parse()):8.3f}s")
+
+
+def bench_scaling(function_count: int = 10, max_ratio: float = 2.5) -> None:
+    # Parse time per character must stay roughly constant from 1x to 100x input size.
+    # A per-token copy of the remaining input used to make this grow with the file size.
+    print("scaling:")
+    per_char = []
+    for factor in (1, 10, 100):
+        code = generate_corpus(function_count * factor)
+        elapsed = _timed(lambda: Parser(code=code).parse(), repeat=3 if factor < 100 else 1)
+        per_char.append(elapsed / len(code))
+        print(f"  {factor:>4}x {len(code):>10} chars {elapsed:8.3f}s {per_char[-1] * 1e6:8.3f} us/char")
+    assert per_char[-1] <= per_char[0] * max_ratio, "parse time grows faster than linearly"
+
+
+def bench_memo(function_count: int = 200) -> None:
+    # The lookahead classifier parses each type and signature once, so only trial parsing
+    # has anything to reuse
+    code = generate_corpus(function_count)
+    print("packrat memo:")
+    for parser_class in (Parser, _TrialParser):
+        for memoize in (False, True):
+            parser = parser_class(code=code, memoize=memoize)
+            parser.parse()
+            elapsed = _timed(lambda: parser_class(code=code, memoize=memoize).parse())
+            label = 'lookahead' if parser_class is Parser else 'trial'
+            print(f"  {label + ',':<10} memoize={memoize!s:<5} {elapsed:8.3f}s  {parser.memo_stats if memoize else ''}")
+
+
+class _TrialParser(Parser):
+    # Classifies statements the way the parser did before the lookahead classifier
+    def classify_statement(self) -> StatementKind:
+        return self._classify_by_trial()
+
+
+def bench_classifier(function_count: int = 200) -> None:
+    code = generate_corpus(function_count)
+    print(f"statement classifier: {function_count} functions")
+    print(f"  trial parsing       {_timed(lambda: _TrialParser(code=code).parse()):8.3f}s")
+    print(f"  lookahead           {_timed(lambda: Parser(code=code).parse()):8.3f}s")
+    tokens = TokenBuffer(code)
+    print(f"  trial, buffer       {_timed(lambda: _TrialParser(tokens=tokens).parse()):8.3f}s")
+    print(f"  lookahead, buffer   {_timed(lambda: Parser(tokens=tokens).parse()):8.3f}s")
+
+
+def bench_expressions(depth: int = 20000) -> None:
+    # Shapes that used to need one Python frame per nesting level and operator precedence level
+    print(f"expressions, depth {depth}:")
+    shapes = {
+        'parentheses': 'x = ' + '(' * depth + 'a' + ')' * depth + ';',
+        '&& chain': 'x = ' + ' && '.join(f"a{i}" for i in range(depth)) + ';',
+        'prefix operators': 'x = ' + '-' * depth + 'a;',
+        'nested calls': 'x = ' + 'f(' * depth + 'a' + ')' * depth + ';',
+        'assignment chain': ' = '.join(f"a{i}" for i in range(depth)) + ';',
+    }
+    for name, code in shapes.items():
+        print(f"  {name:<18} {_timed(lambda: Parser(code=code).parse(), repeat=1):8.3f}s")
+
+
+def _peak_memory(func: Callable[[], object]) -> int:
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _stream(code: str) -> int:
+    count = 0
+    for statement, comments in Parser(tokens=TokenBuffer(code)).iter_statements():
+        count += 1
+    return count
+
+
+def bench_streaming(function_count: int = 2000) -> None:
+    code = generate_corpus(function_count)
+    print(f"streaming: {function_count} functions, {len(code)} chars")
+    print(f"  parse()             {_timed(lambda: Parser(tokens=TokenBuffer(code)).parse(), repeat=1):8.3f}s"
+          f" {_peak_memory(lambda: Parser(tokens=TokenBuffer(code)).parse()) / 2 ** 20:8.1f} MiB peak")
+    print(f"  iter_statements()   {_timed(lambda: _stream(code), repeat=1):8.3f}s"
+          f" {_peak_memory(lambda: _stream(code)) / 2 ** 20:8.1f} MiB peak")
+
+
+def bench_batch(file_count: int = 32, function_count: int = 20) -> None:
+    program = Parser(code=generate_corpus(function_count * 10)).parse()
+    encoded = encode(program)
+    print("serialized AST:")
+    print(f"  pickle objects      {len(pickle.dumps(program)):>10} bytes {_timed(lambda: pickle.loads(pickle.dumps(program))):8.3f}s")
+    print(f"  pickle encoded      {len(pickle.dumps(encoded)):>10} bytes {_timed(lambda: pickle.loads(pickle.dumps(encode(program)))):8.3f}s")
+    print(f"  decode              {'':>16} {_timed(lambda: decode(encoded)):8.3f}s")
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for index in range(file_count):
+            paths.append(os.path.join(directory, f"dump_{index}.c"))
+            with open(paths[-1], 'w') as file:
+                file.write(generate_corpus(function_count, seed=index))
+        print(f"batch: {file_count} files, {os.cpu_count()} CPUs")
+        for workers in (1, None):
+            elapsed = _timed(lambda: process_files(paths, workers, chunk_size=4, mode='ast'), repeat=1)
+            print(f"  workers={workers!s:<5}       {elapsed:8.3f}s")
+
+
+def _count_nodes(root: ASTNode) -> int:
+    count = 0
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        count += 1
+        stack.extend(node.children())
+    return count
+
+
+def _instance_size(instance: object) -> int:
+    return sys.getsizeof(instance) + (sys.getsizeof(instance.__dict__) if hasattr(instance, '__dict__') else 0)
+
+
+def bench_memory(function_count: int = 300) -> None:
+    tokens = TokenBuffer(generate_corpus(function_count))
+    tracemalloc.start()
+    try:
+        program = Parser(tokens=tokens).parse()
+        retained = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    node_count = _count_nodes(program)
+    print(f"memory: {node_count} nodes, {len(program.comments)} comments")
+    print(f"  retained            {retained / node_count:8.1f} bytes/node")
+    identifier = program.find_node(lambda node: isinstance(node, Identifier))
+    print(f"  Identifier          {_instance_size(identifier):8} bytes")
+    print(f"  Token               {_instance_size(program.comments[0]):8} bytes")
+
+
+def bench_flat(function_count: int = 300) -> None:
+    from flat_ast import FlatAST
+
+    program = Parser(tokens=TokenBuffer(generate_corpus(function_count))).parse()
+    node_count = _count_nodes(program)
+    tracemalloc.start()
+    try:
+        flat = FlatAST.from_program(program)
+        retained = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    print(f"flat AST: {node_count} nodes, {len(flat.strings)} strings")
+    print(f"  columns             {flat.nbytes / node_count:8.1f} bytes/node")
+    print(f"  retained            {retained / node_count:8.1f} bytes/node")
+    print(f"  from_program        {_timed(lambda: FlatAST.from_program(program)):8.3f}s")
+    print(f"  to_program          {_timed(flat.to_program):8.3f}s")
+    name = next(str(call.function) for call in program.find_nodes(lambda node: isinstance(node, FunctionCall))
+                if isinstance(call.function, Identifier))
+    def find_calls():
+        return program.find_nodes(lambda node: isinstance(node, FunctionCall) and isinstance(node.function, Identifier)
+                                  and node.function.name == name)
+    print(f"  find_nodes          {_timed(find_calls):8.4f}s")
+    print(f"  calls_to            {_timed(lambda: flat.calls_to(name)):8.4f}s")
+
+
+def _children_find_nodes(root: ASTNode, predicate: Callable[[ASTNode], bool]) -> List[ASTNode]:
+    # find_nodes as it was before the visitor, going through children()
+    nodes = []
+    def dfs(node: ASTNode):
+        if predicate(node):
+            nodes.append(node)
+        for child in node.children():
+            dfs(child)
+    dfs(root)
+    return nodes
+
+
+def _children_transform(root: ASTNode, transformation: Callable[[ASTNode], Optional[ASTNode]]) -> ASTNode:
+    # transform as it was before the visitor, going through children() and replace_child()
+    def dfs(node: ASTNode) -> Optional[ASTNode]:
+        result = transformation(node)
+        if result is not None:
+            return result
+        for child in node.children():
+            new_child = dfs(child)
+            if new_child is not None and new_child is not child:
+                node.replace_child(child, new_child)
+        return None
+    dfs(root)
+    return root
+
+
+def _allocated(func: Callable[[], object]) -> int:
+    # Peak memory allocated while func runs, beyond what was allocated before
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        func()
+        return tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+
+
+def bench_traversal(function_count: int = 300) -> None:
+    program = Parser(tokens=TokenBuffer(generate_corpus(function_count))).parse()
+    node_count = _count_nodes(program)
+    is_call = lambda node: isinstance(node, FunctionCall)
+    # Replaces every literal with itself, so each one goes through a replacement
+    same_literal = lambda node: Literal(node.value, node._begin_pos, node._end_pos) if type(node) is Literal else None
+    print(f"traversal: {node_count} nodes")
+    keep = lambda node: None
+    for name, func in (('find_nodes, children()', lambda: _children_find_nodes(program, is_call)),
+                       ('find_nodes, walker', lambda: program.find_nodes(is_call)),
+                       ('transform, children()', lambda: _children_transform(program, keep)),
+                       ('transform, visitor', lambda: program.transform(keep)),
+                       ('replace, children()', lambda: _children_transform(program, same_literal)),
+                       ('replace, visitor', lambda: program.transform(same_literal))):
+        print(f"  {name:<24}{_timed(func):8.3f}s {_allocated(func):>10} bytes peak")
+    # Walkers are generators, so a search stops at its first match
+    is_declaration = lambda node: isinstance(node, FunctionDeclaration)
+    print(f"  find_node, first      {_timed(lambda: program.find_node(is_declaration)):10.6f}s")
+    deep = Parser(code='x = ' + '-' * 20000 + 'a;').parse()
+    print(f"  find_nodes, depth 20000 {_timed(lambda: deep.find_nodes(is_call)):8.3f}s")
+
+
+def bench_index(function_count: int = 300) -> None:
+    code = generate_corpus(function_count)
+    tokens = TokenBuffer(code)
+    program = Parser(tokens=tokens).parse()
+    indexed = Parser(tokens=tokens, index=True).parse()
+    print(f"node index: {len(indexed.index)} nodes")
+    print(f"  parse               {_timed(lambda: Parser(tokens=tokens).parse()):8.3f}s")
+    print(f"  parse, index        {_timed(lambda: Parser(tokens=tokens, index=True).parse()):8.3f}s")
+    for name, func in (('calls, find_nodes', lambda: program.nodes_of_class(FunctionCall)),
+                       ('calls, index', lambda: indexed.nodes_of_class(FunctionCall)),
+                       ('identifier, find_nodes', lambda: program.identifiers_named('this')),
+                       ('identifier, index', lambda: indexed.identifiers_named('this'))):
+        print(f"  {name:<22}{_timed(func):8.4f}s")
+
+
+def _str_fixed_point(ast: ASTNode) -> ASTNode:
+    # apply_refactorings as it was before change tracking, printing the tree twice per round
+    while True:
+        ast_before = str(ast)
+        ast.transform(remove_vtbl_and_first_arg)
+        ast.transform(remove_data_arrow)
+        ast.transform(inline_comma_assignment)
+        ast.transform(remove_calling_convention)
+        if ast_before == str(ast):
+            return ast
+
+
+def _uncommented_program(tokens: TokenBuffer) -> Program:
+    # Comments left out, so that only the printing of the tree itself is measured and compared
+    program = Parser(tokens=tokens).parse()
+    program.comments = []
+    return program
+
+
+def bench_refactor(function_count: int = 300) -> None:
+    tokens = TokenBuffer(generate_corpus(function_count))
+    print(f"refactor: {function_count} functions")
+    print(f"  parse only          {_timed(lambda: _uncommented_program(tokens)):8.3f}s")
+    print(f"  str() fixed point   {_timed(lambda: _str_fixed_point(_uncommented_program(tokens))):8.3f}s")
+    print(f"  mutation count      {_timed(lambda: apply_refactorings(_uncommented_program(tokens))):8.3f}s")
+    # One round over an already refactored tree: nothing left to rewrite, so this is the traversal cost
+    program = apply_refactorings(_uncommented_program(tokens))
+    visits = [0]
+    def counted(node: ASTNode) -> None:
+        visits[0] += 1
+    def separate_passes():
+        for function in (remove_vtbl_and_first_arg, remove_data_arrow, inline_comma_assignment, remove_calling_convention):
+            program.transform(function)
+    for function in (remove_vtbl_and_first_arg, remove_data_arrow, inline_comma_assignment):
+        program.transform(lambda node: counted(node) or function(node))
+    # remove_calling_convention returns the function itself, so its pass stops at declarations
+    program.transform(lambda node: counted(node) or (node if isinstance(node, FunctionDeclaration) else None))
+    print(f"  round, 4 passes     {_timed(separate_passes):8.3f}s {visits[0]:>8} node visits")
+    visits[0] = 0
+    RuleEngine([Rule(counted, (ASTNode,))]).visit(program)
+    print(f"  round, fused        {_timed(lambda: RuleEngine(RULES).visit(program)):8.3f}s {visits[0]:>8} node visits")
+
+
+def _rounds_fixed_point(ast: ASTNode) -> int:
+    # The fused engine run in full rounds until one changes nothing, as before the worklist
+    engine = RuleEngine(RULES)
+    rounds = 0
+    while True:
+        mutations_before = mutation_count(ast)
+        engine.visit(ast)
+        rounds += 1
+        if mutation_count(ast) == mutations_before:
+            return rounds
+
+
+def bench_worklist(function_count: int = 300, depth: int = 100) -> None:
+    # Each `.data` only becomes removable once the one inside it is gone, so the chain takes one
+    # round per level to converge
+    cascade = f"void __cdecl Cascade(Object *this)\n{{\n  this->{'data.' * depth}vtbl->Run(this);\n}}\n"
+    tokens = TokenBuffer(generate_corpus(function_count) + cascade)
+    rounds_result = _uncommented_program(tokens)
+    rounds = _rounds_fixed_point(rounds_result)
+    worklist_result = _uncommented_program(tokens)
+    engine = WorklistEngine(RULES)
+    engine.run(worklist_result)
+    generations = engine.generations
+    print(f"worklist: {function_count} functions and a {depth}-level cascade")
+    print(f"  full rounds         {_timed(lambda: _rounds_fixed_point(_uncommented_program(tokens)), repeat=1):8.3f}s {rounds:>5} rounds")
+    print(f"  worklist            {_timed(lambda: apply_refactorings(_uncommented_program(tokens)), repeat=1):8.3f}s {generations:>5} generations")
+
+
+def bench_incremental(function_count: int = 2000, edit_count: int = 20) -> None:
+    code = generate_corpus(function_count)
+    program = Parser(code=code).parse()
+    rng = random.Random(0)
+    functions = [statement for statement in program.statements if isinstance(statement, FunctionDeclaration)]
+    print(f"incremental: {function_count} functions, {len(code)} chars")
+    print(f"  full parse          {_timed(lambda: Parser(code=code).parse(), repeat=1) * 1000:8.1f}ms")
+    # A statement added at the top of a body only needs that body parsed again, a declaration
+    # added between functions only the function after it
+    edits = [('statement in a body', lambda function: (function.body._begin_pos, ' v0 = 1;')),
+             ('top-level declaration', lambda function: (code.rfind('\n\n', 0, function._begin_pos) + 2, 'int g_counter;\n'))]
+    for label, make_edit in edits:
+        elapsed = 0.0
+        for _ in range(edit_count):
+            position, text = make_edit(rng.choice(functions))
+            start = time.perf_counter()
+            code = reparse(program, code, position, position, text)
+            elapsed += time.perf_counter() - start
+            functions = [statement for statement in program.statements if isinstance(statement, FunctionDeclaration)]
+        print(f"  reparse, {label:<22} {elapsed / edit_count * 1000:8.1f}ms per edit")
+
+
+def bench_parse_cache(function_count: int = 500) -> None:
+    code = generate_corpus(function_count)
+    # The next snapshot: a tenth of the functions changed, the rest unchanged but moved
+    next_code = '\n}\n\n'.join(function.replace('return', 'return 1 +') if index % 10 == 0 else function
+                                for index, function in enumerate(code.split('\n}\n\n')))
+    print(f"parse cache: {function_count} functions, {len(code)} chars")
+    print(f"  parse               {_timed(lambda: Parser(tokens=TokenBuffer(code)).parse(), repeat=1):8.3f}s")
+    with tempfile.TemporaryDirectory() as directory:
+        cache = ParseCache(directory)
+        print(f"  cold cache          {_timed(lambda: cache.parse(code), repeat=1):8.3f}s")
+        print(f"  warm cache          {_timed(lambda: cache.parse(code), repeat=1):8.3f}s")
+        cache.stats = CacheStats()
+        print(f"  next snapshot       {_timed(lambda: cache.parse(next_code), repeat=1):8.3f}s {cache.stats}")
+        print(f"  cache size          {cache.size / 1024 / 1024:8.1f}MiB in {len(cache)} entries")
+
+
+def bench_binary(function_count: int = 500) -> None:
+    code = generate_corpus(function_count)
+    program = Parser(code=code).parse()
+    data = binary_ast.dumps(program)
+    encoded = pickle.dumps(encode(program), protocol=pickle.HIGHEST_PROTOCOL)
+    # Pickling the nodes themselves follows every parent link, which recurses deeply
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 100000))
+    graph = pickle.dumps(program, protocol=pickle.HIGHEST_PROTOCOL)
+    print(f"binary: {function_count} functions, {len(code)} chars")
+    print(f"  {'':<20} {'write':>8} {'read':>8} {'size':>10}")
+    print(f"  {'re-parse':<20} {'':>8} {_timed(lambda: Parser(code=code).parse(), repeat=1):7.3f}s {len(code):>10,}")
+    print(f"  {'pickle, nodes':<20} {_timed(lambda: pickle.dumps(program, protocol=pickle.HIGHEST_PROTOCOL)):7.3f}s "
+          f"{_timed(lambda: pickle.loads(graph)):7.3f}s {len(graph):>10,}")
+    print(f"  {'pickle, encoded':<20} {_timed(lambda: pickle.dumps(encode(program), protocol=pickle.HIGHEST_PROTOCOL)):7.3f}s "
+          f"{_timed(lambda: decode(pickle.loads(encoded))):7.3f}s {len(encoded):>10,}")
+    print(f"  {'binary':<20} {_timed(lambda: binary_ast.dumps(program)):7.3f}s "
+          f"{_timed(lambda: binary_ast.loads(data)):7.3f}s {len(data):>10,}")
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'program.ast')
+        with open(path, 'wb') as file:
+            file.write(data)
+        name = program.statements[len(program.statements) // 2].name
+        def load_one():
+            with binary_ast.open_file(path) as ast_file:
+                return ast_file.statement_named(name)
+        print(f"  {'binary, one function':<20} {'':>8} {_timed(load_one) * 1000:6.2f}ms")
+
+
+def _reindented_str(node: ASTNode) -> str:
+    # str() as it was, with every block indenting the whole text of the blocks inside it again
+    if isinstance(node, Program):
+        return '\n\n'.join(_reindented_str(statement) for statement in node.statements)
+    if isinstance(node, FunctionDeclaration) and node.body is not None:
+        return code_string(node).split('\n', 1)[0] + '\n' + _reindented_str(node.body)
+    if isinstance(node, CompoundStatement):
+        lines = ('    ' + _reindented_str(statement).replace('\n', '\n    ') for statement in node.statements)
+        return '{\n' + '\n'.join(lines) + '\n}'
+    if isinstance(node, IfStatement) and node.else_branch is None:
+        branch = _reindented_str(node.then_branch)
+        if not isinstance(node.then_branch, CompoundStatement):
+            branch = '\n'.join('    ' + line for line in branch.split('\n'))
+        return f"if ({node.condition})\n{branch}"
+    return str(node)
+
+
+def bench_printer(function_count: int = 2000, depth: int = 300) -> None:
+    code = generate_corpus(function_count)
+    nested = f"void __cdecl Nested(int a)\n{{\n{'if (a) { ' * depth}a = 1;{' }' * depth}\n}}\n"
+    # Parsing and printing the nested blocks both recurse once per level
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 100000))
+    for label, program in (('corpus', _uncommented_program(TokenBuffer(code))),
+                           (f'{depth} nested blocks', _uncommented_program(TokenBuffer(nested))),
+                           ('3000-term && chain', _uncommented_program(TokenBuffer(_chain_code())))):
+        print(f"printer: {label}, {len(str(program))} chars")
+        print(f"  re-indenting str()  {_timed(lambda: _reindented_str(program), repeat=1):8.3f}s"
+              f" {_peak_memory(lambda: _reindented_str(program)) / 2 ** 20:8.1f} MiB peak")
+        print(f"  str()               {_timed(lambda: str(program), repeat=1):8.3f}s"
+              f" {_peak_memory(lambda: str(program)) / 2 ** 20:8.1f} MiB peak")
+        with tempfile.TemporaryFile('w') as file:
+            print(f"  write_to(file)      {_timed(lambda: program.write_to(file), repeat=1):8.3f}s"
+                  f" {_peak_memory(lambda: program.write_to(file)) / 2 ** 20:8.1f} MiB peak")
+
+
+def bench_comments(function_count: int = 2000, comment_count: int = 2000) -> None:
+    code = generate_corpus(function_count)
+    program = Parser(tokens=TokenBuffer(code)).parse()
+    uncommented = _uncommented_program(TokenBuffer(code))
+    # Block comments between the words of one long line
+    crowded_code = f"void __cdecl Crowded(int a)\n{{\n  sub_401000({', '.join(f'/* {index} */ a' for index in range(comment_count))});\n}}\n"
+    # The arguments parse into a chain of comma operations, which str() recurses through
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 100000))
+    crowded = Parser(code=crowded_code).parse()
+    print(f"comments: {function_count} functions, {len(program.comments)} comments")
+    print(f"  str(), no comments  {_timed(lambda: str(uncommented), repeat=1):8.3f}s")
+    print(f"  attach_comments()   {_timed(lambda: attach_comments(program, program.comments), repeat=1):8.3f}s")
+    print(f"  str()               {_timed(lambda: str(program), repeat=1):8.3f}s")
+    print(f"  {f'{comment_count} on one line':<20}{_timed(lambda: str(crowded), repeat=1):8.3f}s")
+
+
+def bench_render_cache(function_count: int = 2000, edit_count: int = 20) -> None:
+    code = generate_corpus(function_count)
+    program = _uncommented_program(TokenBuffer(code))
+    rng = random.Random(0)
+    identifiers = program.nodes_of_class(Identifier)
+    print(f"render cache: {function_count} functions, {len(code)} chars")
+    print(f"  str()               {_timed(lambda: str(program), repeat=1) * 1000:8.1f}ms")
+    with caching_renders(program):
+        print(f"  first cached str()  {_timed(lambda: str(program), repeat=1) * 1000:8.1f}ms")
+        elapsed = 0.0
+        for _ in range(edit_count):
+            identifier = cast(Identifier, rng.choice(identifiers))
+            identifier.assign('name', identifier.name + '_')
+            start = time.perf_counter()
+            str(program)
+            elapsed += time.perf_counter() - start
+        print(f"  str() after an edit {elapsed / edit_count * 1000:8.1f}ms")
+    tokens = TokenBuffer(generate_corpus(function_count // 10))
+    programs = [_uncommented_program(tokens) for _ in range(2)]
+    print(f"  str() fixed point   {_timed(lambda: _str_fixed_point(programs[0]), repeat=1):8.3f}s")
+    def cached_fixed_point():
+        with caching_renders(programs[1]):
+            _str_fixed_point(programs[1])
+    print(f"  cached fixed point  {_timed(cached_fixed_point, repeat=1):8.3f}s")
+
+
+def bench_structural_hash(function_count: int = 1000, pair_count: int = 200000) -> None:
+    code = generate_corpus(function_count)
+    print(f"structural hash: {function_count} functions")
+    for hash_consing in (False, True):
+        tracemalloc.start()
+        try:
+            parser = Parser(code=code, hash_consing=hash_consing)
+            program = parser.parse()
+            label = f"{len(parser.leaves)} distinct leaves" if parser.leaves is not None else "no hash-consing"
+            # Without the parser's memo and leaf table
+            del parser
+            retained = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+        node_count = _count_nodes(program)
+        print(f"  retained            {retained / node_count:8.1f} bytes/node, {label}")
+    print(f"  parse               {_timed(lambda: Parser(code=code).parse(), repeat=1):8.3f}s")
+    print(f"  parse, hash-consing {_timed(lambda: Parser(code=code, hash_consing=True).parse(), repeat=1):8.3f}s")
+    print(f"  structural_hash()   {_timed(program.structural_hash, repeat=1):8.3f}s")
+    rng = random.Random(0)
+    operands = program.nodes_of_class(Operand)
+    pairs = [(rng.choice(operands), rng.choice(operands)) for _ in range(pair_count)]
+    # The same text for an expression's own class, the way subtrees were compared so far
+    repeated = [(first, second) for first, second in pairs if first.__class__ is second.__class__ and str(first) == str(second)]
+    print(f"  {pair_count} pairs, {len(repeated)} equal")
+    print(f"  str() ==            {_timed(lambda: [str(first) == str(second) for first, second in pairs]):8.3f}s")
+    print(f"  equals()            {_timed(lambda: [first.equals(second) for first, second in pairs]):8.3f}s")
+
+
+def _clone(function_code: str, number: int, rng: random.Random) -> str:
+    # The function with other names, other constants and one more statement
+    lines = function_code.split('\n')
+    lines[0] = re.sub(r'Method_\d+', f'Clone_{number}', lines[0])
+    lines.insert(-2, f"  v0 = {rng.randint(0, 255)};")
+    text = '\n'.join(lines)
+    text = re.sub(r'\bv(\d)\b', r'var\1', text)
+    return re.sub(r'\b\d+\b(?!h\])', lambda match: str(rng.randint(0, 255)), text)
+
+
+def bench_clone_index(function_count: int = 5000, clone_count: int = 200, k: int = 10) -> None:
+    from clone_index import CloneIndex
+    import numpy as np
+
+    code = generate_corpus(function_count)
+    rng = random.Random(0)
+    originals = rng.sample(range(function_count), clone_count)
+    # Functions start at the start of a line, their statements are indented
+    sources = re.split(r'\n\n(?=\S)', code)
+    clone_code = '\n\n'.join(_clone(sources[original], number, rng) for number, original in enumerate(originals))
+    functions = cast(List[FunctionDeclaration], Parser(tokens=TokenBuffer(code)).parse().statements)
+    clones = cast(List[FunctionDeclaration], Parser(tokens=TokenBuffer(clone_code)).parse().statements)
+    index = CloneIndex()
+    print(f"clone index: {function_count} functions, {clone_count} clones, top {k}")
+    print(f"  add()               {_timed(lambda: [index.add(function) for function in functions], repeat=1):8.3f}s")
+    clone_keys = [index.add(clone) for clone in clones]
+    found = sum(functions[original].name in [key for key, _ in index.similar(clone_key, k)]
+                for original, clone_key in zip(originals, clone_keys))
+    print(f"  found originals     {found:8}/{clone_count}")
+    for size in (len(index) // 10, len(index)):
+        part = CloneIndex()
+        members = functions[:size - clone_count] + clones
+        for function in members:
+            part.add(function)
+        print(f"  {size} functions, similar() {_timed(lambda: [part.similar(key, k) for key in clone_keys]) / clone_count * 1000:6.3f}ms")
+        signatures = np.array([part.signature(function) for function in members])
+        def scan():
+            # Every signature compared with each clone's
+            for signature in signatures[-clone_count:]:
+                similarities = (signatures == signature).mean(axis=1)
+                np.argpartition(-similarities, k)[:k]
+        print(f"  {size} functions, full scan {_timed(scan) / clone_count * 1000:6.3f}ms")
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'clones.idx')
+        print(f"  save()              {_timed(lambda: index.save(path)):8.3f}s, {os.path.getsize(path) / 2 ** 20:.1f} MiB")
+        print(f"  load()              {_timed(lambda: CloneIndex.load(path)):8.3f}s")
+
+
+BENCHMARKS = {
+    'lexer': bench_lexer,
+    'token_buffer': bench_token_buffer,
+    'memo': bench_memo,
+    'classifier': bench_classifier,
+    'expressions': bench_expressions,
+    'streaming': bench_streaming,
+    'batch': bench_batch,
+    'memory': bench_memory,
+    'flat': bench_flat,
+    'traversal': bench_traversal,
+    'index': bench_index,
+    'refactor': bench_refactor,
+    'worklist': bench_worklist,
+    'incremental': bench_incremental,
+    'parse_cache': bench_parse_cache,
+    'binary': bench_binary,
+    'printer': bench_printer,
+    'comments': bench_comments,
+    'render_cache': bench_render_cache,
+    'structural_hash': bench_structural_hash,
+    'clone_index': bench_clone_index,
+    'scaling': bench_scaling,
+}
+# Benchmarks of the modules that need numpy, from requirements.txt
+NUMPY_BENCHMARKS = {'flat', 'clone_index'}
+
+if __name__ == '__main__':
+    has_numpy = importlib.util.find_spec('numpy') is not None
+    for name in sys.argv[1:] or BENCHMARKS:
+        if name in NUMPY_BENCHMARKS and not has_numpy:
+            print(f"{name}: skipped, numpy is not installed")
+            continue
+        BENCHMARKS[name]()
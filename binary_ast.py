@@ -0,0 +1,391 @@
+import mmap
+import os
+from typing import Any, Dict, List, Optional, Tuple, Type, Union
+
+from ast_nodes import ASTNode, FunctionDeclaration, Program, Statement, VariableDeclaration
+from lexer import Token, TokenType
+from serialization import NODE_CLASSES, constructor_fields
+
+# A compact binary form of a Program, its comments included. Everything is a varint: strings are
+# stored once in a table and referred to by index, and positions as the zigzag encoded difference
+# to the previous position, which is nearly always a byte or two.
+#
+#   magic, format version
+#   strings: count, then the UTF-8 length and bytes of each
+#   node kinds: count, then the class name and constructor field names of each
+#   program begin and end positions
+#   comments section size, statement count, then the size and name of each statement
+#   comments section, then each top-level statement
+#
+# Node records are written in pre-order: kind + FIRST_KIND, then the constructor fields. A value is
+# a tag, or a node record. The statement table lets ASTFile decode a single statement without
+# reading the ones before it, and the kind table lets a reader check that the classes still match.
+MAGIC = b'HRAST'
+FORMAT_VERSION = 1
+
+_NONE = 0
+_FALSE = 1
+_TRUE = 2
+_INT = 3
+_STRING = 4
+_LIST = 5
+FIRST_KIND = 6
+
+_POSITION_FIELDS = ('_begin_pos', '_end_pos')
+# Marks a position on _Writer.value's stack, positions are written without a tag
+_POSITION = object()
+# The statement table holds the name of these, so statements can be found without decoding them
+_NAMED_STATEMENTS = (FunctionDeclaration, VariableDeclaration)
+
+Buffer = Union[bytes, bytearray, mmap.mmap]
+
+
+def _write_varint(out: bytearray, value: int):
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _zigzag(value: int) -> int:
+    return value << 1 if value >= 0 else (-value << 1) - 1
+
+
+def _unzigzag(value: int) -> int:
+    return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+
+def _read_varint(data: Buffer, offset: int) -> Tuple[int, int]:
+    byte = data[offset]
+    offset += 1
+    if byte < 0x80:
+        return byte, offset
+    result = byte & 0x7f
+    shift = 7
+    while True:
+        byte = data[offset]
+        offset += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, offset
+        shift += 7
+
+
+class _Writer:
+    def __init__(self):
+        self.strings: Dict[str, int] = {}
+        self.kinds: Dict[Type[ASTNode], int] = {}
+        self.position: int = 0
+
+    def string(self, string: str) -> int:
+        string_id = self.strings.get(string)
+        if string_id is None:
+            string_id = self.strings[string] = len(self.strings)
+        return string_id
+
+    def kind(self, cls: Type[ASTNode]) -> int:
+        kind = self.kinds.get(cls)
+        if kind is None:
+            kind = self.kinds[cls] = len(self.kinds)
+        return kind
+
+    def value(self, out: bytearray, value: Any):
+        # Pre-order without recursion, expressions can nest deeper than the stack. What is left to
+        # write is kept on a stack in reverse, with _POSITION on top of each position.
+        stack = [value]
+        while stack:
+            value = stack.pop()
+            if value is _POSITION:
+                position = stack.pop()
+                _write_varint(out, _zigzag(position - self.position))
+                self.position = position
+            elif isinstance(value, ASTNode):
+                cls = value.__class__
+                _write_varint(out, FIRST_KIND + self.kind(cls))
+                for field in reversed(constructor_fields(cls)):
+                    stack.append(getattr(value, field))
+                    if field in _POSITION_FIELDS:
+                        stack.append(_POSITION)
+            elif value is None:
+                out.append(_NONE)
+            elif value is True:
+                out.append(_TRUE)
+            elif value is False:
+                out.append(_FALSE)
+            elif isinstance(value, str):
+                out.append(_STRING)
+                _write_varint(out, self.string(value))
+            elif isinstance(value, int):
+                out.append(_INT)
+                _write_varint(out, _zigzag(value))
+            elif isinstance(value, list):
+                out.append(_LIST)
+                _write_varint(out, len(value))
+                stack.extend(reversed(value))
+            else:
+                raise ValueError(f"Can't store a {type(value).__name__} value")
+
+    def statement(self, statement: ASTNode) -> bytearray:
+        # Positions restart from 0 so that a statement can be decoded on its own
+        out = bytearray()
+        self.position = 0
+        self.value(out, statement)
+        return out
+
+    def comments(self, comments: List[Token]) -> bytearray:
+        out = bytearray()
+        _write_varint(out, len(comments))
+        position = 0
+        for comment in comments:
+            _write_varint(out, comment.type.value)
+            _write_varint(out, self.string(comment.value))
+            _write_varint(out, comment.line)
+            _write_varint(out, _zigzag(comment.column))
+            _write_varint(out, _zigzag(comment.position - position))
+            position = comment.position
+        return out
+
+
+def dumps(program: Program) -> bytes:
+    writer = _Writer()
+    statements = [writer.statement(statement) for statement in program.statements]
+    names = [writer.string(statement.name) + 1 if isinstance(statement, _NAMED_STATEMENTS) else 0
+             for statement in program.statements]
+    comments = writer.comments(program.comments)
+
+    out = bytearray(MAGIC)
+    _write_varint(out, FORMAT_VERSION)
+    _write_varint(out, len(writer.strings))
+    for string in writer.strings:
+        encoded = string.encode('utf-8', 'surrogatepass')
+        _write_varint(out, len(encoded))
+        out += encoded
+    # Field names are interned after the string table is written, so they get their own
+    kind_names: Dict[str, int] = {}
+    kind_table = bytearray()
+    for cls in writer.kinds:
+        for name in (cls.__name__,) + constructor_fields(cls):
+            kind_names.setdefault(name, len(kind_names))
+        _write_varint(kind_table, kind_names[cls.__name__])
+        _write_varint(kind_table, len(constructor_fields(cls)))
+        for field in constructor_fields(cls):
+            _write_varint(kind_table, kind_names[field])
+    _write_varint(out, len(kind_names))
+    for name in kind_names:
+        encoded = name.encode('ascii')
+        _write_varint(out, len(encoded))
+        out += encoded
+    _write_varint(out, len(writer.kinds))
+    out += kind_table
+    _write_varint(out, program._begin_pos)
+    _write_varint(out, program._end_pos)
+    _write_varint(out, len(comments))
+    _write_varint(out, len(statements))
+    for statement, name in zip(statements, names):
+        _write_varint(out, len(statement))
+        _write_varint(out, name)
+    out += comments
+    for statement in statements:
+        out += statement
+    return bytes(out)
+
+
+def dump(program: Program, file):
+    file.write(dumps(program))
+
+
+def loads(data: Buffer) -> Program:
+    return ASTFile(data).program()
+
+
+def load(file) -> Program:
+    return loads(file.read())
+
+
+def open_file(path: str) -> 'ASTFile':
+    # Memory-maps the file, only the pages of what is decoded are read
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            # Which mmap can't map
+            raise ValueError("Not a binary AST file")
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    return ASTFile(data)
+
+
+class _KindLayout:
+    def __init__(self, cls: Type[ASTNode], fields: Tuple[str, ...]):
+        self.cls = cls
+        # True for the position fields, which are stored without a tag
+        self.positions: Tuple[bool, ...] = tuple(field in _POSITION_FIELDS for field in fields)
+
+
+# A file written by dump(), read from any buffer. Only the header is decoded up front, statements
+# and comments are decoded when asked for, every time they are asked for, so each caller gets
+# nodes of its own.
+class ASTFile:
+    def __init__(self, data: Buffer):
+        self._data: Buffer = data
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError("Not a binary AST file")
+        version, offset = _read_varint(data, len(MAGIC))
+        if version != FORMAT_VERSION:
+            raise ValueError(f"Unsupported binary AST format version {version}, expected {FORMAT_VERSION}")
+        self._strings, offset = self._read_strings(offset)
+        kind_names, offset = self._read_strings(offset)
+        self._layouts: List[_KindLayout] = []
+        kind_count, offset = _read_varint(data, offset)
+        for _ in range(kind_count):
+            name_id, offset = _read_varint(data, offset)
+            field_count, offset = _read_varint(data, offset)
+            fields = []
+            for _ in range(field_count):
+                field_id, offset = _read_varint(data, offset)
+                fields.append(kind_names[field_id])
+            cls = NODE_CLASSES.get(kind_names[name_id])
+            if cls is None or constructor_fields(cls) != tuple(fields):
+                raise ValueError(f"Node class {kind_names[name_id]} does not match the one the file was written with")
+            self._layouts.append(_KindLayout(cls, tuple(fields)))
+        self.begin_pos, offset = _read_varint(data, offset)
+        self.end_pos, offset = _read_varint(data, offset)
+        comments_size, offset = _read_varint(data, offset)
+        statement_count, offset = _read_varint(data, offset)
+        sizes = []
+        self.names: List[Optional[str]] = []
+        for _ in range(statement_count):
+            size, offset = _read_varint(data, offset)
+            name_id, offset = _read_varint(data, offset)
+            sizes.append(size)
+            self.names.append(self._strings[name_id - 1] if name_id else None)
+        self._comments_offset: int = offset
+        offset += comments_size
+        # Start of each statement, and the end of the last one
+        self._offsets: List[int] = [offset]
+        for size in sizes:
+            offset += size
+            self._offsets.append(offset)
+        self._indexes: Dict[str, int] = {}
+        for index, name in enumerate(self.names):
+            if name is not None:
+                self._indexes.setdefault(name, index)
+
+    def _read_strings(self, offset: int) -> Tuple[List[str], int]:
+        data = self._data
+        count, offset = _read_varint(data, offset)
+        strings = []
+        for _ in range(count):
+            length, offset = _read_varint(data, offset)
+            strings.append(bytes(data[offset:offset + length]).decode('utf-8', 'surrogatepass'))
+            offset += length
+        return strings, offset
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def statement(self, index: int) -> Statement:
+        # Copied out of the buffer first, indexing bytes is faster than indexing an mmap
+        blob = bytes(self._data[self._offsets[index]:self._offsets[index + 1]])
+        node, _, _ = self._read_value(blob, 0, 0)
+        return node
+
+    def statement_named(self, name: str) -> Optional[Statement]:
+        # The first function or variable declared with name
+        index = self._indexes.get(name)
+        return None if index is None else self.statement(index)
+
+    def comments(self) -> List[Token]:
+        data = self._data
+        count, offset = _read_varint(data, self._comments_offset)
+        comments = []
+        position = 0
+        for _ in range(count):
+            token_type, offset = _read_varint(data, offset)
+            value, offset = _read_varint(data, offset)
+            line, offset = _read_varint(data, offset)
+            column, offset = _read_varint(data, offset)
+            delta, offset = _read_varint(data, offset)
+            position += _unzigzag(delta)
+            comments.append(Token(TokenType(token_type), self._strings[value], line, _unzigzag(column), position))
+        return comments
+
+    def program(self) -> Program:
+        statements = [self.statement(index) for index in range(len(self))]
+        program = Program(statements, self.comments(), self.begin_pos, self.end_pos)
+        for statement in statements:
+            statement.parent = program
+        return program
+
+    def _read_value(self, blob: bytes, offset: int, position: int) -> Tuple[Any, int, int]:
+        # Returns the value at offset, the offset after it and the last position read. Without
+        # recursion, expressions can nest deeper than the stack: each node or list being read is a
+        # frame of its layout, None for a list, the values read so far and how many it has.
+        frames: List[Tuple[Optional[_KindLayout], List[Any], int]] = []
+        while True:
+            tag = blob[offset]
+            offset += 1
+            if tag >= FIRST_KIND:
+                if tag >= 0x80:
+                    tag, offset = _read_varint(blob, offset - 1)
+                layout = self._layouts[tag - FIRST_KIND]
+                frames.append((layout, [], len(layout.positions)))
+            elif tag == _LIST:
+                count, offset = _read_varint(blob, offset)
+                frames.append((None, [], count))
+            else:
+                if tag == _STRING:
+                    string_id, offset = _read_varint(blob, offset)
+                    value: Any = self._strings[string_id]
+                elif tag == _NONE:
+                    value = None
+                elif tag == _INT:
+                    value, offset = _read_varint(blob, offset)
+                    value = _unzigzag(value)
+                else:
+                    value = tag == _TRUE
+                if not frames:
+                    return value, offset, position
+                frames[-1][1].append(value)
+            # Finish what can be finished without reading another tagged value
+            while frames:
+                layout, values, count = frames[-1]
+                if layout is not None:
+                    positions = layout.positions
+                    while len(values) < count:
+                        if positions[len(values)]:
+                            byte = blob[offset]
+                            if byte < 0x80:
+                                offset += 1
+                            else:
+                                byte, offset = _read_varint(blob, offset)
+                            position += byte >> 1 if not byte & 1 else -((byte + 1) >> 1)
+                            values.append(position)
+                        elif blob[offset] == _STRING and blob[offset + 1] < 0x80:
+                            # Inlined _STRING and _NONE, the most common fields by far
+                            values.append(self._strings[blob[offset + 1]])
+                            offset += 2
+                        elif blob[offset] == _NONE:
+                            values.append(None)
+                            offset += 1
+                        else:
+                            break
+                if len(values) < count:
+                    break
+                frames.pop()
+                if layout is None:
+                    value = values
+                else:
+                    value = layout.cls(*values)
+                    for child in value.children():
+                        child.parent = value
+                if not frames:
+                    return value, offset, position
+                frames[-1][1].append(value)
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+
+    def __enter__(self) -> 'ASTFile':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,219 @@
+import os
+import pickle
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+
+from ast_nodes import ASTNode, FunctionDeclaration, Program, Type, stable_hash
+
+INDEX_VERSION = 1
+DEFAULT_PERMUTATIONS = 128
+DEFAULT_BANDS = 32
+
+# Contents left out of the fingerprints, so that functions differing only in their names,
+# constants and labels look the same. Type names are kept.
+_NORMALIZED_FIELDS = {'name', 'value', 'label'}
+# Modulus of the MinHash permutations, a Mersenne prime. Shingles and coefficients are below
+# 2 ** 32, so a * x + b fits in 64 bits.
+_PRIME = (1 << 61) - 1
+_SHINGLE_MASK = (1 << 32) - 1
+
+
+def fingerprint(function: FunctionDeclaration) -> List[int]:
+    # The shingles of a function: the multiset of the normalized hashes of its subtrees, leaves
+    # aside, as a set with the n-th repeat of a hash standing for itself
+    hashes: Dict[int, int] = {}
+    counts: Dict[int, int] = {}
+    shingles: List[int] = []
+    stack: List[ASTNode] = [function]
+    # Children before parents, without recursion, expressions can nest deeper than the stack
+    while stack:
+        node = stack[-1]
+        pending = False
+        for child in _children(node):
+            if id(child) not in hashes:
+                stack.append(child)
+                pending = True
+        if pending:
+            continue
+        stack.pop()
+        if id(node) in hashes:
+            continue
+        children = [hashes[id(child)] for child in _children(node)]
+        node_hash = hash((_class_hash(node), _content_hash(node), tuple(children)))
+        hashes[id(node)] = node_hash
+        if children:
+            count = counts.get(node_hash, 0)
+            counts[node_hash] = count + 1
+            shingles.append(hash((node_hash, count)) & _SHINGLE_MASK)
+    return shingles
+
+
+def _children(node: ASTNode) -> Iterable[ASTNode]:
+    for field in node._child_fields:
+        value = getattr(node, field)
+        if value.__class__ is list:
+            yield from value
+        elif value is not None:
+            yield value
+
+
+def _class_hash(node: ASTNode) -> int:
+    return stable_hash(node.__class__.__name__)
+
+
+def _content_hash(node: ASTNode) -> int:
+    parts = []
+    for field in node._value_fields:
+        if field in _NORMALIZED_FIELDS and not isinstance(node, Type):
+            continue
+        value = getattr(node, field)
+        if isinstance(value, str):
+            parts.append(stable_hash(value))
+        elif isinstance(value, list):
+            parts.append(hash(tuple(stable_hash(item) for item in value)))
+        else:
+            # None, bools and ints hash the same in every run, None only from Python 3.12
+            parts.append(-1 if value is None else hash(value))
+    return hash(tuple(parts))
+
+
+# Finds near-duplicate functions, such as thunks and inlined templates, among many. Each function
+# gets a MinHash signature of its fingerprint(), whose matching entries estimate the Jaccard
+# similarity of two fingerprints. Signatures are cut into bands, and only functions sharing all
+# of a band with the one asked about are compared with it, so a query looks at a few buckets
+# instead of the whole index. With the defaults, pairs from about 0.4 similar up are found.
+class CloneIndex:
+    def __init__(self, permutations: int = DEFAULT_PERMUTATIONS, bands: int = DEFAULT_BANDS, seed: int = 0):
+        if permutations % bands:
+            raise ValueError(f"{bands} bands do not divide {permutations} permutations")
+        self.permutations: int = permutations
+        self.bands: int = bands
+        self.seed: int = seed
+        rng = np.random.default_rng(seed)
+        self._a: np.ndarray = rng.integers(1, 1 << 32, size=(permutations, 1), dtype=np.uint64)
+        self._b: np.ndarray = rng.integers(0, 1 << 32, size=(permutations, 1), dtype=np.uint64)
+        self.keys: List[str] = []
+        self._ids: Dict[str, int] = {}
+        # One signature row per key, grown by doubling
+        self._signatures: np.ndarray = np.empty((0, permutations), dtype=np.uint32)
+        # Per band: the bytes of the band of a signature -> ids of the keys with that band
+        self._buckets: List[Dict[bytes, List[int]]] = [{} for _ in range(bands)]
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._ids
+
+    def signature(self, function: FunctionDeclaration) -> np.ndarray:
+        shingles = np.array(fingerprint(function), dtype=np.uint64)
+        return ((self._a * shingles + self._b) % _PRIME).min(axis=1).astype(np.uint32)
+
+    def add(self, function: FunctionDeclaration, key: Optional[str] = None) -> str:
+        # Indexes function under key, its name by default, in place of anything under the same key
+        key = function.name if key is None else key
+        self._insert(key, self.signature(function))
+        return key
+
+    def add_program(self, program: Program, source: Optional[str] = None) -> List[str]:
+        # Indexes the functions with a body, as source:name when a source is given
+        keys = []
+        for statement in program.statements:
+            if isinstance(statement, FunctionDeclaration) and statement.body is not None:
+                keys.append(self.add(statement, statement.name if source is None else f"{source}:{statement.name}"))
+        return keys
+
+    def remove(self, key: str):
+        key_id = self._ids.pop(key)
+        self._unbucket(key_id)
+        # The last key takes the freed id, so ids stay dense
+        last_id = len(self.keys) - 1
+        if key_id != last_id:
+            last_key = self.keys[last_id]
+            self._unbucket(last_id)
+            self.keys[key_id] = last_key
+            self._ids[last_key] = key_id
+            self._signatures[key_id] = self._signatures[last_id]
+            self._bucket(key_id)
+        self.keys.pop()
+
+    def similar(self, query: Union[str, FunctionDeclaration], k: int = 10) -> List[Tuple[str, float]]:
+        # The k indexed functions most similar to query, a key or a function, with their estimated
+        # similarity, most similar first. Only functions sharing a band with query are looked at.
+        if isinstance(query, str):
+            own_id: Optional[int] = self._ids[query]
+            signature = self._signatures[own_id]
+        else:
+            own_id = None
+            signature = self.signature(query)
+        candidates = set()
+        for band, buckets in zip(self._bands(signature), self._buckets):
+            candidates.update(buckets.get(band, ()))
+        candidates.discard(own_id)
+        if not candidates:
+            return []
+        ids = np.fromiter(candidates, dtype=np.intp, count=len(candidates))
+        similarities = (self._signatures[ids] == signature).mean(axis=1)
+        # Highest similarity first, then the key added first
+        order = np.lexsort((ids, -similarities))[:k]
+        return [(self.keys[ids[row]], float(similarities[row])) for row in order]
+
+    def save(self, path: str):
+        # Buckets are rebuilt from the signatures on load
+        state = {
+            'version': INDEX_VERSION,
+            'permutations': self.permutations,
+            'bands': self.bands,
+            'seed': self.seed,
+            'keys': self.keys,
+            'signatures': self._signatures[:len(self.keys)],
+        }
+        # Written aside and renamed, so a crash never leaves half an index
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, 'wb') as file:
+            pickle.dump(state, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'CloneIndex':
+        with open(path, 'rb') as file:
+            state = pickle.load(file)
+        if state.get('version') != INDEX_VERSION:
+            raise ValueError(f"Unsupported clone index version {state.get('version')}, expected {INDEX_VERSION}")
+        index = cls(state['permutations'], state['bands'], state['seed'])
+        index.keys = list(state['keys'])
+        index._ids = {key: key_id for key_id, key in enumerate(index.keys)}
+        index._signatures = np.array(state['signatures'], dtype=np.uint32)
+        for key_id in range(len(index.keys)):
+            index._bucket(key_id)
+        return index
+
+    def _insert(self, key: str, signature: np.ndarray):
+        key_id = self._ids.get(key)
+        if key_id is None:
+            key_id = len(self.keys)
+            self.keys.append(key)
+            self._ids[key] = key_id
+            if key_id == len(self._signatures):
+                grown = np.empty((max(16, 2 * key_id), self.permutations), dtype=np.uint32)
+                grown[:key_id] = self._signatures
+                self._signatures = grown
+        else:
+            self._unbucket(key_id)
+        self._signatures[key_id] = signature
+        self._bucket(key_id)
+
+    def _bands(self, signature: np.ndarray) -> List[bytes]:
+        return [band.tobytes() for band in signature.reshape(self.bands, -1)]
+
+    def _bucket(self, key_id: int):
+        for band, buckets in zip(self._bands(self._signatures[key_id]), self._buckets):
+            buckets.setdefault(band, []).append(key_id)
+
+    def _unbucket(self, key_id: int):
+        for band, buckets in zip(self._bands(self._signatures[key_id]), self._buckets):
+            bucket = buckets[band]
+            bucket.remove(key_id)
+            if not bucket:
+                del buckets[band]
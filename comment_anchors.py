@@ -0,0 +1,146 @@
+from bisect import bisect_right
+from functools import lru_cache
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Set, Tuple
+
+from lexer import Token
+
+if TYPE_CHECKING:
+    from ast_nodes import ASTNode
+
+
+# Where comments go when a tree is printed. Every comment is anchored to the statement nearest to
+# it, found by bisecting the statement lists on their positions, so the anchors follow the tree
+# through refactorings and a comment whose statement was removed goes to the one after it.
+#
+# A comment after code on its line stays on the line of that code: the first line of the innermost
+# statement around it when the code is a header, '{' or case label, otherwise the last line of the
+# statement the code belongs to. A comment on a line of its own goes on a line of its own before
+# the next statement, or before the '}' of the block when nothing follows it in the block.
+class CommentAnchors:
+    def __init__(self):
+        # All keyed by id() of the statement
+        self.leading: Dict[int, List[Token]] = {}
+        self.first_line: Dict[int, List[Token]] = {}
+        self.last_line: Dict[int, List[Token]] = {}
+        # On lines of their own at the end of a block, switch or program
+        self.closing: Dict[int, List[Token]] = {}
+        # The statements with a comment anchored to them or to anything in them
+        self.enclosing: Set[int] = set()
+
+
+def attach_comments(root: 'ASTNode', comments: Sequence[Token]) -> CommentAnchors:
+    anchors = CommentAnchors()
+    for comment in comments:
+        start = comment.position - len(comment.value)
+        # The column counts from the start of the comment's last line, which for a comment spanning
+        # lines puts line_start after its start, and no code before it
+        line_start = start - comment.column + 1
+        _attach(anchors, comment, root, start, line_start)
+    return anchors
+
+
+def _attach(anchors: CommentAnchors, comment: Token, root: 'ASTNode', start: int, line_start: int):
+    # Statement lists around the comment, outermost first, with the number of statements in each
+    # that begin before it
+    levels: List[Tuple['ASTNode', List['ASTNode'], int]] = []
+    container = root
+    while True:
+        statements = _statements(container)
+        count = bisect_right(statements, start, key=_begin_pos)
+        levels.append((container, statements, count))
+        anchors.enclosing.add(id(container))
+        if count == 0 or not _contains(statements[count - 1], start):
+            break
+        container = statements[count - 1]
+
+    if _code_before(statements[count - 1] if count else container, start, line_start):
+        if count:
+            _add(anchors, anchors.last_line, statements[count - 1], comment)
+        else:
+            _add(anchors, anchors.first_line, container, comment)
+        return
+    # Past the last statement of a branch, loop body or case, the comment is before whatever
+    # follows the statement it is in
+    for container, statements, count in reversed(levels):
+        if count < len(statements):
+            _add(anchors, anchors.leading, statements[count], comment)
+            return
+        if _kind(container.__class__) in _BLOCKS:
+            break
+    _add(anchors, anchors.closing, container, comment)
+
+
+def _add(anchors: CommentAnchors, placement: Dict[int, List[Token]], node: 'ASTNode', comment: Token):
+    placement.setdefault(id(node), []).append(comment)
+    anchors.enclosing.add(id(node))
+
+
+def _begin_pos(node: 'ASTNode') -> int:
+    return node._begin_pos
+
+
+# Statements directly under each kind of node, as a list or as single statements, and the kinds
+# whose statements end with a '}' or the end of the input
+_STATEMENT_LISTS = {
+    'Program': 'statements',
+    'CompoundStatement': 'statements',
+    'SwitchStatement': 'cases',
+    'CaseStatement': 'statements',
+}
+_STATEMENT_SLOTS = {
+    'IfStatement': ('then_branch', 'else_branch'),
+    'WhileStatement': ('body',),
+    'ForStatement': ('body',),
+    'FunctionDeclaration': ('body',),
+}
+_BLOCKS = {'Program', 'CompoundStatement', 'SwitchStatement'}
+
+
+@lru_cache(maxsize=None)
+def _kind(node_class: type) -> Optional[str]:
+    # Matched by name, ast_nodes imports the printer and with it this module
+    return next((base.__name__ for base in node_class.__mro__
+                 if base.__name__ in _STATEMENT_LISTS or base.__name__ in _STATEMENT_SLOTS), None)
+
+
+def _statements(node: 'ASTNode') -> List['ASTNode']:
+    kind = _kind(node.__class__)
+    if kind in _STATEMENT_LISTS:
+        return getattr(node, _STATEMENT_LISTS[kind])
+    if kind in _STATEMENT_SLOTS:
+        return [child for child in (getattr(node, field) for field in _STATEMENT_SLOTS[kind]) if child is not None]
+    return []
+
+
+def _contains(statement: 'ASTNode', position: int) -> bool:
+    # Whether position, which is after the statement's first token, is before its end. A block only
+    # knows where its '}' is from the statement before it, so an empty block holds nothing.
+    kind = _kind(statement.__class__)
+    if kind in _BLOCKS:
+        statements = _statements(statement)
+        return bool(statements) and position < statements[-1]._end_pos
+    # Anything else runs up to the next statement
+    return kind is not None
+
+
+def _code_before(node: 'ASTNode', position: int, line_start: int) -> bool:
+    # Whether a token of node ends between line_start and position. Positions are token ends, and
+    # only the last child starting before position can hold a later one than node's first token.
+    while node._begin_pos <= line_start:
+        child = None
+        for field in reversed(node._child_fields):
+            value = getattr(node, field)
+            if value.__class__ is list:
+                index = bisect_right(value, position, key=_begin_pos)
+                if index:
+                    child = value[index - 1]
+                    break
+            elif value is not None and value._begin_pos <= position:
+                child = value
+                break
+        if child is None:
+            return False
+        if child._end_pos <= position:
+            return child._end_pos > line_start
+        node = child
+    return True
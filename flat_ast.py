@@ -0,0 +1,226 @@
+from typing import Any, Dict, List, Optional, Tuple, Type
+
+import numpy as np
+
+from ast_nodes import (ASTNode, BinaryOperation, FunctionCall, FunctionDeclaration, GotoStatement, Identifier,
+                       JumpStatement, LabelStatement, Literal, Parameter, Program, UnaryOperation,
+                       VariableDeclaration)
+from ast_nodes import Type as TypeNode
+from lexer import Token
+from serialization import NODE_CLASSES, constructor_fields
+
+NO_NODE = -1
+
+# Node classes by kind code, the kind column indexes this list
+KINDS: List[Type[ASTNode]] = list(NODE_CLASSES.values())
+KIND_CODES: Dict[Type[ASTNode], int] = {cls: code for code, cls in enumerate(KINDS)}
+
+# The string attribute of each class that goes in the value column, so it can be queried
+# with array operations. Subclasses inherit the entry of their base class.
+_VALUE_FIELDS: Dict[Type[ASTNode], str] = {
+    Identifier: 'name',
+    Literal: 'value',
+    BinaryOperation: 'operator',
+    UnaryOperation: 'operator',
+    FunctionDeclaration: 'name',
+    Parameter: 'name',
+    VariableDeclaration: 'name',
+    TypeNode: 'name',
+    GotoStatement: 'label',
+    LabelStatement: 'label',
+    JumpStatement: 'jump_type',
+}
+# Child fields that hold a list, as opposed to a single optional node
+_LIST_FIELDS = {'statements', 'parameters', 'arguments', 'cases'}
+
+
+class _KindLayout:
+    def __init__(self, cls: Type[ASTNode]):
+        self.cls = cls
+        self.child_fields: Tuple[str, ...] = cls._child_fields
+        self.value_field: Optional[str] = next((_VALUE_FIELDS[base] for base in cls.__mro__ if base in _VALUE_FIELDS), None)
+        self.constructor_fields: Tuple[str, ...] = constructor_fields(cls)
+        # Everything else the constructor needs, kept as one interned tuple per node
+        self.attribute_fields: Tuple[str, ...] = tuple(
+            field for field in self.constructor_fields
+            if field not in self.child_fields and field != self.value_field
+            and field not in ('_begin_pos', '_end_pos', 'comments'))
+
+
+_LAYOUTS: List[_KindLayout] = [_KindLayout(cls) for cls in KINDS]
+
+
+# An AST stored column-wise, one row per node in pre-order, with the Program in row 0
+class FlatAST:
+    def __init__(self, kind: np.ndarray, parent: np.ndarray, first_child: np.ndarray, next_sibling: np.ndarray,
+                 field: np.ndarray, value: np.ndarray, attributes: np.ndarray, begin_pos: np.ndarray,
+                 end_pos: np.ndarray, strings: List[str], attribute_table: List[tuple], comments: List[Token]):
+        self.kind = kind
+        self.parent = parent
+        self.first_child = first_child
+        self.next_sibling = next_sibling
+        # Index of the child field in the parent's _child_fields the node is stored in
+        self.field = field
+        # Index into strings, or NO_NODE when the class has no value field
+        self.value = value
+        # Index into attribute_table
+        self.attributes = attributes
+        self.begin_pos = begin_pos
+        self.end_pos = end_pos
+        self.strings = strings
+        self.attribute_table = attribute_table
+        self.comments = comments
+        self._string_ids: Dict[str, int] = {string: index for index, string in enumerate(strings)}
+
+    @classmethod
+    def from_program(cls, program: Program) -> 'FlatAST':
+        kinds: List[int] = []
+        parents: List[int] = []
+        fields: List[int] = []
+        values: List[int] = []
+        attributes: List[int] = []
+        begin_positions: List[int] = []
+        end_positions: List[int] = []
+        strings: List[str] = []
+        string_ids: Dict[str, int] = {}
+        attribute_table: List[tuple] = []
+        attribute_ids: Dict[tuple, int] = {}
+
+        # Children are pushed in reverse so they pop, and get their rows, in children() order
+        stack: List[Tuple[ASTNode, int, int]] = [(program, NO_NODE, 0)]
+        while stack:
+            node, parent, field = stack.pop()
+            row = len(kinds)
+            code = KIND_CODES[type(node)]
+            layout = _LAYOUTS[code]
+            kinds.append(code)
+            parents.append(parent)
+            fields.append(field)
+            begin_positions.append(node._begin_pos)
+            end_positions.append(node._end_pos)
+            if layout.value_field is None:
+                values.append(NO_NODE)
+            else:
+                string = getattr(node, layout.value_field)
+                values.append(string_ids.setdefault(string, len(string_ids)))
+                if values[-1] == len(strings):
+                    strings.append(string)
+            attribute = tuple(_freeze(getattr(node, name)) for name in layout.attribute_fields)
+            attributes.append(attribute_ids.setdefault(attribute, len(attribute_ids)))
+            if attributes[-1] == len(attribute_table):
+                attribute_table.append(attribute)
+            for child_field in range(len(layout.child_fields) - 1, -1, -1):
+                child = getattr(node, layout.child_fields[child_field])
+                if isinstance(child, list):
+                    stack.extend((item, row, child_field) for item in reversed(child))
+                elif child is not None:
+                    stack.append((child, row, child_field))
+
+        parent = np.array(parents, dtype=np.int32)
+        first_child = np.full(len(kinds), NO_NODE, dtype=np.int32)
+        next_sibling = np.full(len(kinds), NO_NODE, dtype=np.int32)
+        # Rows are in pre-order, so walking them backwards links every child list in order
+        for row in range(len(kinds) - 1, 0, -1):
+            row_parent = parents[row]
+            next_sibling[row] = first_child[row_parent]
+            first_child[row_parent] = row
+        return cls(np.array(kinds, dtype=np.int16), parent, first_child, next_sibling,
+                   np.array(fields, dtype=np.int8), np.array(values, dtype=np.int32),
+                   np.array(attributes, dtype=np.int32), np.array(begin_positions, dtype=np.int32),
+                   np.array(end_positions, dtype=np.int32), strings, attribute_table, list(program.comments))
+
+    def to_program(self) -> Program:
+        return self.materialize(0)
+
+    def __len__(self) -> int:
+        return len(self.kind)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(column.nbytes for column in (self.kind, self.parent, self.first_child, self.next_sibling,
+                                                self.field, self.value, self.attributes, self.begin_pos,
+                                                self.end_pos))
+
+    def string_id(self, string: str) -> int:
+        return self._string_ids.get(string, NO_NODE)
+
+    def string(self, row: int) -> Optional[str]:
+        value = self.value[row]
+        return None if value == NO_NODE else self.strings[value]
+
+    def node_class(self, row: int) -> Type[ASTNode]:
+        return KINDS[self.kind[row]]
+
+    def children(self, row: int) -> List[int]:
+        children = []
+        child = self.first_child[row]
+        while child != NO_NODE:
+            children.append(int(child))
+            child = self.next_sibling[child]
+        return children
+
+    def nodes_of_kind(self, cls: Type[ASTNode], subclasses: bool = True) -> np.ndarray:
+        codes = [code for code, kind in enumerate(KINDS) if kind is cls or (subclasses and issubclass(kind, cls))]
+        return np.flatnonzero(np.isin(self.kind, codes))
+
+    def nodes_with_value(self, cls: Type[ASTNode], string: str) -> np.ndarray:
+        string_id = self.string_id(string)
+        if string_id == NO_NODE:
+            return np.empty(0, dtype=np.intp)
+        rows = self.nodes_of_kind(cls)
+        return rows[self.value[rows] == string_id]
+
+    def calls_to(self, name: str) -> np.ndarray:
+        # FunctionCall rows whose callee is the plain identifier name
+        string_id = self.string_id(name)
+        if string_id == NO_NODE:
+            return np.empty(0, dtype=np.intp)
+        calls = np.flatnonzero(self.kind == KIND_CODES[FunctionCall])
+        callees = self.first_child[calls]
+        matches = (self.kind[callees] == KIND_CODES[Identifier]) & (self.value[callees] == string_id)
+        return calls[matches]
+
+    def materialize(self, row: int) -> Any:
+        # Build the subtree bottom-up: in pre-order every descendant has a higher row than its
+        # ancestors, so handling rows in descending order builds children before their parents
+        rows = []
+        stack = [row]
+        while stack:
+            current = stack.pop()
+            rows.append(current)
+            stack.extend(self.children(current))
+        rows.sort(reverse=True)
+        built: Dict[int, ASTNode] = {}
+        for current in rows:
+            layout = _LAYOUTS[self.kind[current]]
+            arguments: Dict[str, Any] = {name: [] for name in layout.child_fields if name in _LIST_FIELDS}
+            children = []
+            for child_row in self.children(current):
+                child = built.pop(child_row)
+                children.append(child)
+                name = layout.child_fields[self.field[child_row]]
+                if name in _LIST_FIELDS:
+                    arguments[name].append(child)
+                else:
+                    arguments[name] = child
+            if layout.value_field is not None:
+                arguments[layout.value_field] = self.strings[self.value[current]]
+            arguments.update(zip(layout.attribute_fields, map(_thaw, self.attribute_table[self.attributes[current]])))
+            arguments['_begin_pos'] = int(self.begin_pos[current])
+            arguments['_end_pos'] = int(self.end_pos[current])
+            if layout.cls is Program:
+                arguments['comments'] = list(self.comments)
+            node = layout.cls(*[arguments.get(name) for name in layout.constructor_fields])
+            for child in children:
+                child.parent = node
+            built[current] = node
+        return built[row]
+
+
+def _freeze(value: Any) -> Any:
+    # Attribute tuples are interned, so list attributes such as Type.specifiers become tuples
+    return tuple(value) if isinstance(value, list) else value
+
+
+def _thaw(value: Any) -> Any:
+    return list(value) if isinstance(value, tuple) else value
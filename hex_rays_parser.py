@@ -1,28 +1,95 @@
-from typing import Optional, List, Tuple
-from lexer import Lexer, Token, TokenType, MSVC_CALLING_CONVENTIONS, C_DECLARATION_SPECIFIERS
+from enum import Enum, auto
+from typing import Callable, Dict, Iterator, Optional, List, Tuple, TypeVar
+from lexer import Lexer, Token, TokenBuffer, TokenType, MSVC_CALLING_CONVENTIONS, C_DECLARATION_SPECIFIERS
 from ast_nodes import *
+from node_index import NodeIndex
 
 class ParserException(Exception):
     pass
 
+T = TypeVar('T')
+
+# Bump whenever a change to the lexer, the parser or the node classes changes what parse() builds,
+# so ASTs cached by an older version are not used
+PARSER_VERSION = 1
+
+class StatementKind(Enum):
+    VARIABLE_DECLARATION = auto()
+    FUNCTION_DECLARATION = auto()
+    LABEL = auto()
+    EXPRESSION = auto()
+
+# Longest token window the statement classifier looks at before it falls back to trial
+# parsing. Only unusually long specifier or '*' runs need more than a handful of tokens.
+STATEMENT_LOOKAHEAD = 16
+
+class MemoStats:
+    def __init__(self):
+        # Speculative parses that ran for the first time at their position
+        self.misses: int = 0
+        # Successful parses that were reused instead of parsed again
+        self.hits: int = 0
+        # Failed parses that were not retried
+        self.failed_hits: int = 0
+        # Tokens that did not have to be consumed again thanks to the hits
+        self.tokens_reused: int = 0
+
+    def __str__(self):
+        return f"misses={self.misses} hits={self.hits} failed_hits={self.failed_hits} tokens_reused={self.tokens_reused}"
+
 class Parser:
-    def __init__(self, lexer: Optional[Lexer] = None, code: str = ""):
+    def __init__(self, lexer: Optional[Lexer] = None, code: str = "", tokens: Optional[TokenBuffer] = None, memoize: bool = False, index: bool = False,
+                 hash_consing: bool = False):
         if lexer is None:
             self.lexer = Lexer()
         else:
             self.lexer = lexer
 
+        # With a token buffer the parser walks the pre-lexed tokens with an integer cursor
+        # and backtracking only rewinds the cursor. The lexer is kept in sync with the code.
+        self._tokens: Optional[TokenBuffer] = tokens
+        self._cursor: int = 0
+        if tokens is not None:
+            code = tokens.code
+
         if code:
             self.lexer.set_code(code)
 
-        self.current_token: Token = self.lexer.next_token()
+        if tokens is not None:
+            first_token = tokens.token(0)
+            self.lexer.position = first_token.position
+        else:
+            first_token = self.lexer.next_token()
+        self.current_token: Token = first_token
+        # The last token consumed by advance(), used to tell trailing comments from leading ones
+        self._previous_token: Token = first_token
         self._comments: List[Token] = []
-        self._rest: str = self.lexer.code[self.lexer.position:]
+        while self.current_token.type in (TokenType.LINE_COMMENT, TokenType.BLOCK_COMMENT):
+            self._comments.append(self.current_token)
+            self.current_token = self._next_token()
+        self.lexer.position = self.current_token.position
         self._position_stack = []
+        self._advance_count: int = 0
+        # Packrat memo of speculative parses: (rule, position) -> result and end state,
+        # or the ParserException the rule failed with. Only the trial parses that
+        # classify_statement() falls back to are ever repeated, so it is off by default.
+        self._memoize: bool = memoize
+        # Whether parse() gives the Program a NodeIndex
+        self._index: bool = index
+        # With hash_consing, leaves are put through a LeafTable as they are built
+        self.leaves: Optional[LeafTable] = LeafTable() if hash_consing else None
+        self._memo: Dict[tuple, object] = {}
+        self.memo_stats: MemoStats = MemoStats()
 
     @property
     def position(self):
         return self.lexer.position
+
+    @property
+    def trailing_comments(self) -> List[Token]:
+        # The comments iter_statements() hasn't given to a statement. Once it is exhausted these
+        # are the comments of an input without any statement, later ones go to the last statement.
+        return self._comments
     
     @position.setter
     def position(self, value):
@@ -31,14 +98,34 @@ class Parser:
     @property
     def _dbg_token(self):
         return (self.current_token.value, self.current_token.type)
+
+    @property
+    def _dbg_rest(self):
+        # Built on demand only, slicing the remaining code on every advance() is quadratic
+        return self.lexer.code[self.position:self.position + 200]
     
+    def _next_token(self) -> Token:
+        tokens = self._tokens
+        if tokens is None:
+            return self.lexer.next_token()
+        if self._cursor < len(tokens) - 1:
+            self._cursor += 1
+        return tokens.token(self._cursor)
+
+    def _peek_token(self) -> Token:
+        tokens = self._tokens
+        if tokens is None:
+            return self.lexer.peek_next_token()
+        return tokens.token(min(self._cursor + 1, len(tokens) - 1))
+
     def advance(self):
-        self.current_token = self.lexer.next_token()
+        self._advance_count += 1
+        self._previous_token = self.current_token
+        self.current_token = self._next_token()
         while self.current_token.type in (TokenType.LINE_COMMENT, TokenType.BLOCK_COMMENT):
             self._comments.append(self.current_token)
-            self.current_token = self.lexer.next_token()
+            self.current_token = self._next_token()
         self.position = self.current_token.position
-        self._rest = self.lexer.code[self.position:]
 
     def expect(self, token_type: TokenType, value: Optional[str] = None) -> Token:
         if self.current_token.type != token_type:
@@ -54,29 +141,72 @@ class Parser:
 
     def parse(self) -> Program:
         declarations = []
-        while self.current_token.type != TokenType.EOF:
-            declarations.append(self.parse_statement())
-        program = Program(declarations, self._comments, 0, self.position)
-        self._assign_parents(program)
+        comments = []
+        for statement, statement_comments in self.iter_statements():
+            declarations.append(statement)
+            comments.extend(statement_comments)
+        comments.extend(self.trailing_comments)
+        program = Program(declarations, comments, 0, self.position)
+        for statement in declarations:
+            statement.parent = program
+        if self._index:
+            program.index = NodeIndex(program)
         return program
 
+    def iter_statements(self) -> Iterator[Tuple[Statement, List[Token]]]:
+        # Yields each top-level statement as soon as it is parsed, with its parents linked and
+        # the comments that belong to it: the ones before it and inside it, plus trailing ones
+        # on its last line. Comments on later lines are held back for the next statement, and the
+        # last statement takes all the rest; without any statement they are trailing_comments.
+        # Nothing is retained between statements, so memory stays bounded by the largest one.
+        comments = self._comments
+        while self.current_token.type != TokenType.EOF:
+            statement = self.parse_statement()
+            # Nothing is ever rewound past a top-level statement
+            self._memo.clear()
+            self._assign_parents(statement)
+            if self.current_token.type == TokenType.EOF:
+                owned_count = len(comments)
+            else:
+                owned_count = self._owned_comment_count(comments)
+            statement_comments = comments[:owned_count]
+            del comments[:owned_count]
+            yield statement, statement_comments
+
+    def _owned_comment_count(self, comments: List[Token]) -> int:
+        last_token = self._previous_token
+        last_start = last_token.position - len(last_token.value)
+        count = len(comments)
+        while count:
+            comment = comments[count - 1]
+            comment_start = comment.position - len(comment.value)
+            if comment_start < last_start or comment.line - comment.value.count('\n') <= last_token.line:
+                break
+            count -= 1
+        return count
+
     def _assign_parents(self, node: ASTNode):
-        for child in node.children():
-            child.parent = node
-            self._assign_parents(child)
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            for child in node.children():
+                child.parent = node
+                stack.append(child)
 
     def push_position(self):
-        state = (self.lexer.position, self.current_token, self._comments.copy())
+        # Comments are only ever appended, so rolling them back is a truncation to the saved length
+        state = (self.lexer.position, self._cursor, self.current_token, self._previous_token, len(self._comments))
         self._position_stack.append(state)
 
     def pop_position(self):
         if not self._position_stack:
             raise ParserException("Attempted to pop from an empty position stack")
-        position, token, comments = self._position_stack.pop()
+        position, cursor, token, previous_token, comment_count = self._position_stack.pop()
         self.lexer.position = position
+        self._cursor = cursor
         self.current_token = token
-        self._comments = comments
-        self._rest = self.lexer.code[self.lexer.position:]
+        self._previous_token = previous_token
+        del self._comments[comment_count:]
 
     def with_preserved_position(self, func):
         self.push_position()
@@ -85,6 +215,35 @@ class Parser:
         finally:
             self.pop_position()
 
+    def memoized(self, rule: str, parse: Callable[[], T]) -> T:
+        if not self._memoize:
+            return parse()
+        key = (rule, self._cursor, self.lexer.position, self.current_token.type)
+        entry = self._memo.get(key)
+        if entry is None:
+            self.memo_stats.misses += 1
+            comment_count = len(self._comments)
+            advance_count = self._advance_count
+            try:
+                result = parse()
+            except ParserException as exception:
+                self._memo[key] = exception
+                raise
+            self._memo[key] = (result, self.lexer.position, self._cursor, self.current_token,
+                               self._comments[comment_count:], self._advance_count - advance_count)
+            return result
+        if isinstance(entry, ParserException):
+            self.memo_stats.failed_hits += 1
+            raise ParserException(*entry.args)
+        result, position, cursor, token, comments, advance_count = entry
+        self.memo_stats.hits += 1
+        self.memo_stats.tokens_reused += advance_count
+        self.lexer.position = position
+        self._cursor = cursor
+        self.current_token = token
+        self._comments.extend(comments)
+        return result
+
     def is_operator(self, operator: str) -> bool:
         return self.current_token.type == TokenType.OPERATOR and self.current_token.value == operator
 
@@ -116,15 +275,104 @@ class Parser:
             return keyword_handlers[self.current_token.value]()
         elif self.is_operator('{'):
             return self.parse_compound_statement()
-        elif self.is_variable_declaration():
+        kind = self.classify_statement()
+        if kind == StatementKind.VARIABLE_DECLARATION:
             return self.parse_variable_declaration()
-        elif self.is_function_declaration():
+        elif kind == StatementKind.FUNCTION_DECLARATION:
             return self.parse_function_declaration()
-        elif self.is_label():
+        elif kind == StatementKind.LABEL:
             return self.parse_label_statement()
         else:
             return self.parse_expression_statement()
 
+    def classify_statement(self) -> StatementKind:
+        # Predicts which rule parses the statement at the current token from a bounded window
+        # of upcoming tokens. This gives the same answer as the trial parses in
+        # _classify_by_trial(), without raising and catching ParserExceptions.
+        kind = self._classify_declaration()
+        if kind is None:
+            return self._classify_by_trial()
+        if kind == StatementKind.EXPRESSION and self.is_label():
+            return StatementKind.LABEL
+        return kind
+
+    def _classify_by_trial(self) -> StatementKind:
+        if self.is_variable_declaration():
+            return StatementKind.VARIABLE_DECLARATION
+        if self.is_function_declaration():
+            return StatementKind.FUNCTION_DECLARATION
+        if self.is_label():
+            return StatementKind.LABEL
+        return StatementKind.EXPRESSION
+
+    def _classify_declaration(self) -> Optional[StatementKind]:
+        # Mirrors parse_type(), the name and then either '='/';' or the calling convention
+        # and '('. Returns None when the window is too short to decide.
+        window = self._lookahead(STATEMENT_LOOKAHEAD)
+        try:
+            token = next(window, None)
+            while token is not None and self.is_declaration_specifier(token):
+                token = next(window, None)
+            if token is None:
+                return None
+            if token.type != TokenType.IDENTIFIER:
+                return StatementKind.EXPRESSION
+            token = next(window, None)
+            while token is not None and token.type == TokenType.OPERATOR and token.value == '*':
+                token = next(window, None)
+            if token is None:
+                return None
+            if token.type != TokenType.IDENTIFIER:
+                return StatementKind.EXPRESSION
+            name = token
+            token = next(window, None)
+            if token is None:
+                return None
+            if token.type == TokenType.OPERATOR and token.value in ('=', ';'):
+                return StatementKind.VARIABLE_DECLARATION
+            if name.value in MSVC_CALLING_CONVENTIONS:
+                if token.type != TokenType.IDENTIFIER:
+                    return StatementKind.EXPRESSION
+                token = next(window, None)
+                if token is None:
+                    return None
+            if token.type == TokenType.OPERATOR and token.value == '(':
+                return StatementKind.FUNCTION_DECLARATION
+            return StatementKind.EXPRESSION
+        finally:
+            window.close()
+
+    def _lookahead(self, limit: int) -> Iterator[Token]:
+        # Yields the current token and the following non-comment tokens without moving
+        # the parser. Stops after `limit` tokens or at EOF.
+        yield self.current_token
+        if self.current_token.type == TokenType.EOF:
+            return
+        tokens = self._tokens
+        if tokens is not None:
+            cursor = self._cursor
+            for _ in range(limit - 1):
+                cursor += 1
+                while tokens.is_comment(cursor):
+                    cursor += 1
+                token = tokens.token(cursor)
+                yield token
+                if token.type == TokenType.EOF:
+                    return
+            return
+        lexer = self.lexer
+        saved = (lexer.position, lexer.line, lexer.column)
+        try:
+            for _ in range(limit - 1):
+                token = lexer.next_token()
+                while token.type in (TokenType.LINE_COMMENT, TokenType.BLOCK_COMMENT):
+                    token = lexer.next_token()
+                yield token
+                if token.type == TokenType.EOF:
+                    return
+        finally:
+            lexer.position, lexer.line, lexer.column = saved
+
     def is_variable_declaration(self) -> bool:
         def check():
             try:
@@ -159,13 +407,17 @@ class Parser:
         return token.value in C_DECLARATION_SPECIFIERS
 
     def parse_type(self) -> Type:
+        return self.memoized('type', self._parse_type)
+
+    def _parse_type(self) -> Type:
         declaration_specifiers = self.parse_declaration_specifiers()
         _type = self.expect(TokenType.IDENTIFIER)
         pointer_count = 0
         while self.is_operator('*'):
             pointer_count += 1
             self.advance()
-        return Type(_type.value, declaration_specifiers, pointer_count, _type.position, self.position)
+        type_node = Type(_type.value, declaration_specifiers, pointer_count, _type.position, self.position)
+        return type_node if self.leaves is None else self.leaves.intern(type_node)
 
     def parse_parameters(self) -> List[Parameter]:
         parameters = []
@@ -212,7 +464,7 @@ class Parser:
     def is_label(self) -> bool:
         if self.current_token.type != TokenType.IDENTIFIER:
             return False
-        next_token = self.lexer.peek_next_token()
+        next_token = self._peek_token()
         return next_token.type == TokenType.OPERATOR and next_token.value == ':'
 
     def parse_label_statement(self) -> LabelStatement:
@@ -233,6 +485,9 @@ class Parser:
         return VariableDeclaration(var_type, var_name.value, initializer, start_pos, self.current_token.position)
 
     def parse_function_signature(self) -> Tuple[Type, Token, Optional[str]]:
+        return self.memoized('function_signature', self._parse_function_signature)
+
+    def _parse_function_signature(self) -> Tuple[Type, Token, Optional[str]]:
         _type = self.parse_type()
         _name = self.expect(TokenType.IDENTIFIER)
         calling_convention = None
@@ -284,7 +539,10 @@ class Parser:
         # Parse initializer
         initializer = None
         if not self.is_operator(';'):
-            if self.is_variable_declaration():
+            kind = self._classify_declaration()
+            if kind is None:
+                kind = StatementKind.VARIABLE_DECLARATION if self.is_variable_declaration() else StatementKind.EXPRESSION
+            if kind == StatementKind.VARIABLE_DECLARATION:
                 initializer = self.parse_variable_declaration()
             else:
                 initializer = self.parse_expression_statement()
@@ -308,17 +566,6 @@ class Parser:
 
         return ForStatement(initializer, condition, increment, body, start_pos, self.current_token.position)
 
-    def parse_function_call(self, function: Operand, start_pos: int) -> FunctionCall:
-        self.expect_operator('(')
-        arguments = []
-        if not self.is_operator(')'):
-            arguments.append(self.parse_expression())
-            while self.is_operator(','):
-                self.advance()
-                arguments.append(self.parse_argument())
-        self.expect_operator(')')
-        return FunctionCall(function, arguments, start_pos, self.current_token.position)
-
     def parse_switch_statement(self) -> SwitchStatement:
         start_pos = self.current_token.position
         self.expect_identifier('switch')
@@ -358,180 +605,195 @@ class Parser:
         return ExpressionStatement(expression, start_pos, self.current_token.position)
 
     def parse_expression(self) -> Operand:
-        return self.parse_comma_expression()
+        return self._parse_expression(allow_comma=True)
 
     def parse_comma_expression(self) -> Operand:
-        start_pos = self.current_token.position
-        expr = self.parse_assignment()
-        if self.is_operator(','):
-            self.advance()
-            right = self.parse_expression()
-            return CommaOperation(expr, right, start_pos, self.current_token.position)
-        return expr
-    
+        return self._parse_expression(allow_comma=True)
+
     def parse_argument(self) -> Operand:
         # we skip parsing of comma expressions here
-        return self.parse_assignment()
+        return self._parse_expression(allow_comma=False)
 
     def parse_assignment(self) -> Operand:
-        start_pos = self.current_token.position
-        left = self.parse_logical_or()
-        if self.any_of_operators(['=', '+=', '-=', '*=', '/=', '%=', '&=', '|=', '^=', '<<=', '>>=']):
-            op = self.current_token
-            self.advance()
-            right = self.parse_assignment()
-            return BinaryOperation(left, op.value, right, start_pos, self.current_token.position)
-        return left
-
-    def parse_logical_or(self) -> Operand:
-        start_pos = self.current_token.position
-        expr = self.parse_logical_and()
-        while self.is_operator('||'):
-            op = self.current_token
-            self.advance()
-            right = self.parse_logical_and()
-            expr = BinaryOperation(expr, op.value, right, start_pos, self.current_token.position)
-        return expr
-
-    def parse_logical_and(self) -> Operand:
-        start_pos = self.current_token.position
-        expr = self.parse_bitwise_or()
-        while self.is_operator('&&'):
-            op = self.current_token
-            self.advance()
-            right = self.parse_bitwise_or()
-            expr = BinaryOperation(expr, op.value, right, start_pos, self.current_token.position)
-        return expr
-    
-    def parse_bitwise_or(self) -> Operand:
-        start_pos = self.current_token.position
-        expr = self.parse_bitwise_xor()
-        while self.is_operator('|'):
-            op = self.current_token
-            self.advance()
-            right = self.parse_bitwise_xor()
-            expr = BinaryOperation(expr, op.value, right, start_pos, self.current_token.position)
-        return expr
-
-    def parse_bitwise_xor(self) -> Operand:
-        start_pos = self.current_token.position
-        expr = self.parse_bitwise_and()
-        while self.is_operator('^'):
-            op = self.current_token
-            self.advance()
-            right = self.parse_bitwise_and()
-            expr = BinaryOperation(expr, op.value, right, start_pos, self.current_token.position)
-        return expr
-
-    def parse_bitwise_and(self) -> Operand:
-        start_pos = self.current_token.position
-        expr = self.parse_equality()
-        while self.is_operator('&'):
-            op = self.current_token
-            self.advance()
-            right = self.parse_equality()
-            expr = BinaryOperation(expr, op.value, right, start_pos, self.current_token.position)
-        return expr
-
-    def parse_equality(self) -> Operand:
-        start_pos = self.current_token.position
-        expr = self.parse_relational()
-        while self.any_of_operators(['==', '!=']):
-            op = self.current_token
-            self.advance()
-            right = self.parse_relational()
-            expr = BinaryOperation(expr, op.value, right, start_pos, self.current_token.position)
-        return expr
-
-    def parse_relational(self) -> Operand:
-        start_pos = self.current_token.position
-        expr = self.parse_additive()
-        while self.any_of_operators(['<', '>', '<=', '>=']):
-            op = self.current_token
-            self.advance()
-            right = self.parse_additive()
-            expr = BinaryOperation(expr, op.value, right, start_pos, self.current_token.position)
-        return expr
-
-    def parse_additive(self) -> Operand:
-        start_pos = self.current_token.position
-        expr = self.parse_multiplicative()
-        while self.any_of_operators(['+', '-']):
-            op = self.current_token
-            self.advance()
-            right = self.parse_multiplicative()
-            expr = BinaryOperation(expr, op.value, right, start_pos, self.current_token.position)
-        return expr
-
-    def parse_multiplicative(self) -> Operand:
-        start_pos = self.current_token.position
-        expr = self.parse_unary()
-        while self.any_of_operators(['*', '/', '%']):
-            op = self.current_token
-            self.advance()
-            right = self.parse_unary()
-            expr = BinaryOperation(expr, op.value, right, start_pos, self.current_token.position)
-        return expr
-
-    def parse_unary(self) -> Operand:
-        start_pos = self.current_token.position
-        if self.any_of_operators(['-', '!', '*', '&', '~', '++', '--']):
-            op = self.current_token
-            self.advance()
-            expr = self.parse_unary()
-            return UnaryOperation(op.value, expr, False, start_pos, self.current_token.position)
-        return self.parse_postfix()
-
-    def parse_postfix(self) -> Operand:
-        expr = self.parse_primary()
-        start_pos = expr._begin_pos
-
-        while self.current_token.type == TokenType.OPERATOR:
-            if self.any_of_operators(['++', '--']):
-                op = self.current_token
-                self.advance()
-                expr = UnaryOperation(op.value, expr, True, start_pos, self.current_token.position)
-            elif self.is_operator('('):
-                expr = self.parse_function_call(expr, start_pos)
-            elif self.is_operator('['):
-                self.advance()
-                index = self.parse_expression()
-                self.expect_operator(']')
-                expr = ArrayAccess(expr, index, start_pos, self.current_token.position)
-            elif self.is_operator('.'):
-                self.advance()
-                member = self.parse_primary()
-                expr = MemberAccess(expr, member, start_pos, self.current_token.position)
-            elif self.is_operator('->'):
+        return self._parse_expression(allow_comma=False)
+
+    def _parse_expression(self, allow_comma: bool) -> Operand:
+        # Iterative precedence climbing over BINARY_OPERATOR_PRECEDENCE. Every open
+        # parenthesis, call argument list, array index or parenthesised member gets its own
+        # frame with an operand and an operator stack, so nesting depth is bounded by memory
+        # instead of the Python recursion limit. Each operand is kept together with the
+        # position of the token its parse started at, which is what the enclosing binary
+        # operation uses as its begin position.
+        frames = [_ExpressionFrame(_ExpressionFrame.ROOT, allow_comma)]
+        frame = frames[-1]
+        expr: Operand
+        expr_start = 0
+        postfix_start = 0
+        expecting_operand = True
+
+        while True:
+            if expecting_operand:
+                token = self.current_token
+                while token.type == TokenType.OPERATOR and token.value in UNARY_OPERATORS:
+                    frame.operators.append((token.value, _PREFIX, token.position))
+                    self.advance()
+                    token = self.current_token
+                if token.type == TokenType.OPERATOR and token.value == '(':
+                    self.advance()
+                    frame = _ExpressionFrame(_ExpressionFrame.PARENTHESES, True, operand_start=token.position)
+                    frames.append(frame)
+                    continue
+                expr = self._parse_primary_token()
+                expr_start = postfix_start = token.position
+                expecting_operand = False
+
+            token = self.current_token
+            if token.type == TokenType.OPERATOR:
+                value = token.value
+                if value == '++' or value == '--':
+                    self.advance()
+                    expr = UnaryOperation(value, expr, True, postfix_start, self.current_token.position)
+                    continue
+                if value == '(':
+                    self.advance()
+                    if self.is_operator(')'):
+                        self.advance()
+                        expr = FunctionCall(expr, [], postfix_start, self.current_token.position)
+                        continue
+                    frame = _ExpressionFrame(_ExpressionFrame.CALL, True, expr, postfix_start, expr_start)
+                    frames.append(frame)
+                    expecting_operand = True
+                    continue
+                if value == '[':
+                    self.advance()
+                    frame = _ExpressionFrame(_ExpressionFrame.INDEX, True, expr, postfix_start, expr_start)
+                    frames.append(frame)
+                    expecting_operand = True
+                    continue
+                if value == '.' or value == '->':
+                    self.advance()
+                    if self.is_operator('('):
+                        self.advance()
+                        frame = _ExpressionFrame(_ExpressionFrame.MEMBER, True, expr, postfix_start, expr_start, value)
+                        frames.append(frame)
+                        expecting_operand = True
+                        continue
+                    member = self._parse_primary_token()
+                    access_class = MemberAccess if value == '.' else PointerAccess
+                    expr = access_class(expr, member, postfix_start, self.current_token.position)
+                    continue
+
+            # The postfix chain is complete, apply pending prefix operators
+            operators = frame.operators
+            while operators and operators[-1][1] == _PREFIX:
+                operator, _, start = operators.pop()
+                expr = UnaryOperation(operator, expr, False, start, self.current_token.position)
+                expr_start = start
+
+            precedence = BINARY_OPERATOR_PRECEDENCE.get(token.value) if token.type == TokenType.OPERATOR else None
+            if precedence is not None and (precedence != COMMA_PRECEDENCE or frame.allow_comma):
+                expr, expr_start = self._reduce_operators(frame, expr, expr_start, precedence)
+                frame.operands.append((expr, expr_start))
+                operators.append((token.value, precedence, 0))
                 self.advance()
-                member = self.parse_primary()
-                expr = PointerAccess(expr, member, start_pos, self.current_token.position)
+                expecting_operand = True
+                continue
+
+            expr, expr_start = self._reduce_operators(frame, expr, expr_start, None)
+            kind = frame.kind
+            if kind == _ExpressionFrame.ROOT:
+                return expr
+            if kind == _ExpressionFrame.CALL:
+                frame.arguments.append(expr)
+                if self.is_operator(','):
+                    self.advance()
+                    frame.allow_comma = False
+                    expecting_operand = True
+                    continue
+            frames.pop()
+            if kind == _ExpressionFrame.PARENTHESES:
+                self.expect_operator(')')
+                expr_start = frame.operand_start
+                postfix_start = expr._begin_pos
             else:
+                postfix_start = frame.postfix_start
+                expr_start = frame.operand_start
+                if kind == _ExpressionFrame.INDEX:
+                    self.expect_operator(']')
+                    expr = ArrayAccess(frame.target, expr, postfix_start, self.current_token.position)
+                elif kind == _ExpressionFrame.CALL:
+                    self.expect_operator(')')
+                    expr = FunctionCall(frame.target, frame.arguments, postfix_start, self.current_token.position)
+                else:
+                    self.expect_operator(')')
+                    access_class = MemberAccess if frame.member_operator == '.' else PointerAccess
+                    expr = access_class(frame.target, expr, postfix_start, self.current_token.position)
+            frame = frames[-1]
+
+    def _reduce_operators(self, frame: '_ExpressionFrame', right: Operand, right_start: int,
+                          precedence: Optional[int]) -> Tuple[Operand, int]:
+        # Folds the operators of the frame that bind at least as tightly as `precedence`
+        # (all of them for None) into `right`, honouring right associativity.
+        operators = frame.operators
+        operands = frame.operands
+        end_pos = self.current_token.position
+        while operators:
+            operator, operator_precedence, _ = operators[-1]
+            if precedence is not None and (operator_precedence < precedence or (
+                    operator_precedence == precedence and precedence in RIGHT_ASSOCIATIVE_PRECEDENCES)):
                 break
+            operators.pop()
+            left, left_start = operands.pop()
+            if operator == ',':
+                right = CommaOperation(left, right, left_start, end_pos)
+            else:
+                right = BinaryOperation(left, operator, right, left_start, end_pos)
+            right_start = left_start
+        return right, right_start
 
-        return expr
-
-    def parse_primary(self) -> Operand:
+    def _parse_primary_token(self) -> Operand:
         start_pos = self.current_token.position
-        expr = None
-
-        if self.current_token.type == TokenType.NUMBER:
-            value = self.current_token.value
+        token_type = self.current_token.type
+        value = self.current_token.value
+        leaf: Operand
+        if token_type == TokenType.NUMBER:
             self.advance()
-            expr = Literal(value, start_pos, self.current_token.position)
-        elif self.current_token.type == TokenType.IDENTIFIER:
-            name = self.current_token.value
+            leaf = Literal(value, start_pos, self.current_token.position)
+        elif token_type == TokenType.IDENTIFIER:
             self.advance()
-            expr = Identifier(name, start_pos, self.current_token.position)
-        elif self.is_operator('('):
+            leaf = Identifier(value, start_pos, self.current_token.position)
+        elif token_type == TokenType.STRING:
             self.advance()
-            expr = self.parse_expression()
-            self.expect_operator(')')
-        elif self.current_token.type == TokenType.STRING:
-            value = self.current_token.value
-            self.advance()
-            expr = StringLiteral(value, start_pos, self.current_token.position)
+            leaf = StringLiteral(value, start_pos, self.current_token.position)
         else:
             raise self.error(f"Unexpected token: {self.current_token}")
-
-        return expr
+        return leaf if self.leaves is None else self.leaves.intern(leaf)
+
+
+UNARY_OPERATORS = {'-', '!', '*', '&', '~', '++', '--'}
+# Marks a prefix operator on an operator stack, it binds tighter than every binary operator
+_PREFIX = 1 << 16
+
+class _ExpressionFrame:
+    ROOT = 0
+    PARENTHESES = 1
+    CALL = 2
+    INDEX = 3
+    MEMBER = 4
+
+    __slots__ = ('kind', 'allow_comma', 'target', 'postfix_start', 'operand_start', 'member_operator',
+                 'operands', 'operators', 'arguments')
+
+    def __init__(self, kind: int, allow_comma: bool, target: Optional[Operand] = None, postfix_start: int = 0,
+                 operand_start: int = 0, member_operator: str = ''):
+        self.kind = kind
+        self.allow_comma = allow_comma
+        # The expression a call, index or member access applies to
+        self.target = target
+        self.postfix_start = postfix_start
+        # Position the enclosing operand started at, before its '(' or its postfix chain
+        self.operand_start = operand_start
+        self.member_operator = member_operator
+        self.operands: List[Tuple[Operand, int]] = []
+        self.operators: List[Tuple[str, int, int]] = []
+        self.arguments: List[Operand] = []
@@ -0,0 +1,178 @@
+from bisect import bisect_left, bisect_right
+from typing import List, Optional, Set, Tuple
+
+from ast_nodes import ASTNode, CompoundStatement, Program, Statement
+from hex_rays_parser import Parser, ParserException
+from lexer import Lexer, Token, TokenType
+from visitor import link_new_child, unlink_child, walk_preorder
+
+
+# Updating a parsed Program after an edit of its source without parsing all of it again.
+# Node positions are token end offsets, so the tokens around the edit can be found from the tree:
+# the innermost block around the edit is parsed again from its '{' and kept if its '}' ends up
+# where the old one was. Failing that, the top-level statements from the one the edit is in up to
+# the first one the parse lines up with again are replaced. The rest of the tree, and the comments,
+# after the edit only have their positions shifted.
+
+
+def reparse(program: Program, code: str, edit_start: int, edit_end: int, new_text: str) -> str:
+    # program must have been parsed from code. Replaces code[edit_start:edit_end] with new_text,
+    # updates program in place to what a full parse of the result gives and returns the new code.
+    # A ParserException leaves program as it was.
+    if not 0 <= edit_start <= edit_end <= len(code):
+        raise ValueError(f"Invalid edit range {edit_start}:{edit_end} for {len(code)} characters")
+    new_code = code[:edit_start] + new_text + code[edit_end:]
+    delta = len(new_text) - (edit_end - edit_start)
+    lexer = Lexer(new_code)
+    for block, close_end in reversed(_enclosing_blocks(program, code, edit_start, edit_end)):
+        parser = _parser_at(lexer, block._begin_pos - 1)
+        try:
+            new_block = parser.parse_compound_statement()
+        except ParserException:
+            continue
+        # The edit is before both braces, so if they end at the same place they are the same '}'
+        # and the code after it is lexed and parsed exactly as before
+        if parser._previous_token.position != close_end + delta:
+            continue
+        comments = [comment for comment in parser._comments if comment.position < close_end + delta]
+        region_start = block._begin_pos
+        _shift_positions(program, close_end, delta, {id(block)})
+        parent = block.parent
+        assert parent is not None
+        parent.replace_child(block, new_block)
+        _splice_comments(program, lexer, region_start, close_end, comments, delta)
+        return new_code
+    _reparse_statements(program, code, lexer, edit_start, edit_end, len(new_text), delta)
+    return new_code
+
+
+def _parser_at(lexer: Lexer, position: int) -> Parser:
+    # The lexer already holds the new code, so the parser starts at the token at position
+    lexer.position = position
+    return Parser(lexer=lexer)
+
+
+def _enclosing_blocks(program: Program, code: str, edit_start: int, edit_end: int) -> List[Tuple[CompoundStatement, int]]:
+    # Blocks whose '{' ends before the edit and whose '}' starts after it, outermost first, with the
+    # end of their '}'. A node whose first token ends after the edit starts or that ends before the
+    # edit does can't hold such a block.
+    blocks = []
+    old_lexer: Optional[Lexer] = None
+    for node in walk_preorder(program, lambda node: node._begin_pos > edit_start or node._end_pos < edit_end):
+        if not isinstance(node, CompoundStatement) or node._begin_pos > edit_start:
+            continue
+        if node.statements:
+            # A statement ends at the token after it, which for the last one is the '}'
+            close_end = node.statements[-1]._end_pos
+        else:
+            if old_lexer is None:
+                old_lexer = Lexer(code)
+            old_lexer.position = node._begin_pos
+            token = old_lexer.next_token()
+            while token.type in (TokenType.LINE_COMMENT, TokenType.BLOCK_COMMENT):
+                token = old_lexer.next_token()
+            close_end = token.position
+        if edit_end < close_end:
+            blocks.append((node, close_end))
+    return blocks
+
+
+def _reparse_statements(program: Program, code: str, lexer: Lexer, edit_start: int, edit_end: int,
+                        new_text_length: int, delta: int):
+    statements = program.statements
+    # Parsing starts at the last statement whose first token ends before the edit
+    first = bisect_left(statements, edit_start, key=_begin_pos) - 1
+    start = 0
+    if first > 0:
+        token_start = _token_start(lexer, statements[first - 1]._begin_pos, statements[first]._begin_pos)
+        if token_start is None:
+            first = 0
+        else:
+            start = token_start
+    first = max(first, 0)
+
+    parser = _parser_at(lexer, start)
+    new_statements: List[Statement] = []
+    comments: List[Token] = []
+    last = len(statements)
+    for statement, statement_comments in parser.iter_statements():
+        new_statements.append(statement)
+        comments.extend(statement_comments)
+        token = parser.current_token
+        if token.position - len(token.value) < edit_start + new_text_length:
+            continue
+        # Past the edit, stop at an old statement that starts with this same token. Its first token
+        # has to start after the edit too, which it does when the one before it ends after the edit.
+        old_position = token.position - delta
+        index = bisect_left(statements, old_position, lo=first + 1, key=_begin_pos)
+        if (index < len(statements) and statements[index]._begin_pos == old_position
+                and statements[index - 1]._begin_pos >= edit_end):
+            last = index
+            break
+    comments.extend(parser.trailing_comments)
+
+    removed = statements[first:last]
+    if last < len(statements):
+        region_end = statements[last]._begin_pos
+    else:
+        # Everything up to the end of the input was parsed again, comments at the very end included
+        region_end = len(code) + 1
+    _shift_positions(program, min(region_end, len(code)), delta, {id(statement) for statement in removed})
+    statements[first:last] = new_statements
+    for statement in removed:
+        unlink_child(program, statement)
+    for statement in new_statements:
+        link_new_child(program, statement)
+    _splice_comments(program, lexer, start, region_end, comments, delta)
+
+
+def _begin_pos(node: ASTNode) -> int:
+    return node._begin_pos
+
+
+def _token_start(lexer: Lexer, position: int, token_end: int) -> Optional[int]:
+    # Start of the token ending at token_end, lexing from position, which is a token boundary
+    lexer.position = position
+    token = lexer.next_token()
+    while token.position < token_end and token.type != TokenType.EOF:
+        token = lexer.next_token()
+    if token.position != token_end:
+        return None
+    return token.position - len(token.value)
+
+
+def _shift_positions(root: ASTNode, threshold: int, delta: int, replaced: Set[int]):
+    # Moves every position at or after threshold by delta. A subtree that ends before threshold lies
+    # entirely before it, so only the nodes after the edit and their ancestors are visited.
+    if delta == 0:
+        return
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if node._end_pos < threshold or id(node) in replaced:
+            continue
+        node._end_pos += delta
+        if node._begin_pos >= threshold:
+            node._begin_pos += delta
+        for field in node._child_fields:
+            value = getattr(node, field)
+            if value.__class__ is list:
+                stack.extend(value)
+            elif value is not None:
+                stack.append(value)
+
+
+def _splice_comments(program: Program, lexer: Lexer, region_start: int, region_end: int,
+                     new_comments: List[Token], delta: int):
+    # Comments ending in (region_start, region_end) in the old code are replaced with the ones the
+    # new parse found there, and the ones after are moved. Their line and column come from the new
+    # code, as they would have in a full parse.
+    comments = program.comments
+    begin = bisect_right(comments, region_start, key=_token_position)
+    end = bisect_left(comments, region_end, key=_token_position)
+    moved = [lexer.relocate(comment, comment.position + delta) for comment in comments[end:]]
+    comments[begin:] = sorted(new_comments, key=_token_position) + moved
+
+
+def _token_position(token: Token) -> int:
+    return token.position
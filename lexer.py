@@ -1,4 +1,7 @@
-from typing import Optional
+import re
+from array import array
+from bisect import bisect_left
+from typing import Dict, List, Optional
 from enum import Enum, auto
 
 MSVC_CALLING_CONVENTIONS = {'__stdcall', '__cdecl', '__fastcall', '__thiscall', '__vectorcall'}
@@ -20,6 +23,8 @@ class TokenType(Enum):
     EOF = auto()
 
 class Token:
+    __slots__ = ('type', 'value', 'line', 'column', 'position')
+
     def __init__(self, type: TokenType, value: str, line: int, column: int, position: int):
         self.type: TokenType = type
         self.value: str = value
@@ -30,7 +35,7 @@ class Token:
     def __str__(self):
         return self.value
 
-class Lexer:
+class CharLexer:
     def __init__(self, code: str = ""):
         self.code: str = code
         self.position: int = 0
@@ -217,3 +222,211 @@ class Lexer:
 
     def error(self, message: str) -> Exception:
         return Exception(f"Lexer error at line {self.line}, column {self.column}: {message}")
+
+
+# Master pattern for the table-driven lexer. Leading whitespace is skipped as part of the
+# match, so every call produces one token. Operators are tried longest first, which is
+# equivalent to the incremental munching done by CharLexer.operator.
+_OPERATOR_PATTERN = '|'.join(re.escape(op) for op in sorted(C_OPERATORS, key=len, reverse=True))
+_NUMBER_SUFFIX = '[uUlLfFiI]*'
+_NUMBER_PATTERN = (f'0[xX][0-9a-fA-F]*{_NUMBER_SUFFIX}'
+                   f'|0[bB][01]*{_NUMBER_SUFFIX}'
+                   f'|[0-9]*(?:\\.[0-9]*)?(?:[eE][+-]?[0-9]*)?{_NUMBER_SUFFIX}')
+_MASTER = re.compile(
+    r'\s*(?:'
+    r'(?P<LINE_COMMENT>//[^\n]*)'
+    r'|(?P<BLOCK_COMMENT>/\*)'
+    r'|(?P<IDENTIFIER>[A-Za-z_]\w*)(?P<SCOPE>\s*::)?'
+    rf'|(?P<NUMBER>(?=[0-9])(?:{_NUMBER_PATTERN}))'
+    rf'|(?P<OPERATOR>{_OPERATOR_PATTERN})'
+    r'|(?P<STRING>["\'])'
+    r')')
+_WORD = re.compile(r'\w+')
+_WHITESPACE = re.compile(r'\s*')
+_STRING_BODY = {
+    '"': re.compile(r'[^"\\]*(?:\\.[^"\\]*)*', re.DOTALL),
+    "'": re.compile(r"[^'\\]*(?:\\.[^'\\]*)*", re.DOTALL),
+}
+_NEWLINE = re.compile('\n')
+_TOKEN_TYPES = {type.name: type for type in TokenType}
+
+
+# Table-driven lexer producing the same token stream as CharLexer. Each call to next_token() is a
+# single match of a precompiled master pattern, which skips whitespace and classifies the token by
+# its first character. Comments, strings and numbers are then consumed in whole runs. Line and
+# column are derived from the position through a table of newline offsets, so they stay correct
+# when the parser rewinds `position`. Anything outside the ASCII fast path goes to CharLexer.
+class Lexer(CharLexer):
+    def __init__(self, code: str = ""):
+        super().__init__(code)
+        self._newlines: List[int] = self._index_newlines(code)
+
+    def set_code(self, code: str):
+        super().set_code(code)
+        self._newlines = self._index_newlines(code)
+
+    @staticmethod
+    def _index_newlines(code: str) -> List[int]:
+        return [match.start() for match in _NEWLINE.finditer(code)]
+
+    def _sync_line_column(self, position: int) -> None:
+        newlines = self._newlines
+        line_index = bisect_left(newlines, position)
+        self.line = line_index + 1
+        self.column = position - newlines[line_index - 1] if line_index else position + 1
+
+    def relocate(self, token: Token, position: int) -> Token:
+        # A copy of token, lexed elsewhere, ending at position in this lexer's code
+        self._sync_line_column(position)
+        return Token(token.type, token.value, self.line, self.column - len(token.value), position)
+
+    def _make_token(self, type: TokenType, value: str, start: int, end: int) -> Token:
+        self.position = end
+        self._sync_line_column(end)
+        return Token(type, value, self.line, self.column - (end - start), end)
+
+    def _fallback(self, position: int, method) -> Token:
+        self.position = position
+        self._sync_line_column(position)
+        return method()
+
+    def next_token(self) -> Token:
+        code = self.code
+        match = _MASTER.match(code, self.position)
+        if match is None:
+            # End of input, a non-ASCII identifier or an unexpected character
+            return self._fallback(_WHITESPACE.match(code, self.position).end(), super().next_token)
+
+        kind = match.lastgroup
+        if kind == 'SCOPE':
+            return self._scoped_identifier(match)
+        start = match.start(kind)
+        end = match.end()
+        if kind == 'BLOCK_COMMENT':
+            close = code.find('*/', end)
+            end = len(code) if close == -1 else close + 2
+        elif kind == 'STRING':
+            # An unterminated literal runs to the end of the input, like CharLexer.string
+            end = _STRING_BODY[code[start]].match(code, end).end()
+            end = end + 1 if end < len(code) and code[end] == code[start] else len(code)
+        elif kind == 'NUMBER' and end < len(code) and code[end] >= '\x80':
+            # str.isdigit() accepts non-ASCII digits that the pattern does not
+            return self._fallback(start, self.number)
+
+        # Inlined _make_token, this is the hot path
+        self.position = end
+        newlines = self._newlines
+        line_index = bisect_left(newlines, end)
+        self.line = line = line_index + 1
+        self.column = column = end - newlines[line_index - 1] if line_index else end + 1
+        return Token(_TOKEN_TYPES[kind], code[start:end], line, column - (end - start), end)
+
+    def _scoped_identifier(self, match: re.Match) -> Token:
+        # Fast path for `A::B::C` chains written without whitespace. Anything else goes
+        # through CharLexer.identifier, whose lookahead gives unusual results there.
+        code = self.code
+        start = match.start('IDENTIFIER')
+        if match.end() - match.start('SCOPE') != 2:
+            return self._fallback(start, self.identifier)
+        parts = [match.group('IDENTIFIER')]
+        position = match.end()
+        while True:
+            if position < len(code) and code[position].isspace():
+                return self._fallback(start, self.identifier)
+            word = _WORD.match(code, position)
+            if word is None:
+                # `::` was consumed but no name follows it
+                if code.startswith('::', position):
+                    return self._fallback(start, self.identifier)
+                break
+            parts.append(word.group())
+            position = word.end()
+            if code.startswith('::', position):
+                position += 2
+            elif code.startswith('::', _WHITESPACE.match(code, position).end()):
+                return self._fallback(start, self.identifier)
+            else:
+                break
+        return self._make_token(TokenType.IDENTIFIER, '::'.join(parts), start, position)
+
+
+_TOKEN_TYPE_LIST = list(TokenType)
+_TOKEN_TYPE_CODES = {type: index for index, type in enumerate(_TOKEN_TYPE_LIST)}
+_TOKEN_TYPE_CODES_BY_NAME = {type.name: index for index, type in enumerate(_TOKEN_TYPE_LIST)}
+EOF_CODE = _TOKEN_TYPE_CODES[TokenType.EOF]
+LINE_COMMENT_CODE = _TOKEN_TYPE_CODES[TokenType.LINE_COMMENT]
+BLOCK_COMMENT_CODE = _TOKEN_TYPE_CODES[TokenType.BLOCK_COMMENT]
+OPERATOR_CODE = _TOKEN_TYPE_CODES[TokenType.OPERATOR]
+
+
+# The complete token stream of a piece of code, lexed once into parallel arrays. Token i is
+# described by kinds[i], starts[i], ends[i], lines[i] and columns[i], with the same meaning as the
+# fields of the Token that Lexer would produce (`ends` is Token.position). Token objects are only
+# built on demand by token(). The buffer is immutable, so one instance can be shared by any number
+# of parsers over the same code. The last entry is always the EOF token.
+class TokenBuffer:
+    def __init__(self, code: str):
+        self.code: str = code
+        self.kinds = array('B')
+        self.starts = array('l')
+        self.ends = array('l')
+        self.lines = array('l')
+        self.columns = array('l')
+        # Token values that are not simply code[start:end], see Lexer._scoped_identifier
+        self._values: Dict[int, str] = {}
+        self._tokenize(Lexer(code))
+
+    def _tokenize(self, lexer: Lexer) -> None:
+        code = self.code
+        newlines = lexer._newlines
+        kinds, starts, ends, lines, columns = self.kinds, self.starts, self.ends, self.lines, self.columns
+        master_match = _MASTER.match
+        type_codes = _TOKEN_TYPE_CODES_BY_NAME
+        position = 0
+        while True:
+            match = master_match(code, position)
+            kind = match.lastgroup if match is not None else None
+            end = match.end() if match is not None else position
+            if (kind is None or kind == 'SCOPE' or kind == 'STRING' or kind == 'BLOCK_COMMENT'
+                    or (kind == 'NUMBER' and end < len(code) and code[end] >= '\x80')):
+                # Let the lexer handle everything that is more than a single match
+                lexer.position = position
+                token = lexer.next_token()
+                end = token.position
+                # The lexer skips the same whitespace as the master pattern. The value of a
+                # scoped identifier has its spaces taken out, so it can't give the start.
+                start = _WHITESPACE.match(code, position).end()
+                if code[start:end] != token.value:
+                    self._values[len(kinds)] = token.value
+                kinds.append(_TOKEN_TYPE_CODES[token.type])
+                starts.append(start)
+                ends.append(end)
+                lines.append(token.line)
+                columns.append(token.column)
+                if token.type == TokenType.EOF:
+                    return
+                position = end
+                continue
+            start = match.start(kind)
+            line_index = bisect_left(newlines, end)
+            column = end - newlines[line_index - 1] if line_index else end + 1
+            kinds.append(type_codes[kind])
+            starts.append(start)
+            ends.append(end)
+            lines.append(line_index + 1)
+            columns.append(column - (end - start))
+            position = end
+
+    def __len__(self) -> int:
+        return len(self.kinds)
+
+    def token(self, index: int) -> Token:
+        start = self.starts[index]
+        end = self.ends[index]
+        value = self._values.get(index)
+        if value is None:
+            value = self.code[start:end]
+        return Token(_TOKEN_TYPE_LIST[self.kinds[index]], value, self.lines[index], self.columns[index], end)
+
+    def is_comment(self, index: int) -> bool:
+        return self.kinds[index] in (LINE_COMMENT_CODE, BLOCK_COMMENT_CODE)
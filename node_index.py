@@ -0,0 +1,65 @@
+from typing import Dict, List
+
+from ast_nodes import ASTNode, Identifier
+
+
+# Live nodes of a tree by class and Identifiers by name, so lookups cost O(matches) instead of a
+# full traversal. Program.index holds one; replace_child and transform keep it up to date through
+# visitor.link_child. Nodes are keyed by id() and come back in no particular order. That relies on
+# every node being in one place in the tree, rules put copies from ASTNode.deep_copy() elsewhere.
+class NodeIndex:
+    def __init__(self, root: ASTNode):
+        self._by_class: Dict[type, Dict[int, ASTNode]] = {}
+        self._by_name: Dict[str, Dict[int, Identifier]] = {}
+        self.add(root)
+
+    def add(self, root: ASTNode):
+        # Also links the subtree's parents, which the replacement bookkeeping walks up
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            self._by_class.setdefault(node.__class__, {})[id(node)] = node
+            if isinstance(node, Identifier):
+                self._by_name.setdefault(node.name, {})[id(node)] = node
+            for child in node.children():
+                child.parent = node
+                stack.append(child)
+
+    def remove(self, root: ASTNode):
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            nodes = self._by_class.get(node.__class__)
+            if nodes is not None:
+                nodes.pop(id(node), None)
+            if isinstance(node, Identifier):
+                identifiers = self._by_name.get(node.name)
+                if identifiers is not None:
+                    identifiers.pop(id(node), None)
+            stack.extend(node.children())
+
+    def replace(self, old_child: ASTNode, new_child: ASTNode):
+        # The new subtree may reuse nodes of the old one, so everything is removed before adding
+        self.remove(old_child)
+        self.add(new_child)
+
+    def rename(self, node: ASTNode, old_name: str):
+        # An Identifier in the tree was renamed from old_name, other nodes' names aren't indexed
+        if isinstance(node, Identifier):
+            identifiers = self._by_name.get(old_name)
+            if identifiers is not None:
+                identifiers.pop(id(node), None)
+            self._by_name.setdefault(node.name, {})[id(node)] = node
+
+    def nodes_of_class(self, cls: type) -> List[ASTNode]:
+        result: List[ASTNode] = []
+        for node_class, nodes in self._by_class.items():
+            if issubclass(node_class, cls):
+                result.extend(nodes.values())
+        return result
+
+    def identifiers_named(self, name: str) -> List[Identifier]:
+        return list(self._by_name.get(name, {}).values())
+
+    def __len__(self) -> int:
+        return sum(len(nodes) for nodes in self._by_class.values())
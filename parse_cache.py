@@ -0,0 +1,269 @@
+import hashlib
+import os
+import re
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+import binary_ast
+from ast_nodes import ASTNode, Program, Statement
+from hex_rays_parser import PARSER_VERSION, Parser
+from lexer import Lexer, Token, TokenBuffer, TokenType
+from node_index import NodeIndex
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+_ENTRY_SUFFIX = '.ast'
+
+# What split_statements looks at: brackets, ';', 'do', and the start of comments and literals
+_STRUCTURE = re.compile(r'//|/\*|["\'(){}\[\];]|\bdo\b')
+_NON_SPACE = re.compile(r'\S')
+
+
+class CacheStats:
+    def __init__(self):
+        # Top-level statements loaded from the cache
+        self.hits: int = 0
+        # Top-level statements that were parsed and stored
+        self.misses: int = 0
+        # Entries deleted to keep the cache under its size limit
+        self.evictions: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __str__(self):
+        return f"hits={self.hits} misses={self.misses} evictions={self.evictions} hit_rate={self.hit_rate:.1%}"
+
+
+# An on-disk cache of parsed top-level statements, in front of Parser.parse. The code is split
+# into top-level statements by its brackets alone, and each one is looked up by a hash of its
+# source text and PARSER_VERSION, so a function that did not change is not parsed again wherever
+# it moved to. Entries hold the binary_ast form of the statement, with positions relative to it,
+# and are evicted least recently used first once the cache grows past max_bytes.
+# The order of use is kept in the files' modification times, so it survives between runs.
+class ParseCache:
+    def __init__(self, directory: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.directory: str = directory
+        self.max_bytes: int = max_bytes
+        self.stats: CacheStats = CacheStats()
+        os.makedirs(directory, exist_ok=True)
+        # Entry sizes by key, least recently used first
+        self._entries: 'OrderedDict[str, int]' = OrderedDict()
+        self._size: int = 0
+        entries = []
+        with os.scandir(directory) as files:
+            for file in files:
+                if file.name.endswith(_ENTRY_SUFFIX):
+                    stat = file.stat()
+                    entries.append((stat.st_mtime_ns, file.name[:-len(_ENTRY_SUFFIX)], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self._size += size
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def parse(self, code: str, index: bool = False) -> Program:
+        # The same Program as Parser(code=code, index=index).parse()
+        lexer = Lexer(code)
+        statements: List[Statement] = []
+        comments: List[Token] = []
+        try:
+            spans, top_level_comments = split_statements(code, lexer)
+            comments_left = iter(top_level_comments)
+            comment = next(comments_left, None)
+            for number, (start, end) in enumerate(spans):
+                while comment is not None and comment.position <= start:
+                    comments.append(comment)
+                    comment = next(comments_left, None)
+                # The token after the statement ends it, the statement's own parse only has the EOF
+                if number + 1 < len(spans):
+                    lexer.position = spans[number + 1][0]
+                    follower = lexer.next_token().position
+                else:
+                    follower = len(code)
+                source = code[start:end]
+                chunk_statements, chunk_comments = self._statements(source)
+                if not _covers(chunk_statements, lexer, start, end):
+                    raise ValueError(f"Misjudged statement at {start}")
+                for statement in chunk_statements:
+                    _place(statement, start, len(source) + 1, follower)
+                    statements.append(statement)
+                comments.extend(lexer.relocate(chunk_comment, chunk_comment.position + start) for chunk_comment in chunk_comments)
+        except Exception:
+            # A statement boundary was misjudged or the code is broken. Either way the whole
+            # parse gets it right or raises the error it would have raised without the cache.
+            return Parser(code=code, index=index).parse()
+        if comment is not None:
+            comments.append(comment)
+            comments.extend(comments_left)
+        program = Program(statements, comments, 0, len(code))
+        for statement in statements:
+            statement.parent = program
+        if index:
+            program.index = NodeIndex(program)
+        return program
+
+    def _statements(self, source: str) -> Tuple[List[Statement], List[Token]]:
+        # Statements and comments of source, with positions relative to it
+        key = hashlib.sha256(f"{PARSER_VERSION}\0{source}".encode('utf-8', 'surrogatepass')).hexdigest()
+        program = self._load(key)
+        if program is not None:
+            self.stats.hits += 1
+            return program.statements, program.comments
+        # A trailing space puts the end of the input after the statement's last token
+        program = Parser(tokens=TokenBuffer(source + ' ')).parse()
+        self.stats.misses += 1
+        self._store(key, binary_ast.dumps(program))
+        return program.statements, program.comments
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + _ENTRY_SUFFIX)
+
+    def _load(self, key: str) -> Optional[Program]:
+        if key not in self._entries:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as file:
+                program = binary_ast.loads(file.read())
+            os.utime(path)
+        except (OSError, ValueError, IndexError):
+            # Evicted by another process sharing the directory, or written in an older format
+            self._forget(key)
+            return None
+        self._entries.move_to_end(key)
+        return program
+
+    def _store(self, key: str, data: bytes):
+        path = self._path(key)
+        # Written aside and renamed, so readers never see half an entry
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, 'wb') as file:
+            file.write(data)
+        os.replace(temporary_path, path)
+        self._forget(key)
+        self._entries[key] = len(data)
+        self._size += len(data)
+        while self._size > self.max_bytes and len(self._entries) > 1:
+            old_key = next(iter(self._entries))
+            self._forget(old_key)
+            try:
+                os.remove(self._path(old_key))
+            except OSError:
+                pass
+            self.stats.evictions += 1
+
+    def _forget(self, key: str):
+        size = self._entries.pop(key, None)
+        if size is not None:
+            self._size -= size
+
+    def clear(self):
+        for key in list(self._entries):
+            self._forget(key)
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+
+def split_statements(code: str, lexer: Lexer) -> Tuple[List[Tuple[int, int]], List[Token]]:
+    # Source ranges of the top-level statements of code, and the comments between statements.
+    # A statement ends at a ';' or a '}' outside of any brackets, unless an operator follows the '}',
+    # as in an initializer list, or an 'else' follows, or the 'while' of a 'do' in the statement.
+    # Only brackets, ';' and 'do' are looked at, comments and literals are skipped with lexer so
+    # that what is inside them is ignored exactly as the parser ignores it.
+    spans: List[Tuple[int, int]] = []
+    comments: List[Token] = []
+    start = -1
+    depth = 0
+    # 'do' statements in the current statement still waiting for their 'while'
+    open_dos = 0
+    position = 0
+    while True:
+        match = _STRUCTURE.search(code, position)
+        if start < 0:
+            # Whatever comes before the first bracket of a statement starts it
+            code_start = _NON_SPACE.search(code, position, len(code) if match is None else match.start())
+            if code_start is not None:
+                start = code_start.start()
+        if match is None:
+            break
+        char = match.group()
+        position = match.end()
+        if char == '//' or char == '/*' or char == '"' or char == "'":
+            lexer.position = match.start()
+            token = lexer.next_token()
+            position = token.position
+            if start < 0 and char[0] == '/':
+                comments.append(token)
+            elif start < 0:
+                start = match.start()
+            continue
+        if start < 0:
+            start = match.start()
+        if char == 'do':
+            if depth == 0:
+                open_dos += 1
+            continue
+        if char in '({[':
+            depth += 1
+            continue
+        if char in ')]':
+            depth -= 1
+            continue
+        if char == '}':
+            depth -= 1
+        if depth != 0:
+            continue
+        following = _next_code_token(lexer, position)
+        if following.type == TokenType.IDENTIFIER:
+            if following.value == 'else':
+                continue
+            if following.value == 'while' and open_dos:
+                open_dos -= 1
+                continue
+        elif char == '}' and following.type == TokenType.OPERATOR:
+            continue
+        spans.append((start, position))
+        start = -1
+        open_dos = 0
+    if start >= 0:
+        # Unterminated, its parse fails like the whole code's would
+        spans.append((start, len(code)))
+    return spans, comments
+
+
+def _next_code_token(lexer: Lexer, position: int) -> Token:
+    lexer.position = position
+    token = lexer.next_token()
+    while token.type in (TokenType.LINE_COMMENT, TokenType.BLOCK_COMMENT):
+        token = lexer.next_token()
+    return token
+
+
+def _covers(statements: List[Statement], lexer: Lexer, start: int, end: int) -> bool:
+    # Whether the code from start to end parsed on its own is a single statement running from the
+    # first token to the end, as it has to be if the statement boundaries were judged right
+    if len(statements) != 1:
+        return False
+    lexer.position = start
+    first_token_end = lexer.next_token().position - start
+    return statements[0]._begin_pos == first_token_end and statements[0]._end_pos == end - start + 1
+
+
+def _place(root: ASTNode, offset: int, end: int, follower: int):
+    # Moves positions relative to a statement parsed on its own to where the statement is. Its
+    # parse ended at end, where the parse of the whole code has the token that follows it.
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        node._begin_pos = follower if node._begin_pos == end else node._begin_pos + offset
+        node._end_pos = follower if node._end_pos == end else node._end_pos + offset
+        stack.extend(node.children())
@@ -0,0 +1,352 @@
+from functools import lru_cache
+from io import StringIO
+from typing import TYPE_CHECKING, Iterator, List, Optional, Sequence, TextIO, Tuple, Union, cast
+
+from comment_anchors import CommentAnchors, attach_comments
+from lexer import Token
+from visitor import Visitor
+
+if TYPE_CHECKING:
+    from ast_nodes import (ArrayAccess, ASTNode, BinaryOperation, CaseStatement, CommaOperation, CompoundStatement,
+                           ForStatement, FunctionCall, FunctionDeclaration, Identifier, IfStatement, Literal,
+                           MemberAccess, PointerAccess, Program, Statement, SwitchStatement, TernaryOperation,
+                           UnaryOperation, WhileStatement)
+
+INDENT = '    '
+
+
+def code_string(node: 'ASTNode', comments: Sequence[Token] = (), cached: bool = False) -> str:
+    stream = StringIO()
+    write_code(node, stream, comments, cached)
+    return stream.getvalue()
+
+
+def write_code(node: 'ASTNode', stream: TextIO, comments: Sequence[Token] = (), cached: bool = False):
+    Printer(stream, comments, cached).write(node)
+
+
+def expression_string(node: 'ASTNode') -> str:
+    # Operands nest as deep as an operator chain is long, so an expression is written from a stack
+    # of the parts still to write of each operand being written, rather than by str() of each one
+    text: List[str] = []
+    write = text.append
+    stack: List[Iterator[Part]] = [iter((node,))]
+    handlers = _ExpressionParts._handlers
+    while stack:
+        for part in stack[-1]:
+            if part.__class__ is str:
+                write(part)  # type: ignore[arg-type]
+                continue
+            handler = handlers.get(part.__class__) or _ExpressionParts._handler(part.__class__)
+            parts = handler(_EXPRESSION_PARTS, part)
+            if parts.__class__ is str:
+                write(parts)
+            else:
+                stack.append(iter(parts))
+                break
+        else:
+            stack.pop()
+    return ''.join(text)
+
+
+# Writes the code of a tree in one walk. Lines go to the stream as soon as they are complete, with
+# the indentation of the blocks around them, instead of every block indenting the whole text of the
+# blocks inside it once more, so the work is linear in the size of the output. Expressions are
+# written with str(), which is expression_string() for them. Comments, when given, are written
+# where comment_anchors.attach_comments anchors them, as their anchor statements are written. With
+# cached, statements below the root are written from the text kept in them, and keep their text
+# when they have none, see ast_nodes.caching_renders().
+class Printer(Visitor):
+    def __init__(self, stream: TextIO, comments: Sequence[Token] = (), cached: bool = False):
+        self.stream: TextIO = stream
+        self.comments: Sequence[Token] = comments
+        self.cached: bool = cached
+        # Indentation of lines started from here on
+        self._indent: str = ''
+        self._line: List[str] = []
+        # Indentation the current line started with, None until something is written to it
+        self._line_indent: Optional[str] = None
+        # Comments that go at the end of the current line
+        self._line_comments: List[Token] = []
+        self._anchors: Optional[CommentAnchors] = None
+
+    def write(self, node: 'ASTNode'):
+        # Writes node as the whole output, without a newline at the end
+        if self.comments:
+            self._anchors = attach_comments(node, self.comments)
+        self.dispatch(node)
+        if self._anchors is not None and not _is_a(node.__class__, 'Program'):
+            # The comments after everything else, which only a Program writes itself
+            for comment in self._anchors.closing.get(id(node), ()):
+                self._newline()
+                self._comment(comment)
+        self._end_line()
+
+    def _text(self, text: str):
+        if self._line_indent is None:
+            self._line_indent = self._indent
+        if '\n' not in text:
+            self._line.append(text)
+            return
+        # Only string literals and cached statements hold line breaks, every line after the first
+        # is indented like the current one
+        first, rest = text.split('\n', 1)
+        self._line.append(first)
+        self._newline()
+        indent = self._indent
+        middle, line_break, last = rest.rpartition('\n')
+        if line_break:
+            self.stream.write(indent + middle.replace('\n', '\n' + indent) + '\n' if indent else middle + '\n')
+        self._line_indent = indent
+        self._line.append(last)
+
+    def _newline(self):
+        self._end_line()
+        self.stream.write('\n')
+
+    def _end_line(self):
+        # A line nothing was written to, like the inside of an empty block, gets the indentation
+        # of where it ends
+        line = (self._indent if self._line_indent is None else self._line_indent) + ''.join(self._line)
+        if self._line_comments:
+            line += ' ' + ' '.join(comment.value for comment in self._line_comments)
+            self._line_comments.clear()
+        self.stream.write(line)
+        self._line.clear()
+        self._line_indent = None
+
+    def _comment(self, comment: Token):
+        # The lines after the first of a block comment are written as they were in the code
+        first, *rest = comment.value.split('\n')
+        self._text(first)
+        for line in rest:
+            self._newline()
+            self._line_indent = ''
+            self._line.append(line)
+
+    def _statement(self, statement: 'Statement'):
+        if self.cached and (self._anchors is None or id(statement) not in self._anchors.enclosing):
+            # Its lines are all indented the same, like the lines of a string literal
+            text = statement._rendered
+            if text is None:
+                statement._rendered = text = code_string(statement, cached=True)
+            self._text(text)
+            return
+        self._before(statement)
+        self.dispatch(statement)
+        self._after(statement)
+
+    def _before(self, statement: 'Statement'):
+        # At the start of a new line, where the statement is about to be written
+        if self._anchors is None:
+            return
+        for comment in self._anchors.leading.get(id(statement), ()):
+            self._comment(comment)
+            self._newline()
+        self._line_comments.extend(self._anchors.first_line.get(id(statement), ()))
+
+    def _after(self, statement: 'Statement'):
+        if self._anchors is not None:
+            self._line_comments.extend(self._anchors.last_line.get(id(statement), ()))
+
+    def _closing(self, node: 'ASTNode') -> Sequence[Token]:
+        if self._anchors is None:
+            return ()
+        return self._anchors.closing.get(id(node), ())
+
+    def _indented(self, statement: 'Statement'):
+        # A branch or loop body goes one level deeper, unless it is a block, whose braces line up
+        # with the statement it belongs to
+        if _is_a(statement.__class__, 'CompoundStatement'):
+            self._statement(statement)
+        else:
+            self._deeper(statement)
+
+    def _deeper(self, statement: 'Statement'):
+        outer = self._indent
+        self._indent = outer + INDENT
+        self._statement(statement)
+        self._indent = outer
+
+    def generic_visit(self, node: 'ASTNode'):
+        self._text(str(node))
+
+    def visit_Program(self, node: 'Program'):
+        for number, statement in enumerate(node.statements):
+            if number:
+                self._newline()
+                self._newline()
+            self._statement(statement)
+        for number, comment in enumerate(self._closing(node)):
+            if number or node.statements:
+                self._newline()
+            self._comment(comment)
+
+    def visit_FunctionDeclaration(self, node: 'FunctionDeclaration'):
+        params = ', '.join(str(param) for param in node.parameters)
+        self._text(str(node.return_type))
+        if node.calling_convention:
+            self._text(f" {node.calling_convention}")
+        self._text(f" {node.name}({params})")
+        if node.body is not None:
+            self._newline()
+            self._statement(node.body)
+        else:
+            self._text(";")
+
+    def visit_CompoundStatement(self, node: 'CompoundStatement'):
+        self._text('{')
+        for statement in node.statements:
+            self._newline()
+            # Labels stand at the level of the braces
+            if _is_a(statement.__class__, 'LabelStatement'):
+                self._statement(statement)
+            else:
+                self._deeper(statement)
+        if not node.statements:
+            self._newline()
+        self._closing_lines(node)
+        self._newline()
+        self._text('}')
+
+    def _closing_lines(self, node: 'ASTNode'):
+        outer = self._indent
+        self._indent = outer + INDENT
+        for comment in self._closing(node):
+            self._newline()
+            self._comment(comment)
+        self._indent = outer
+
+    def visit_IfStatement(self, node: 'IfStatement'):
+        self._text(f"if ({node.condition})")
+        self._newline()
+        self._indented(node.then_branch)
+        current_else = node.else_branch
+        # An else if is written as part of the chain, its comments with it
+        chain = []
+        while current_else is not None and _is_a(current_else.__class__, 'IfStatement'):
+            self._newline()
+            self._before(current_else)
+            self._text(f"else if ({current_else.condition})")
+            self._newline()
+            self._indented(current_else.then_branch)
+            chain.append(current_else)
+            current_else = current_else.else_branch
+        if current_else is not None:
+            self._newline()
+            self._text("else")
+            self._newline()
+            self._indented(current_else)
+        for else_if in reversed(chain):
+            self._after(else_if)
+
+    def visit_WhileStatement(self, node: 'WhileStatement'):
+        self._text(f"while ({node.condition})")
+        self._newline()
+        self._statement(node.body)
+
+    def visit_ForStatement(self, node: 'ForStatement'):
+        init_str = str(node.initializer) if node.initializer is not None else ''
+        cond_str = str(node.condition) if node.condition is not None else ''
+        incr_str = str(node.increment) if node.increment is not None else ''
+        self._text(f"for ({init_str} {cond_str}; {incr_str})")
+        self._newline()
+        self._indented(node.body)
+
+    def visit_SwitchStatement(self, node: 'SwitchStatement'):
+        self._text(f"switch ({node.expression}) {{")
+        for case in node.cases:
+            self._newline()
+            self._indented(case)
+        if not node.cases:
+            self._newline()
+        self._closing_lines(node)
+        self._newline()
+        self._text('}')
+
+    def visit_CaseStatement(self, node: 'CaseStatement'):
+        self._text("default:" if node.is_default_statement() else f"case {node.value}:")
+        for statement in node.statements:
+            self._newline()
+            # Labels stand at the level of the case label
+            if _is_a(statement.__class__, 'LabelStatement'):
+                self._statement(statement)
+            else:
+                self._indented(statement)
+
+
+Part = Union[str, 'ASTNode']
+Parts = Union[str, Tuple[Part, ...]]
+
+
+# What an expression is written as: its text, or its parts in order, text and the operands to
+# be written in their place
+class _ExpressionParts(Visitor):
+    def generic_visit(self, node: 'ASTNode') -> Parts:
+        # Anything else inside an expression writes itself
+        return str(node)
+
+    def visit_Identifier(self, node: 'Identifier') -> Parts:
+        return node.name
+
+    def visit_Literal(self, node: 'Literal') -> Parts:
+        return node.value
+
+    def visit_BinaryOperation(self, node: 'BinaryOperation') -> Parts:
+        left, right = node.left, node.right
+        operator = f" {node.operator} "
+        if _parenthesized(node, left):
+            if _parenthesized(node, right):
+                return ('(', left, ')', operator, '(', right, ')')
+            return ('(', left, ')', operator, right)
+        if _parenthesized(node, right):
+            return (left, operator, '(', right, ')')
+        return (left, operator, right)
+
+    def visit_CommaOperation(self, node: 'CommaOperation') -> Parts:
+        return (node.left, ', ', node.right)
+
+    def visit_UnaryOperation(self, node: 'UnaryOperation') -> Parts:
+        if node.is_postfix:
+            return (node.operand, node.operator)
+        if _is_a(node.operand.__class__, 'BinaryOperation'):
+            return (node.operator, '(', node.operand, ')')
+        return (node.operator, node.operand)
+
+    def visit_ArrayAccess(self, node: 'ArrayAccess') -> Parts:
+        return (node.array, '[', node.index, ']')
+
+    def visit_MemberAccess(self, node: 'MemberAccess') -> Parts:
+        return (node.object, '.', node.member)
+
+    def visit_PointerAccess(self, node: 'PointerAccess') -> Parts:
+        return (node.pointer, '->', node.member)
+
+    def visit_TernaryOperation(self, node: 'TernaryOperation') -> Parts:
+        return ('(', node.condition, ' ? ', node.true_branch, ' : ', node.false_branch, ')')
+
+    def visit_FunctionCall(self, node: 'FunctionCall') -> Parts:
+        if not node.arguments:
+            return (node.function, '()')
+        parts: List[Part] = ['(', node.function, ')('] if _is_a(node.function.__class__, 'UnaryOperation') else [node.function, '(']
+        for number, argument in enumerate(node.arguments):
+            if number:
+                parts.append(', ')
+            parts.append(argument)
+        parts.append(')')
+        return tuple(parts)
+
+
+def _parenthesized(operation: 'BinaryOperation', operand: 'ASTNode') -> bool:
+    operand_class = operand.__class__
+    return _is_a(operand_class, 'BinaryOperation') and (_is_a(operand_class, 'CommaOperation')
+                                                        or operation._needs_parentheses(cast('BinaryOperation', operand)))
+
+
+_EXPRESSION_PARTS = _ExpressionParts()
+
+
+@lru_cache(maxsize=None)
+def _is_a(node_class: type, class_name: str) -> bool:
+    # isinstance() by name, ast_nodes imports this module
+    return any(base.__name__ == class_name for base in node_class.__mro__)
@@ -1,9 +1,166 @@
-from typing import Optional
+from typing import Callable, Dict, List, Optional, Tuple
 from ast_nodes import ASTNode, FunctionCall, FunctionDeclaration, Identifier, MemberAccess, PointerAccess, CommaOperation, BinaryOperation
+from visitor import Transformer, note_field_change, walk_preorder
+
+
+RuleFunction = Callable[[ASTNode], Optional[ASTNode]]
+
+
+class Rule:
+    def __init__(self, function: RuleFunction, node_classes: Tuple[type, ...]):
+        self.function: RuleFunction = function
+        self.node_classes: Tuple[type, ...] = node_classes
+
+
+# Rules applied by apply_refactorings, in order. A rule is only called for nodes of its classes.
+RULES: List[Rule] = []
+
+
+def rule(*node_classes: type) -> Callable[[RuleFunction], RuleFunction]:
+    def register(function: RuleFunction) -> RuleFunction:
+        RULES.append(Rule(function, node_classes))
+        return function
+    return register
+
+
+class RuleEngine(Transformer):
+    # Runs every rule in a single traversal, looking up the rules for each node class once.
+    # A rule may return a replacement, which ends that node's visit, or change the node in place
+    # and return it, which lets the remaining rules and the node's children be visited too.
+    # In-place changes are found by comparing the node's fields before and after the rule, and get
+    # the same bookkeeping as replacements.
+    def __init__(self, rules: List[Rule]):
+        self.rules: List[Rule] = rules
+        self._rules_by_class: Dict[type, List[RuleFunction]] = {}
+        # Rule calls that changed something so far, replacements included
+        self.changes: int = 0
+
+    def dispatch(self, node: ASTNode) -> Optional[ASTNode]:
+        functions = self._rules_by_class.get(node.__class__)
+        if functions is None:
+            functions = [rule.function for rule in self.rules if issubclass(node.__class__, rule.node_classes)]
+            self._rules_by_class[node.__class__] = functions
+        for function in functions:
+            before = _field_values(node)
+            result = function(node)
+            replaced = result is not None and result is not node
+            if _note_field_changes(node, before) or replaced:
+                self.changes += 1
+            if replaced:
+                return result
+        return None
+
+
+def _field_values(node: ASTNode) -> List:
+    # What node's fields hold, with lists copied so that changes made to them in place show
+    values = []
+    for field in node._child_fields + node._value_fields:
+        value = getattr(node, field)
+        values.append(value.copy() if value.__class__ is list else value)
+    return values
+
+
+def _note_field_changes(node: ASTNode, before: List) -> bool:
+    # Does the bookkeeping for the fields that differ from the values _field_values gave. Child
+    # nodes are compared by identity, the other fields by value.
+    changed = False
+    child_count = len(node._child_fields)
+    for position, field in enumerate(node._child_fields + node._value_fields):
+        old_value, value = before[position], getattr(node, field)
+        if position < child_count:
+            if value.__class__ is list:
+                same = old_value.__class__ is list and len(old_value) == len(value) and \
+                    all(old is new for old, new in zip(old_value, value))
+            else:
+                same = old_value is value
+        else:
+            same = old_value == value
+        if not same:
+            note_field_change(node, field, old_value)
+            changed = True
+    return changed
+
+
+class WorklistEngine(RuleEngine):
+    # Runs the rules to a fixed point. After one full traversal only the places where something was
+    # rewritten are visited again: a replacement's new subtree, a node changed in place, and their
+    # ancestors, since a rule may match a node because of what changed below it. Each generation
+    # is handled top-down and skips nodes that an earlier rewrite in it has cut off the tree. The
+    # root may be rewritten too, so run() returns the root to use afterwards, and the number of
+    # generations it took is kept in generations.
+    def run(self, root: ASTNode, max_iterations: Optional[int] = None) -> ASTNode:
+        self._rewritten: List[Tuple[ASTNode, bool]] = []
+        root = self._new_root(root, self.visit(root))
+        self.generations = 1
+        while self._rewritten and (max_iterations is None or self.generations < max_iterations):
+            worklist = self._worklist()
+            self._rewritten = []
+            for node in worklist:
+                if not _is_attached(node, root):
+                    continue
+                result = self.dispatch(node)
+                if result is None:
+                    continue
+                if node.parent is None:
+                    root = self._new_root(node, result)
+                else:
+                    node.parent.replace_child(node, result)
+                    node.parent = None
+            self.generations += 1
+        return root
+
+    @staticmethod
+    def _new_root(root: ASTNode, result: Optional[ASTNode]) -> ASTNode:
+        # A rule may return a node from inside the old root, which has to be cut loose from it
+        if result is None or result is root:
+            return root
+        result.parent = None
+        return result
+
+    def dispatch(self, node: ASTNode) -> Optional[ASTNode]:
+        changes_before = self.changes
+        result = super().dispatch(node)
+        if result is not None:
+            self._rewritten.append((result, True))
+        elif self.changes != changes_before:
+            self._rewritten.append((node, False))
+        return result
+
+    def _worklist(self) -> List[ASTNode]:
+        nodes: Dict[int, ASTNode] = {}
+        for node, replaced in self._rewritten:
+            for changed in (walk_preorder(node) if replaced else (node,)):
+                nodes[id(changed)] = changed
+            ancestor = node.parent
+            while ancestor is not None and id(ancestor) not in nodes:
+                nodes[id(ancestor)] = ancestor
+                ancestor = ancestor.parent
+        depths: Dict[int, int] = {}
+        return sorted(nodes.values(), key=lambda node: _depth(node, depths))
+
+
+def _depth(node: ASTNode, depths: Dict[int, int]) -> int:
+    path = []
+    while node is not None and id(node) not in depths:
+        path.append(node)
+        node = node.parent
+    depth = -1 if node is None else depths[id(node)]
+    for node in reversed(path):
+        depth += 1
+        depths[id(node)] = depth
+    return depth
+
+
+def _is_attached(node: ASTNode, root: ASTNode) -> bool:
+    # Replaced nodes get their parent cleared, so anything below one no longer reaches the root
+    while node.parent is not None:
+        node = node.parent
+    return node is root
 
 
 # void __thiscall function(void* this) -> void function()
 # void __cdecl function() -> void function()
+@rule(FunctionDeclaration)
 def remove_calling_convention(node: ASTNode) -> Optional[ASTNode]:
     if isinstance(node, FunctionDeclaration):
         calling_convention = node.calling_convention
@@ -14,6 +171,7 @@ def remove_calling_convention(node: ASTNode) -> Optional[ASTNode]:
     return None
 
 # object->vtbl->function(object) -> object->function()
+@rule(FunctionCall)
 def remove_vtbl_and_first_arg(node: ASTNode) -> Optional[ASTNode]:
     if isinstance(node, FunctionCall):
         if isinstance(node.function, PointerAccess) and isinstance(node.function.pointer, PointerAccess):
@@ -29,6 +187,7 @@ def remove_vtbl_and_first_arg(node: ASTNode) -> Optional[ASTNode]:
     return None
 
 # this->data.baseProcess -> this->baseProcess
+@rule(MemberAccess)
 def remove_data_arrow(node: ASTNode) -> Optional[ASTNode]:
     if isinstance(node, MemberAccess):
         if isinstance(node.object, PointerAccess) and isinstance(node.object.member, Identifier) and node.object.member.name == 'data':
@@ -36,6 +195,7 @@ def remove_data_arrow(node: ASTNode) -> Optional[ASTNode]:
     return None
 
 # (v1 = 1, v1 == 1) -> 1 == 1
+@rule(CommaOperation)
 def inline_comma_assignment(node: ASTNode) -> Optional[ASTNode]:
     if isinstance(node, CommaOperation):
         left = node.left
@@ -44,26 +204,18 @@ def inline_comma_assignment(node: ASTNode) -> Optional[ASTNode]:
             assigned_var = left.left
             assigned_value = left.right
             if isinstance(assigned_var, Identifier):
-                # Replace all occurrences of the assigned variable in the right operand
+                # Replace all occurrences of the assigned variable in the right operand, each with
+                # a copy of its own, so that later rewrites reach every one of them
                 def replace_var(n: ASTNode) -> Optional[ASTNode]:
                     if isinstance(n, Identifier) and n.name == assigned_var.name:
-                        return assigned_value
+                        return assigned_value.deep_copy()
                     return None
                 
                 new_right = right.transform(replace_var)
                 return new_right
     return None
 
-def apply_refactorings(ast: ASTNode) -> ASTNode:
-    # Apply the transformations to the AST
-    while True:
-        ast_before = str(ast)
-        ast.transform(remove_vtbl_and_first_arg)
-        ast.transform(remove_data_arrow)
-        ast.transform(inline_comma_assignment)
-        ast.transform(remove_calling_convention)
-        ast_after = str(ast)
-        
-        if ast_before == ast_after:
-            break
-    return ast
\ No newline at end of file
+def apply_refactorings(ast: ASTNode, max_iterations: Optional[int] = None, rules: Optional[List[Rule]] = None) -> ASTNode:
+    # Apply the transformations until nothing changes, or for at most max_iterations generations.
+    # Returns the refactored tree, which is a new node if the rules rewrote ast itself.
+    return WorklistEngine(RULES if rules is None else rules).run(ast, max_iterations)
@@ -0,0 +1,92 @@
+import inspect
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Type
+
+import ast_nodes
+from ast_nodes import ASTNode
+from lexer import Token, TokenType
+
+
+# A compact, picklable form of an AST made only of tuples, lists, strings and ints.
+# Every node and token becomes a tuple tagged with its class name followed by its constructor
+# arguments, and lists stay lists. This is far cheaper to send between processes than the
+# object graph itself, which pickles every instance attribute and parent link.
+_TOKEN_TAG = 'Token'
+
+NODE_CLASSES: Dict[str, Type[ASTNode]] = {
+    name: cls for name, cls in vars(ast_nodes).items()
+    if inspect.isclass(cls) and issubclass(cls, ASTNode) and not inspect.isabstract(cls)
+}
+_fields_cache: Dict[Type[ASTNode], Tuple[str, ...]] = {}
+# What encode() turns nodes, tokens and lists into, everything else is stored as it is
+_ENCODED_CLASSES = (tuple, list)
+
+
+def constructor_fields(cls: Type[ASTNode]) -> Tuple[str, ...]:
+    fields = _fields_cache.get(cls)
+    if fields is None:
+        parameters = list(inspect.signature(cls.__init__).parameters)[1:]
+        fields = tuple('_' + name if name in ('begin_pos', 'end_pos') else name for name in parameters)
+        _fields_cache[cls] = fields
+    return fields
+
+
+def encode(value: Any) -> Any:
+    # Without recursion, expressions can nest deeper than the stack. Each frame holds the parts of
+    # a node or list still to encode, the ones encoded so far and the node's class name, or None
+    # for a list.
+    frames: List[Tuple[Iterator[Any], List[Any], Optional[str]]] = [(iter((value,)), [], None)]
+    while True:
+        parts, encoded, tag = frames[-1]
+        for part in parts:
+            if isinstance(part, ASTNode):
+                cls = type(part)
+                frames.append((iter([getattr(part, field) for field in constructor_fields(cls)]), [], cls.__name__))
+                break
+            if isinstance(part, list):
+                frames.append((iter(part), [], None))
+                break
+            if isinstance(part, Token):
+                part = (_TOKEN_TAG, part.type.value, part.value, part.line, part.column, part.position)
+            encoded.append(part)
+        else:
+            frames.pop()
+            if not frames:
+                return encoded[0]
+            frames[-1][1].append(encoded if tag is None else (tag,) + tuple(encoded))
+
+
+def decode(value: Any) -> Any:
+    # Without recursion, like encode. Each frame holds the parts of a node or list still to decode,
+    # the ones decoded so far and the node's class, or None for a list.
+    frames: List[Tuple[Iterator[Any], List[Any], Optional[Type[ASTNode]]]] = [(iter((value,)), [], None)]
+    while True:
+        parts, decoded, cls = frames[-1]
+        for part in parts:
+            # Most fields are plain strings and ints, which are passed through as they are
+            if part.__class__ not in _ENCODED_CLASSES:
+                decoded.append(part)
+                continue
+            if part.__class__ is list:
+                frames.append((iter(part), [], None))
+                break
+            tag = part[0]
+            if tag == _TOKEN_TAG:
+                _, token_type, token_value, line, column, position = part
+                decoded.append(Token(TokenType(token_type), token_value, line, column, position))
+                continue
+            part_class = NODE_CLASSES.get(tag)
+            if part_class is None:
+                raise ValueError(f"Unknown node class {tag}")
+            frames.append((iter(part[1:]), [], part_class))
+            break
+        else:
+            frames.pop()
+            if cls is None:
+                result: Any = decoded
+            else:
+                result = cls(*decoded)
+                for child in result.children():
+                    child.parent = result
+            if not frames:
+                return result[0]
+            frames[-1][1].append(result)
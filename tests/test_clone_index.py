@@ -0,0 +1,34 @@
+import random
+import re
+from typing import List, cast
+
+import pytest
+
+from ast_nodes import FunctionDeclaration
+from benchmarks import _clone, generate_corpus
+from hex_rays_parser import Parser
+
+pytest.importorskip('numpy')
+from clone_index import CloneIndex  # noqa: E402
+
+
+def test_clones_find_their_originals(tmp_path):
+    code = generate_corpus(300)
+    rng = random.Random(0)
+    originals = rng.sample(range(300), 20)
+    # Functions start at the start of a line, their statements are indented
+    sources = re.split(r'\n\n(?=\S)', code)
+    clone_code = '\n\n'.join(_clone(sources[original], number, rng) for number, original in enumerate(originals))
+    functions = cast(List[FunctionDeclaration], Parser(code=code).parse().statements)
+    clones = cast(List[FunctionDeclaration], Parser(code=clone_code).parse().statements)
+    index = CloneIndex()
+    for function in functions:
+        index.add(function)
+    clone_keys = [index.add(clone) for clone in clones]
+    found = sum(functions[original].name in [key for key, _ in index.similar(clone_key)]
+                for original, clone_key in zip(originals, clone_keys))
+    assert found >= 18
+    path = str(tmp_path / 'clones.idx')
+    index.save(path)
+    loaded = CloneIndex.load(path)
+    assert all(loaded.similar(key) == index.similar(key) for key in clone_keys)
@@ -0,0 +1,22 @@
+import pytest
+
+import binary_ast
+from ast_nodes import FunctionCall, Identifier
+from benchmarks import generate_corpus
+from hex_rays_parser import Parser
+
+pytest.importorskip('numpy')
+from flat_ast import FlatAST  # noqa: E402
+
+
+def test_round_trip():
+    program = Parser(code=generate_corpus(50)).parse()
+    assert binary_ast.dumps(FlatAST.from_program(program).to_program()) == binary_ast.dumps(program)
+
+
+def test_calls_to():
+    program = Parser(code=generate_corpus(50)).parse()
+    flat = FlatAST.from_program(program)
+    calls = [call for call in program.nodes_of_class(FunctionCall) if isinstance(call.function, Identifier)]
+    for name in {call.function.name for call in calls}:
+        assert len(flat.calls_to(name)) == sum(call.function.name == name for call in calls)
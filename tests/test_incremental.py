@@ -0,0 +1,42 @@
+import random
+
+import binary_ast
+from ast_nodes import FunctionDeclaration
+from benchmarks import generate_corpus
+from hex_rays_parser import Parser
+from incremental import reparse
+
+
+def test_reparse_matches_full_parse():
+    code = generate_corpus(30)
+    program = Parser(code=code).parse()
+    rng = random.Random(0)
+    edit_count = 0
+    for _ in range(40):
+        functions = [statement for statement in program.statements if isinstance(statement, FunctionDeclaration)]
+        function = rng.choice(functions)
+        edit = rng.randint(0, 3)
+        if edit == 0:
+            # A statement at the top of a body
+            start = end = function.body._begin_pos
+            text = ' v0 = 1;'
+        elif edit == 1:
+            # A declaration between functions
+            start = end = code.rfind('\n\n', 0, function._begin_pos) + 2
+            text = 'int g_counter;\n'
+        elif edit == 2:
+            # Text replaced inside a function, comments included
+            start = rng.randint(function._begin_pos, function._end_pos - 1)
+            end = start + rng.randint(0, 3)
+            text = rng.choice(['', ' ', '1', '/* c */', '// c\n'])
+        else:
+            start = end = rng.randint(0, len(code))
+            text = '\n'
+        try:
+            Parser(code=code[:start] + text + code[end:]).parse()
+        except Exception:
+            continue
+        code = reparse(program, code, start, end, text)
+        assert binary_ast.dumps(program) == binary_ast.dumps(Parser(code=code).parse())
+        edit_count += 1
+    assert edit_count >= 20
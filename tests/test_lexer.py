@@ -0,0 +1,29 @@
+import sys
+from typing import List, Tuple, Type
+
+from benchmarks import generate_corpus
+from lexer import CharLexer, Lexer, TokenBuffer, TokenType
+
+
+def _tokens(lexer_class: Type[CharLexer], code: str) -> List[Tuple]:
+    lexer = lexer_class(code)
+    tokens = []
+    while True:
+        token = lexer.next_token()
+        tokens.append((token.type, token.value, token.line, token.column, token.position))
+        if token.type == TokenType.EOF:
+            return tokens
+
+
+def test_lexer_matches_char_lexer():
+    code = generate_corpus(100) + "x = 'c' + \"\\t\" + 0x1Fu + 1.5e3; /* a\nb */ y = a->b; // é\n"
+    # CharLexer recurses once per skipped whitespace character
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 10000))
+    assert _tokens(Lexer, code) == _tokens(CharLexer, code)
+
+
+def test_token_buffer_matches_lexer():
+    code = generate_corpus(50)
+    buffer = TokenBuffer(code)
+    tokens = [buffer.token(index) for index in range(len(buffer))]
+    assert [(token.type, token.value, token.line, token.column, token.position) for token in tokens] == _tokens(Lexer, code)
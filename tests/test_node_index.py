@@ -0,0 +1,43 @@
+from typing import cast
+
+from ast_nodes import ASTNode, FunctionCall, Identifier, Program
+from benchmarks import generate_corpus
+from hex_rays_parser import Parser
+from node_index import NodeIndex
+from refactorings import apply_refactorings
+from visitor import walk_preorder
+
+
+def _check_index(program: Program):
+    # The index kept up to date holds the same nodes as one built from scratch
+    for node in walk_preorder(program):
+        assert all(child.parent is node for child in node.children()), node
+    updated = cast(NodeIndex, program.index)
+    rebuilt = NodeIndex(program)
+    assert {id(node) for node in updated.nodes_of_class(ASTNode)} == {id(node) for node in rebuilt.nodes_of_class(ASTNode)}
+    # Every name either index has, stale ones included
+    names = {name for index in (updated, rebuilt) for name, nodes in index._by_name.items() if nodes}
+    for name in names:
+        assert {id(node) for node in updated.identifiers_named(name)} == {id(node) for node in rebuilt.identifiers_named(name)}, name
+
+
+def test_index_matches_find_nodes():
+    code = generate_corpus(50)
+    program = Parser(code=code).parse()
+    indexed = Parser(code=code, index=True).parse()
+    assert len(indexed.nodes_of_class(FunctionCall)) == len(program.nodes_of_class(FunctionCall)) > 0
+    assert len(indexed.identifiers_named('this')) == len(program.identifiers_named('this')) > 0
+
+
+def test_index_after_refactoring():
+    reused = ("int f ( ) { for ( ; ; ) { ( ( this ) ) ( a != X::Y || X::Y % a ) ; a = this -> m != 'c' = f ( ) < "
+              "a -> data , this . vtbl >= a % this -> vtbl -> M ( this , a ) ; } }")
+    for code in (generate_corpus(50), reused):
+        _check_index(cast(Program, apply_refactorings(Parser(code=code, index=True).parse())))
+
+
+def test_index_after_rename():
+    program = Parser(code="int f() { a = b; }", index=True).parse()
+    cast(Identifier, program.identifiers_named('a')[0]).assign('name', 'c')
+    assert program.identifiers_named('a') == [] and len(program.identifiers_named('c')) == 1
+    _check_index(program)
@@ -0,0 +1,33 @@
+import binary_ast
+from benchmarks import _chain_code, generate_corpus
+from hex_rays_parser import Parser
+from parse_cache import CacheStats, ParseCache
+
+
+def test_cache_matches_parser(tmp_path):
+    code = generate_corpus(50)
+    # The next snapshot: a tenth of the functions changed, the rest unchanged but moved
+    next_code = '\n}\n\n'.join(function.replace('return', 'return 1 +') if index % 10 == 0 else function
+                                for index, function in enumerate(code.split('\n}\n\n')))
+    cache = ParseCache(str(tmp_path))
+    assert binary_ast.dumps(cache.parse(code)) == binary_ast.dumps(Parser(code=code).parse())
+    cache.stats = CacheStats()
+    assert binary_ast.dumps(cache.parse(next_code)) == binary_ast.dumps(Parser(code=next_code).parse())
+    assert cache.stats.hits > 0 and cache.stats.misses > 0
+
+
+def test_braceless_else(tmp_path):
+    # An 'else' after a ';' or a '}' continues the statement
+    cache = ParseCache(str(tmp_path))
+    for code in ("int f() { return 0; }\nif (a) x = 1; else y = 2;\n",
+                 "int f() { return 0; }\nfor (;;) if (a) x = 1; else { y = 2; }\n"):
+        program = cache.parse(code)
+        assert len(program.statements) == 2
+        assert binary_ast.dumps(program) == binary_ast.dumps(Parser(code=code).parse())
+
+
+def test_deep_tree_is_cached(tmp_path):
+    cache = ParseCache(str(tmp_path))
+    chain_data = binary_ast.dumps(Parser(code=_chain_code()).parse())
+    assert all(binary_ast.dumps(cache.parse(_chain_code())) == chain_data for _ in range(2))
+    assert cache.stats.hits == 1
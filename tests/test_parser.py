@@ -0,0 +1,69 @@
+import binary_ast
+from benchmarks import _TrialParser, generate_corpus
+from hex_rays_parser import Parser, StatementKind
+from lexer import TokenBuffer
+
+
+class _CheckedParser(Parser):
+    # Compares every lookahead classification with the one trial parsing gives
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checked = 0
+        self.mismatches = 0
+
+    def classify_statement(self) -> StatementKind:
+        kind = super().classify_statement()
+        self.checked += 1
+        if kind != self._classify_by_trial():
+            self.mismatches += 1
+        return kind
+
+
+def test_classifier_matches_trial_parsing():
+    parser = _CheckedParser(code=generate_corpus(100))
+    parser.parse()
+    assert parser.checked > 0 and parser.mismatches == 0
+
+
+def test_parsers_give_the_same_tree():
+    code = generate_corpus(100)
+    expected = binary_ast.dumps(Parser(code=code).parse())
+    tokens = TokenBuffer(code)
+    for parser in (Parser(tokens=tokens), Parser(code=code, memoize=True), _TrialParser(code=code),
+                   _TrialParser(tokens=tokens, memoize=True), Parser(code=code, hash_consing=True)):
+        assert binary_ast.dumps(parser.parse()) == expected
+
+
+def test_iter_statements_matches_parse():
+    code = generate_corpus(50)
+    program = Parser(code=code).parse()
+    statements = []
+    comments = []
+    for statement, statement_comments in Parser(tokens=TokenBuffer(code)).iter_statements():
+        statements.append(statement)
+        comments.extend(statement_comments)
+    assert [str(statement) for statement in statements] == [str(statement) for statement in program.statements]
+    assert [comment.value for comment in comments] == [comment.value for comment in program.comments]
+
+
+def test_trailing_comments():
+    parser = Parser(code="// a\n/* b */\n")
+    assert list(parser.iter_statements()) == []
+    assert [comment.value for comment in parser.trailing_comments] == ['// a', '/* b */']
+    assert [comment.value for comment in Parser(code="// a\n/* b */\n").parse().comments] == ['// a', '/* b */']
+    # After the last statement they belong to it
+    parser = Parser(code="int f() {}\n// after\n")
+    assert [[comment.value for comment in comments] for _, comments in parser.iter_statements()] == [['// after']]
+    assert parser.trailing_comments == []
+
+
+def test_deep_expressions():
+    # Nesting that used to take one Python frame per level
+    depth = 20000
+    shapes = ['x = ' + '(' * depth + 'a' + ')' * depth + ';',
+              'x = ' + ' && '.join(f"a{i}" for i in range(depth)) + ';',
+              'x = ' + '-' * depth + 'a;',
+              'x = ' + 'f(' * depth + 'a' + ')' * depth + ';',
+              ' = '.join(f"a{i}" for i in range(depth)) + ';']
+    for code in shapes:
+        assert len(Parser(code=code).parse().statements) == 1
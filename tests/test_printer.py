@@ -0,0 +1,88 @@
+import random
+import sys
+from typing import cast
+
+from ast_nodes import Identifier, Operand, caching_renders
+from benchmarks import _chain_code, _reindented_str, _str_fixed_point, _uncommented_program, generate_corpus
+from comment_anchors import attach_comments
+from hex_rays_parser import Parser
+from lexer import TokenBuffer
+from refactorings import apply_refactorings
+from visitor import walk_preorder
+
+
+def test_deep_expression():
+    # Expressions are printed without recursion, however deep they nest
+    assert str(Parser(code=_chain_code()).parse()) == _chain_code().rstrip('\n')
+
+
+def test_matches_reindenting_str():
+    nested = f"void __cdecl Nested(int a)\n{{\n{'if (a) { ' * 100}a = 1;{' }' * 100}\n}}\n"
+    # The re-indenting str() recurses once per nested block
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 10000))
+    for code in (generate_corpus(50), nested):
+        program = _uncommented_program(TokenBuffer(code))
+        assert _reindented_str(program) == str(program)
+
+
+def test_write_to_matches_str(tmp_path):
+    program = Parser(code=generate_corpus(20)).parse()
+    path = tmp_path / 'program.c'
+    with open(path, 'w') as file:
+        program.write_to(file)
+    assert path.read_text() == str(program)
+
+
+def test_comments_are_kept():
+    program = Parser(code=generate_corpus(20)).parse()
+    attach_comments(program, program.comments)
+    text = str(program)
+    assert all(comment.value in text for comment in program.comments)
+
+
+def test_render_cache_after_edits():
+    program = _uncommented_program(TokenBuffer(generate_corpus(50)))
+    rng = random.Random(0)
+    identifiers = program.nodes_of_class(Identifier)
+    with caching_renders(program):
+        str(program)
+        for _ in range(20):
+            identifier = cast(Identifier, rng.choice(identifiers))
+            identifier.assign('name', identifier.name + '_')
+            text = str(program)
+    assert text == str(program)
+
+
+def test_render_cache_below_else_if():
+    # Else-if branches are written without str(), changes below them must still reach the cached
+    # text above
+    else_if = "int f() { if (a) x = 1; else if (b + c) y = 2; else z = 3; }"
+    edited = Parser(code=else_if).parse()
+    refactored = Parser(code=else_if.replace('b + c', 'this->vtbl->M(this)')).parse()
+    with caching_renders(edited), caching_renders(refactored):
+        before = str(edited)
+        edited.identifiers_named('b')[0].assign('name', 'CHANGED')
+        assert str(edited) == before.replace('b + c', 'CHANGED + c')
+        str(refactored)
+        assert 'this->M()' in str(apply_refactorings(refactored))
+    assert all(node._rendered is None for node in walk_preorder(refactored))
+
+
+def test_render_cache_fixed_point():
+    tokens = TokenBuffer(generate_corpus(50))
+    cached = _uncommented_program(tokens)
+    with caching_renders(cached):
+        _str_fixed_point(cached)
+    assert str(cached) == str(_str_fixed_point(_uncommented_program(tokens)))
+
+
+def test_structural_hash():
+    program = Parser(code=generate_corpus(50)).parse()
+    rng = random.Random(0)
+    operands = program.nodes_of_class(Operand)
+    pairs = [(rng.choice(operands), rng.choice(operands)) for _ in range(20000)]
+    for first, second in pairs:
+        same = first.__class__ is second.__class__ and str(first) == str(second)
+        assert first.equals(second) == same
+        if same:
+            assert first.structural_hash() == second.structural_hash()
@@ -0,0 +1,59 @@
+from ast_nodes import FunctionCall, Identifier, Literal
+from benchmarks import _children_find_nodes, _rounds_fixed_point, _str_fixed_point, _uncommented_program, generate_corpus
+from hex_rays_parser import Parser
+from lexer import TokenBuffer
+from refactorings import RULES, WorklistEngine, apply_refactorings
+from visitor import mutation_count
+
+
+def test_find_nodes_matches_children():
+    program = Parser(code=generate_corpus(50)).parse()
+    is_call = lambda node: isinstance(node, FunctionCall)
+    assert _children_find_nodes(program, is_call) == program.find_nodes(is_call)
+
+
+def test_transform_returns_the_replaced_root():
+    identifier = Parser(code="a").parse_expression()
+    replacement = Literal('1', 0, 0)
+    assert identifier.transform(lambda node: replacement if isinstance(node, Identifier) else None) is replacement
+
+
+def test_refactorings_match_str_fixed_point():
+    tokens = TokenBuffer(generate_corpus(100))
+    assert str(apply_refactorings(_uncommented_program(tokens))) == str(_str_fixed_point(_uncommented_program(tokens)))
+
+
+def test_worklist_matches_full_rounds():
+    # Each `.data` only becomes removable once the one inside it is gone
+    cascade = f"void __cdecl Cascade(Object *this)\n{{\n  this->{'data.' * 20}vtbl->Run(this);\n}}\n"
+    tokens = TokenBuffer(generate_corpus(50) + cascade)
+    rounds_result = _uncommented_program(tokens)
+    rounds = _rounds_fixed_point(rounds_result)
+    worklist_result = _uncommented_program(tokens)
+    engine = WorklistEngine(RULES)
+    assert engine.run(worklist_result) is worklist_result
+    assert str(worklist_result) == str(rounds_result)
+    assert engine.generations == rounds
+
+
+def test_mutations_are_counted_per_tree():
+    tokens = TokenBuffer(generate_corpus(20))
+    refactored = apply_refactorings(_uncommented_program(tokens))
+    untouched = _uncommented_program(tokens)
+    assert mutation_count(refactored) > 0 and mutation_count(untouched) == 0
+    apply_refactorings(refactored)
+    assert mutation_count(untouched) == 0
+
+
+def test_reused_temporary():
+    # A temporary used twice is inlined as two copies, and both are rewritten
+    program = apply_refactorings(Parser(code="int f() { x = (v1 = this->vtbl->M(this), v1 + v1); }").parse())
+    assert str(program) == "int f()\n{\n    x = this->M() + this->M();\n}"
+
+
+def test_root_rewritten():
+    # The root is rewritten in the first traversal and again in a later generation
+    for code, expected in (("(a = b, (c = a, c))", "b"), ("(a = b, a)", "b"), ("(a = b, (c = a, (d = c, d + d)))", "b + b")):
+        expression = Parser(code=code).parse_expression()
+        refactored = apply_refactorings(expression)
+        assert str(refactored) == expected and refactored.parent is None
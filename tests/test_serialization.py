@@ -0,0 +1,62 @@
+import os
+
+import pytest
+
+import binary_ast
+from batch import process_files
+from benchmarks import _chain_code, generate_corpus
+from hex_rays_parser import Parser
+from serialization import decode, encode
+
+
+def test_binary_round_trip():
+    program = Parser(code=generate_corpus(50)).parse()
+    data = binary_ast.dumps(program)
+    loaded = binary_ast.loads(data)
+    assert encode(loaded) == encode(program)
+    assert [comment.value for comment in loaded.comments] == [comment.value for comment in program.comments]
+
+
+def test_open_file(tmp_path):
+    program = Parser(code=generate_corpus(20)).parse()
+    path = str(tmp_path / 'program.ast')
+    with open(path, 'wb') as file:
+        binary_ast.dump(program, file)
+    with binary_ast.open_file(path) as ast_file:
+        assert len(ast_file) == len(program.statements)
+        for index, statement in enumerate(program.statements):
+            assert str(ast_file.statement(index)) == str(statement)
+            assert str(ast_file.statement_named(statement.name)) == str(statement)
+
+
+def test_empty_file(tmp_path):
+    path = str(tmp_path / 'empty.ast')
+    open(path, 'wb').close()
+    with pytest.raises(ValueError, match="Not a binary AST file"):
+        binary_ast.open_file(path)
+
+
+def test_encode_round_trip():
+    program = Parser(code=generate_corpus(50)).parse()
+    assert encode(decode(encode(program))) == encode(program)
+
+
+def test_deep_tree_round_trip():
+    # Nested tuples are compared through their binary form, since comparing them recurses
+    chain_data = binary_ast.dumps(Parser(code=_chain_code()).parse())
+    assert binary_ast.dumps(binary_ast.loads(chain_data)) == chain_data
+    assert binary_ast.dumps(decode(encode(binary_ast.loads(chain_data)))) == chain_data
+
+
+def test_batch_ast_mode(tmp_path):
+    paths = []
+    for index, code in enumerate((generate_corpus(5), _chain_code(), "int f( {")):
+        paths.append(str(tmp_path / f"dump_{index}.c"))
+        with open(paths[-1], 'w') as file:
+            file.write(code)
+    for workers in (1, 2):
+        results = process_files(paths, workers, mode='ast')
+        for path, result in zip(paths[:2], results):
+            with open(path) as file:
+                assert result.output == binary_ast.dumps(Parser(code=file.read()).parse())
+        assert not results[2].ok and os.path.basename(results[2].path) == 'dump_2.c'
@@ -0,0 +1,257 @@
+from typing import TYPE_CHECKING, Callable, Dict, Iterator, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    from ast_nodes import ASTNode
+    from node_index import NodeIndex
+
+# A child's place in its parent: the field holding it, its index when that field is a list, and the child
+ChildSlot = Tuple[str, Optional[int], 'ASTNode']
+
+
+def iter_child_slots(node: 'ASTNode') -> Iterator[ChildSlot]:
+    # Reads the fields in place, children() builds a new list on every call
+    for field in node._child_fields:
+        value = getattr(node, field)
+        if value is None:
+            continue
+        if isinstance(value, list):
+            for index, child in enumerate(value):
+                yield field, index, child
+        else:
+            yield field, None, value
+
+
+def replace_slot(node: 'ASTNode', field: str, index: Optional[int], new_child: 'ASTNode'):
+    if index is None:
+        old_child = getattr(node, field)
+        # Bypasses the tracked __setattr__, link_child does the same bookkeeping
+        object.__setattr__(node, field, new_child)
+    else:
+        children = getattr(node, field)
+        old_child = children[index]
+        children[index] = new_child
+    link_child(node, old_child, new_child)
+
+
+def mutation_count(node: 'ASTNode') -> int:
+    # Changes made to node's tree so far: replace_child, transform replacements, rules changing
+    # nodes in place and ASTNode.assign. Only a Program keeps the count, other trees always give 0.
+    return getattr(_root(node), 'mutations', 0)
+
+
+def note_mutation(node: 'ASTNode') -> Optional['NodeIndex']:
+    # Counts a change to node's tree and gives the tree's node index, if it has one
+    root = _root(node)
+    if hasattr(root, 'mutations'):
+        root.mutations += 1
+    return getattr(root, 'index', None)
+
+
+def invalidate_cached(node: Optional['ASTNode']):
+    # Drops the text cached by caching_renders() and the structural hash of node and everything
+    # above it. This goes all the way up: the printer writes some statements without str(), such
+    # as else-if branches, so a node without cached text can have an ancestor with some.
+    while node is not None:
+        object.__setattr__(node, '_rendered', None)
+        object.__setattr__(node, '_hash', None)
+        node = node.parent
+
+
+def link_child(parent: 'ASTNode', old_child: 'ASTNode', new_child: 'ASTNode'):
+    # Bookkeeping for new_child having taken old_child's place under parent
+    index = note_mutation(parent)
+    invalidate_cached(parent)
+    new_child.parent = parent
+    link_subtree(new_child)
+    if index is not None:
+        index.replace(old_child, new_child)
+
+
+def unlink_child(parent: 'ASTNode', old_child: 'ASTNode'):
+    # Bookkeeping for old_child being dropped from parent without a replacement
+    index = note_mutation(parent)
+    invalidate_cached(parent)
+    if index is not None:
+        index.remove(old_child)
+
+
+def link_new_child(parent: 'ASTNode', new_child: 'ASTNode'):
+    # Bookkeeping for new_child being added to parent without replacing anything
+    index = note_mutation(parent)
+    invalidate_cached(parent)
+    new_child.parent = parent
+    link_subtree(new_child)
+    if index is not None:
+        index.add(new_child)
+
+
+def note_field_change(node: 'ASTNode', field: str, old_value):
+    # Bookkeeping for a field of node having been assigned, or a list in it changed in place, with
+    # old_value what the field held before (a copy, for a list changed in place)
+    index = note_mutation(node)
+    invalidate_cached(node)
+    if field not in node._child_fields:
+        if field == 'name' and index is not None:
+            index.rename(node, old_value)
+        return
+    if index is not None:
+        for child in (old_value if old_value.__class__ is list else (old_value,)):
+            if child is not None:
+                index.remove(child)
+    new_value = getattr(node, field)
+    for child in (new_value if new_value.__class__ is list else (new_value,)):
+        if child is not None:
+            child.parent = node
+            link_subtree(child)
+            if index is not None:
+                index.add(child)
+
+
+def link_subtree(root: 'ASTNode'):
+    # Points the parent links of a newly built subtree at their actual parents. Rewrite rules build
+    # new nodes around existing ones, whose links still lead to the nodes they were taken from.
+    # Descent stops at children that are already linked, so only the new part is walked.
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        for field in node._child_fields:
+            value = getattr(node, field)
+            for child in (value if value.__class__ is list else (value,)):
+                if child is not None and child.parent is not node:
+                    child.parent = node
+                    stack.append(child)
+
+
+def _root(node: 'ASTNode') -> 'ASTNode':
+    while node.parent is not None:
+        node = node.parent
+    return node
+
+
+class Visitor:
+    # Handlers are methods named visit_<ClassName>. A node without one goes to the handler of its
+    # nearest base class, then to generic_visit. The lookup is done once per node class.
+    _handlers: Dict[type, Callable] = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._handlers = {}
+
+    @classmethod
+    def _handler(cls, node_class: type) -> Callable:
+        handler = cls._handlers.get(node_class)
+        if handler is None:
+            handler = next((getattr(cls, 'visit_' + base.__name__) for base in node_class.__mro__
+                            if hasattr(cls, 'visit_' + base.__name__)), cls.generic_visit)
+            cls._handlers[node_class] = handler
+        return handler
+
+    def visit(self, node: 'ASTNode'):
+        return self.dispatch(node)
+
+    def dispatch(self, node: 'ASTNode'):
+        handler = self._handlers.get(node.__class__) or self._handler(node.__class__)
+        return handler(self, node)
+
+    def generic_visit(self, node: 'ASTNode'):
+        self.visit_children(node)
+
+    def visit_children(self, node: 'ASTNode'):
+        for field in node._child_fields:
+            value = getattr(node, field)
+            if value is None:
+                continue
+            if value.__class__ is list:
+                for child in value:
+                    self.visit(child)
+            else:
+                self.visit(value)
+
+
+class Transformer(Visitor):
+    # A handler returns the node's replacement, or None to keep the node and transform its children.
+    # Replacements are not visited, and the root can't be replaced: visit() returns its replacement.
+    # Nodes are handled in pre-order with an explicit stack, so depth is not bounded by recursion.
+    def visit(self, node: 'ASTNode') -> Optional['ASTNode']:
+        return _transform_tree(node, self.dispatch)
+
+    def generic_visit(self, node: 'ASTNode') -> Optional['ASTNode']:
+        return None
+
+
+class FunctionTransformer(Transformer):
+    def __init__(self, transformation: Callable[['ASTNode'], Optional['ASTNode']]):
+        self.transformation = transformation
+
+    def visit(self, node: 'ASTNode') -> Optional['ASTNode']:
+        # Every node goes to the same function, so there is nothing to dispatch
+        return _transform_tree(node, self.transformation)
+
+
+def _transform_tree(root: 'ASTNode', transformation: Callable[['ASTNode'], Optional['ASTNode']]) -> Optional['ASTNode']:
+    result = transformation(root)
+    if result is not None:
+        return result
+    stack: List[Tuple['ASTNode', str, Optional[int], 'ASTNode']] = []
+    push = stack.append
+    node = root
+    while True:
+        # Children are pushed last first, so they pop in children() order
+        for field in node._child_fields[::-1]:
+            value = getattr(node, field)
+            if value is None:
+                continue
+            if value.__class__ is list:
+                index = len(value)
+                for child in reversed(value):
+                    index -= 1
+                    push((node, field, index, child))
+            else:
+                push((node, field, None, value))
+        while True:
+            if not stack:
+                return None
+            parent, field, index, node = stack.pop()
+            result = transformation(node)
+            if result is None:
+                break
+            if result is not node:
+                replace_slot(parent, field, index, result)
+
+
+def _push_children(stack: list, node: 'ASTNode'):
+    # Pushed last child first, so they pop in children() order
+    for field in node._child_fields[::-1]:
+        value = getattr(node, field)
+        if value is None:
+            continue
+        if value.__class__ is list:
+            stack.extend(reversed(value))
+        else:
+            stack.append(value)
+
+
+def walk_preorder(root: 'ASTNode', prune: Optional[Callable[['ASTNode'], bool]] = None) -> Iterator['ASTNode']:
+    # Nodes for which prune returns True are yielded, but their children are not.
+    # Nothing past the node last yielded is visited, so breaking out early is cheap.
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        yield node
+        if prune is None or not prune(node):
+            _push_children(stack, node)
+
+
+def walk_postorder(root: 'ASTNode', prune: Optional[Callable[['ASTNode'], bool]] = None) -> Iterator['ASTNode']:
+    # Each node is yielded after all of its children, pruned nodes without their children
+    stack: List[Tuple['ASTNode', bool]] = [(root, False)]
+    children: List['ASTNode'] = []
+    while stack:
+        node, expanded = stack.pop()
+        if expanded or (prune is not None and prune(node)):
+            yield node
+            continue
+        stack.append((node, True))
+        _push_children(children, node)
+        stack.extend((child, False) for child in children)
+        children.clear()